@@ -17,19 +17,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from operator import attrgetter
 from os import path
 import os
 import sys
 import yaml
-from queue import Queue
 import shutil
 import subprocess
-import time
+import threading
 import requests
 
-from macumba import MacumbaError, ServerError
-from cloudinstall import utils
+from macumba import MacumbaError
+from cloudinstall import trace, utils
+from cloudinstall.journal import JournalStep, relation_key
 from cloudinstall.placement.controller import AssignmentType
+from cloudinstall.scheduler import (RelationEngine, RelationState,
+                                    TaskScheduler, post_proc_graph)
 
 log = logging.getLogger('cloudinstall.charms')
 
@@ -107,6 +110,8 @@ class CharmBase:
     subordinate = False
     openstack_release_min = 'i'
     depends = []
+    # charms whose post_proc must finish before this one's
+    post_proc_depends = []
     conflicts = []
     is_core = False
     contrib = False
@@ -367,14 +372,27 @@ class CharmQueue:
     """ charm queue for handling relations in the background
     """
 
+    # rounds of add_relations before a failing relation is an error
+    relation_attempts = 5
+    # seconds before re-sending failed relations, doubled each round
+    relation_backoff = 1
+    # post_procs running at once
+    post_proc_workers = 4
+    # seconds before re-trying a deferred post_proc, doubled each time
+    post_proc_backoff = 5
+
     def __init__(self, ui, config, juju_state=None, juju=None,
-                 deployed_charms=None):
-        self.charm_post_proc_q = Queue()
+                 deployed_charms=None, journal=None):
         self.is_running = False
         self.ui = ui
         self.config = config
         self.juju = juju
         self.juju_state = juju_state
+        # :class:`cloudinstall.journal.DeployJournal`, relations and
+        # post_procs it records as done are skipped
+        self.journal = journal
+        # set once every post_proc has finished
+        self.post_proc_done = threading.Event()
         if deployed_charms is None:
             self.deployed_charms = []
         else:
@@ -420,29 +438,46 @@ class CharmQueue:
     def watch_relations_async(self):
         self.watch_relations()
 
+    @trace.traced
     def watch_relations(self):
         """ Setup charm relations
+
+        Relations are added by a RelationEngine, which retries only the
+        ones that fail.
         """
-        valid_relations = self.filter_valid_relations()
-        completed_relations = []
+        valid_relations = [r for r in self.filter_valid_relations()
+                           if not self._journaled(JournalStep.RELATION_ADDED,
+                                                  relation_key(r))]
         if len(valid_relations) <= 0:
             return
         log.debug("Processing relations: {}".format(valid_relations))
-        while len(valid_relations) != len(completed_relations):
-            for relation_a, relation_b in valid_relations:
-                try:
-                    self.juju.add_relation(relation_a,
-                                           relation_b)
-                    completed_relations.append((relation_a,
-                                                relation_b))
-                except ServerError as e:
-                    msg = ('Failure in add_relation({}, {}): {}'.format(
-                        relation_a,
-                        relation_b,
-                        e))
-                    log.exception(msg)
-                    self.ui.status_info_message(msg)
-                    raise e
+        engine = RelationEngine(self.juju, valid_relations,
+                                attempts=self.relation_attempts,
+                                backoff=self.relation_backoff,
+                                on_progress=self._relation_progress)
+        try:
+            engine.run()
+        except Exception as e:
+            relation_a, relation_b = engine.outstanding()[0]
+            msg = ('Failure in add_relation({}, {}): {}'.format(
+                relation_a,
+                relation_b,
+                e))
+            log.error(msg)
+            self.ui.status_info_message(msg)
+            raise
+
+    def _relation_progress(self, engine, relation):
+        total = len(engine.states)
+        added = len(engine.relations_in_state(RelationState.ADDED))
+        if engine.states[relation] == RelationState.ADDED:
+            self._record(JournalStep.RELATION_ADDED, relation_key(relation))
+            self.ui.status_info_message(
+                "Added relation {} <-> {} ({}/{})".format(
+                    relation[0], relation[1], added, total))
+        else:
+            log.warning("Relation {} <-> {} failed: {}".format(
+                relation[0], relation[1], engine.errors[relation]))
 
     def _charm_classes(self):
         """ Returns instances of deployed charms """
@@ -460,21 +495,49 @@ class CharmQueue:
     def watch_post_proc_async(self):
         self.watch_post_proc()
 
+    @trace.traced
     def watch_post_proc(self):
-        for charm in self._charm_classes():
-            self.charm_post_proc_q.put(charm)
+        """ Runs every deployed charm's post_proc
 
-        log.debug("Starting charm post processing watcher.")
-        while not self.charm_post_proc_q.empty():
-            try:
-                charm = self.charm_post_proc_q.get()
-                err = charm.post_proc()
-                if err:
-                    self.charm_post_proc_q.put(charm)
-                self.charm_post_proc_q.task_done()
-            except:
-                msg = "Exception in post-processing watcher, re-trying."
-                log.exception(msg)
-                self.ui.status_error_message(msg)
-            time.sleep(10)
-        self.config.setopt('deploy_complete', True)
+        Post-procs run side by side on a worker pool, each after the
+        post-procs named in its charm's post_proc_depends. One that
+        returns True is re-tried after its own backoff.
+        """
+        try:
+            charms = self._charm_classes()
+            log.debug("Starting charm post processing.")
+            TaskScheduler(post_proc_graph(charms), self._post_proc,
+                          workers=self.post_proc_workers,
+                          backoff=self.post_proc_backoff,
+                          max_backoff=60,
+                          key=attrgetter('deploy_priority',
+                                         'charm_name')).run()
+            self.config.setopt('deploy_complete', True)
+        finally:
+            # headless mode waits on this, failed or not
+            self.post_proc_done.set()
+
+    def _journaled(self, step, key):
+        return self.journal is not None and self.journal.done(step, key)
+
+    def _record(self, step, key):
+        if self.journal is not None:
+            self.journal.record(step, key)
+
+    def _post_proc(self, charm):
+        """ post_proc, an exception is reported and not re-tried """
+        if self._journaled(JournalStep.POST_PROC_DONE, charm.charm_name):
+            log.debug("post_proc of {} already done".format(
+                charm.charm_name))
+            return False
+        try:
+            with trace.span("post_proc " + charm.charm_name, cat='post_proc'):
+                deferred = charm.post_proc()
+            if not deferred:
+                self._record(JournalStep.POST_PROC_DONE, charm.charm_name)
+            return deferred
+        except:
+            msg = "Exception in post-processing {}.".format(charm.charm_name)
+            log.exception(msg)
+            self.ui.status_error_message(msg)
+            return False
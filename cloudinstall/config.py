@@ -44,6 +44,8 @@ class Config:
         else:
             self._juju_env = None
         self.node_install_wait_interval = 0.2
+        # seconds a juju status snapshot is reused before refetching
+        self.juju_status_ttl = 20
         if cfg_obj is None:
             self._config = {}
         else:
@@ -102,6 +104,10 @@ class Config:
     def placements_filename(self):
         return os.path.join(self.cfg_path, 'placements.yaml')
 
+    @property
+    def journal_filename(self):
+        return os.path.join(self.cfg_path, 'deploy-journal')
+
     def is_single(self):
         if self.getopt('install_type') and \
            'Single' in self.getopt('install_type'):
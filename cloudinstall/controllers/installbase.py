@@ -117,6 +117,10 @@ class InstallController:
         if not self.config.getopt('headless'):
             self.ui.hide_selector_info()
 
+        # A new install starts a new deployment journal
+        if os.path.exists(self.config.journal_filename):
+            os.remove(self.config.journal_filename)
+
         # Set installed placeholder
         utils.spew(os.path.join(
             self.config.cfg_path, 'installed'), 'auto-generated')
@@ -14,24 +14,28 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import time
+import threading
 import sys
+import time
 
 from os import path, getenv
 
 from operator import attrgetter
 
-from cloudinstall import utils
+from cloudinstall import remote, trace, utils
 from cloudinstall.state import ControllerState
-from cloudinstall.juju import JujuState
+from cloudinstall.journal import (DeployJournal, JournalStep,
+                                  JournalScopeUnknown)
+from cloudinstall.juju import JujuState, JujuWatchState
 from cloudinstall.maas import (connect_to_maas, FakeMaasState,
                                MaasMachineStatus)
 from cloudinstall.charms import CharmQueue
 from cloudinstall.log import PrettyLog
+from cloudinstall.scheduler import DeployScheduler, TaskState
 from cloudinstall.placement.controller import (PlacementController,
                                                AssignmentType)
 
-from macumba import JujuClient
+from macumba import JujuClient, MacumbaError
 from macumba import Jobs as JujuJobs
 
 
@@ -45,6 +49,9 @@ class FakeJujuState:
     def services(self):
         return []
 
+    def get_services(self, allow_stale=False):
+        return []
+
     def machines(self):
         return []
 
@@ -56,6 +63,10 @@ class Controller:
 
     """ Controller for Juju deployments and Maas machine init """
 
+    # reads of the juju environment UUID before giving up
+    journal_scope_attempts = 5
+    journal_scope_retry_delay = 2
+
     def __init__(self, ui, config, loop):
         self.ui = ui
         self.ui.controller = self
@@ -69,6 +80,9 @@ class Controller:
         self.juju_m_idmap = None  # for single, {instance_id: machine id}
         self.deployed_charm_classes = []
         self.placement_controller = None
+        self.journal = None
+        # try_deploy runs concurrently for different charms
+        self.placement_lock = threading.Lock()
         self.config.setopt('current_state', ControllerState.INSTALL_WAIT.value)
 
     def update(self, *args, **kwargs):
@@ -106,8 +120,9 @@ class Controller:
         """
         if not self.juju_state:
             return
-        deployed_services = sorted(self.juju_state.services,
-                                   key=attrgetter('service_name'))
+        deployed_services = sorted(
+            self.juju_state.get_services(allow_stale=True),
+            key=attrgetter('service_name'))
         deployed_service_names = [s.service_name for s in deployed_services]
 
         charm_classes = sorted(
@@ -141,10 +156,47 @@ class Controller:
         self.juju = JujuClient(
             url=path.join('wss://', state_server),
             password=self.config.juju_api_password)
+        self.juju.tracer = trace.span
         self.juju.login()
-        self.juju_state = JujuState(self.juju)
+        if self.config.getopt('juju_watch_state'):
+            self.juju_state = JujuWatchState(self.juju)
+            self.juju_state.start()
+        else:
+            self.juju_state = JujuState(
+                self.juju, cache_ttl=self.config.getopt('juju_status_ttl'))
         log.debug('Authenticated against juju api.')
 
+    def journal_scope(self):
+        """ Identifies the juju environment, so a deployment journal left
+        by an earlier environment isn't resumed
+
+        :raises JournalScopeUnknown: if juju keeps failing to report it
+        """
+        if self.juju is None:
+            return None
+        for attempt in range(self.journal_scope_attempts):
+            try:
+                info = self.juju.info()
+                break
+            except MacumbaError:
+                log.exception("Could not read the juju environment UUID "
+                              "(attempt {})".format(attempt + 1))
+                time.sleep(self.journal_scope_retry_delay)
+        else:
+            # Guessing another identity would throw away the journal of
+            # the environment we are resuming
+            raise JournalScopeUnknown("Could not read the juju environment "
+                                      "UUID; leaving the deployment journal "
+                                      "as is")
+        return info.get('UUID') or self.juju.url
+
+    def dump_juju_metrics(self, filename):
+        """ Writes the Juju API client's request metrics to filename """
+        if self.juju is None:
+            return
+        self.juju.metrics.dump(filename)
+        log.info("Wrote juju api metrics to {}".format(filename))
+
     def initialize(self):
         """Authenticates against juju/maas and sets up placement controller."""
         if getenv("FAKE_API_DATA"):
@@ -184,6 +236,9 @@ class Controller:
 
             self.placement_controller.set_all_assignments(def_assignments)
 
+        self.journal = DeployJournal(self.config.journal_filename,
+                                     scope=self.journal_scope())
+
         pfn = self.config.placements_filename
         self.placement_controller.set_autosave_filename(pfn)
         self.placement_controller.do_autosave()
@@ -221,6 +276,7 @@ class Controller:
         """
         self.begin_deployment()
 
+    @trace.traced
     def begin_deployment(self):
         if self.config.is_multi():
 
@@ -229,17 +285,22 @@ class Controller:
             self.maas.nodes_accept_all()
             self.maas.tag_name(self.maas.nodes)
 
-            while not self.all_maas_machines_ready():
-                time.sleep(3)
+            self.maas_state.invalidate_nodes_cache()
+            utils.wait_until(self.all_maas_machines_ready, self.maas_state)
 
             self.add_machines_to_juju_multi()
 
         elif self.config.is_single():
             self.add_machines_to_juju_single()
 
+        self.juju_state.invalidate_status_cache()
         # Quiet out some of the logging
         _previous_summary = None
-        while not self.all_juju_machines_started():
+
+        def machines_started():
+            nonlocal _previous_summary
+            if self.all_juju_machines_started():
+                return True
             sd = self.juju_state.machines_summary()
             summary = ", ".join(["{} {}".format(v, k) for k, v
                                  in sd.items()])
@@ -247,8 +308,9 @@ class Controller:
                 self.ui.status_info_message("Waiting for machines to "
                                             "start: {}".format(summary))
                 _previous_summary = summary
+            return False
 
-            time.sleep(1)
+        utils.wait_until(machines_started, self.juju_state)
 
         if len(self.juju_state.machines()) == 0:
             raise Exception("Expected some juju machines started.")
@@ -257,10 +319,11 @@ class Controller:
         if not self.config.getopt("deploy_complete"):
             if self.config.is_single():
                 controller_machine = self.juju_m_idmap['controller']
-                self.configure_lxc_network(controller_machine)
+                if not self.step_done(JournalStep.LXC_NETWORK,
+                                      controller_machine):
+                    self.configure_lxc_network(controller_machine)
 
-                for juju_machine_id in self.juju_m_idmap.values():
-                    self.run_apt_go_fast(juju_machine_id)
+                self.run_apt_go_fast(list(self.juju_m_idmap.values()))
 
             if self.config.is_single():
                 self.set_unique_hostnames()
@@ -271,33 +334,42 @@ class Controller:
         else:
             self.ui.status_info_message("Ready")
 
+    @trace.traced
     def set_unique_hostnames(self):
         """checks for and ensures unique hostnames, so e.g. ceph can assume
         that.
 
         FIXME: Remove once http://pad.lv/1326091 is fixed
         """
+        commands = {}
         count = 0
         for machine in self.juju_state.machines():
             count += 1
+            if self.step_done(JournalStep.HOSTNAME_SET, machine.machine_id):
+                continue
             hostname = machine.machine.get('InstanceId',
                                            "ubuntu-{}".format(count))
 
             log.debug("Setting hostname of {} to {}".format(machine,
                                                             hostname))
-            juju_home = self.config.juju_home(use_expansion=True)
-            utils.remote_run(
-                machine.machine_id,
-                cmds="echo {} | sudo tee /etc/hostname".format(hostname),
-                juju_home=juju_home)
-            utils.remote_run(
-                machine.machine_id,
-                cmds="sudo hostname {}".format(hostname),
-                juju_home=juju_home)
+            commands[machine.machine_id] = [
+                "echo {} | sudo tee /etc/hostname".format(hostname),
+                "sudo hostname {}".format(hostname)]
+        results = remote.run_each(
+            commands, juju_home=self.config.juju_home(use_expansion=True))
+        for machine_id, result in results.items():
+            if result.ok:
+                self.record_step(JournalStep.HOSTNAME_SET, machine_id)
+
+    def step_done(self, step, key):
+        """ True if the deployment journal has step finished for key """
+        return self.journal is not None and self.journal.done(step, key)
+
+    def record_step(self, step, key, data=None):
+        if self.journal is not None:
+            self.journal.record(step, key, data)
 
     def all_maas_machines_ready(self):
-        self.maas_state.invalidate_nodes_cache()
-
         needed = set([m.instance_id for m in
                       self.placement_controller.machines_pending()])
         ready = set([m.instance_id for m in
@@ -315,6 +387,7 @@ class Controller:
             return False
         return True
 
+    @trace.traced
     def add_machines_to_juju_multi(self):
         """Adds each of the machines used for the placement to juju, if it
         isn't already there."""
@@ -323,6 +396,7 @@ class Controller:
         juju_ids = [jm.instance_id for jm in self.juju_state.machines()]
 
         machine_params = []
+        added = []
         for maas_machine in self.placement_controller.machines_pending():
             if maas_machine.instance_id in juju_ids:
                 # ignore machines that are already added to juju
@@ -331,6 +405,7 @@ class Controller:
             mp = dict(Series="", ContainerType="", ParentId="",
                       Constraints=cd, Jobs=[JujuJobs.HostUnits])
             machine_params.append(mp)
+            added.append(maas_machine)
 
         if len(machine_params) > 0:
             import pprint
@@ -338,34 +413,35 @@ class Controller:
                       " {}".format(pprint.pformat(machine_params)))
             rv = self.juju.add_machines(machine_params)
             log.debug("add_machines returned '{}'".format(rv))
+            for maas_machine, d in zip(added, rv['Machines']):
+                if not d['Error']:
+                    self.record_step(JournalStep.MACHINE_ADDED,
+                                     maas_machine.instance_id,
+                                     d['Machine'])
 
     def all_juju_machines_started(self):
-        self.juju_state.invalidate_status_cache()
         n_needed = len(self.placement_controller.machines_pending())
         n_allocated = len([jm for jm in self.juju_state.machines()
                            if jm.agent_state == 'started'])
         return n_allocated >= n_needed
 
+    @trace.traced
     def add_machines_to_juju_single(self):
         self.juju_state.invalidate_status_cache()
         self.juju_m_idmap = {}
-        for jm in self.juju_state.machines():
-            response = self.juju.get_annotations(jm.machine_id,
-                                                 'machine')
+        juju_machines = self.juju_state.machines()
+        responses = self.juju.get_annotations_many(
+            [(jm.machine_id, 'machine') for jm in juju_machines])
+        for jm, response in zip(juju_machines, responses):
+            if isinstance(response, Exception):
+                raise response
             ann = response['Annotations']
             if 'instance_id' in ann:
                 self.juju_m_idmap[ann['instance_id']] = jm.machine_id
 
         log.debug("existing juju machines: {}".format(self.juju_m_idmap))
 
-        def get_created_machine_id(iid, response):
-            d = response['Machines'][0]
-            if d['Error']:
-                raise Exception("Error adding machine '{}':"
-                                "{}".format(iid, response))
-            else:
-                return d['Machine']
-
+        pending = []
         for machine in self.placement_controller.machines_pending():
             if machine.instance_id in self.juju_m_idmap:
                 machine.machine_id = self.juju_m_idmap[machine.instance_id]
@@ -373,45 +449,85 @@ class Controller:
                           "skipping".format(machine.instance_id,
                                             machine.machine_id))
                 continue
-            log.debug("adding machine with "
-                      "constraints={}".format(machine.constraints))
-            rv = self.juju.add_machine(constraints=machine.constraints)
-            m_id = get_created_machine_id(machine.instance_id, rv)
-            machine.machine_id = m_id
-            rv = self.juju.set_annotations(m_id, 'machine',
-                                           {'instance_id':
-                                            machine.instance_id})
-            self.juju_m_idmap[machine.instance_id] = m_id
-
-    def run_apt_go_fast(self, machine_id):
-        utils.remote_cp(machine_id,
-                        src=path.join(self.config.share_path,
-                                      "tools/apt-go-fast"),
-                        dst="/tmp/apt-go-fast",
-                        juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_run(machine_id,
-                         cmds="sudo sh /tmp/apt-go-fast",
-                         juju_home=self.config.juju_home(use_expansion=True))
+            pending.append(machine)
+
+        if len(pending) == 0:
+            return
 
+        log.debug("adding machines with constraints={}".format(
+            [m.constraints for m in pending]))
+        rv = self.juju.add_machines([
+            self.juju.machine_params(constraints=m.constraints)
+            for m in pending])
+
+        # annotate every machine that was created before reporting an
+        # error, so a re-run finds them instead of adding them again
+        added = []
+        errors = []
+        for machine, d in zip(pending, rv['Machines']):
+            if d['Error']:
+                errors.append("Error adding machine '{}':"
+                              "{}".format(machine.instance_id, d))
+                continue
+            machine.machine_id = d['Machine']
+            self.juju_m_idmap[machine.instance_id] = machine.machine_id
+            added.append(machine)
+            self.record_step(JournalStep.MACHINE_ADDED, machine.instance_id,
+                             machine.machine_id)
+
+        responses = self.juju.set_annotations_many(
+            [(m.machine_id, 'machine', {'instance_id': m.instance_id})
+             for m in added])
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        if errors:
+            raise Exception(errors[0])
+
+    @trace.traced
+    def run_apt_go_fast(self, machine_ids):
+        machine_ids = [m for m in machine_ids
+                       if not self.step_done(JournalStep.APT_GO_FAST, m)]
+        if len(machine_ids) == 0:
+            return
+        juju_home = self.config.juju_home(use_expansion=True)
+        copied = remote.copy(machine_ids,
+                             src=path.join(self.config.share_path,
+                                           "tools/apt-go-fast"),
+                             dst="/tmp/apt-go-fast",
+                             juju_home=juju_home)
+        results = remote.run([m for m, r in copied.items() if r.ok],
+                             cmds="sudo sh /tmp/apt-go-fast",
+                             juju_home=juju_home)
+        for machine_id, result in results.items():
+            if result.ok:
+                self.record_step(JournalStep.APT_GO_FAST, machine_id)
+
+    @trace.traced
     def configure_lxc_network(self, machine_id):
         # upload our lxc-host-only template and setup bridge
         log.info('Copying network specifications to machine')
         srcpath = path.join(self.config.tmpl_path, 'lxc-host-only')
         destpath = "/tmp/lxc-host-only"
-        utils.remote_cp(machine_id, src=srcpath, dst=destpath,
-                        juju_home=self.config.juju_home(use_expansion=True))
+        juju_home = self.config.juju_home(use_expansion=True)
+        remote.copy([machine_id], src=srcpath, dst=destpath,
+                    juju_home=juju_home)
         log.debug('Updating network configuration for machine')
-        utils.remote_run(machine_id,
-                         cmds="sudo chmod +x /tmp/lxc-host-only",
-                         juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_run(machine_id,
-                         cmds="sudo /tmp/lxc-host-only",
-                         juju_home=self.config.juju_home(use_expansion=True))
-
+        results = remote.run([machine_id],
+                             cmds=["sudo chmod +x {}".format(destpath),
+                                   "sudo {}".format(destpath)],
+                             juju_home=juju_home)
+        if results[str(machine_id)].ok:
+            self.record_step(JournalStep.LXC_NETWORK, machine_id)
+
+    @trace.traced
     def deploy_using_placement(self):
         """Deploy charms using machine placement from placement controller,
         waiting for any deferred charms.  Then enqueue all charms for
         further processing and return.
+
+        Charms are deployed concurrently by a DeployScheduler, each as
+        soon as the charms ordered before it are deployed.
         """
 
         self.ui.status_info_message("Verifying service deployments")
@@ -419,55 +535,50 @@ class Controller:
         charm_classes = sorted(assigned_ccs,
                                key=attrgetter('deploy_priority'))
 
-        def undeployed_charm_classes():
-            return [c for c in charm_classes
-                    if c not in self.deployed_charm_classes]
-
-        def update_pending_display():
-            pending_names = [c.display_name for c in
-                             undeployed_charm_classes()]
-            self.ui.set_pending_deploys(pending_names)
+        def deploy(charm_class):
+            self.ui.status_info_message(
+                "Checking if {c} is deployed".format(
+                    c=charm_class.display_name))
 
-        while len(undeployed_charm_classes()) > 0:
-            update_pending_display()
+            service_names = [s.service_name for s in
+                             self.juju_state.services]
 
-            for charm_class in undeployed_charm_classes():
+            if charm_class.charm_name in service_names:
                 self.ui.status_info_message(
-                    "Checking if {c} is deployed".format(
+                    "{c} is already deployed, skipping".format(
                         c=charm_class.display_name))
+                self.record_step(JournalStep.CHARM_DEPLOYED,
+                                 charm_class.charm_name)
+                return False
 
-                service_names = [s.service_name for s in
-                                 self.juju_state.services]
-
-                if charm_class.charm_name in service_names:
-                    self.ui.status_info_message(
-                        "{c} is already deployed, skipping".format(
-                            c=charm_class.display_name))
-                    self.deployed_charm_classes.append(charm_class)
-                    continue
-
+            with trace.span("deploy " + charm_class.charm_name):
                 err = self.try_deploy(charm_class)
-                name = charm_class.display_name
-                if err:
-                    log.debug(
-                        "{} is waiting for another service, will"
-                        " re-try in a few seconds".format(name))
-                    break
-                else:
-                    log.debug("Issued deploy for {}".format(name))
-                    self.deployed_charm_classes.append(charm_class)
-
-                self.juju_state.invalidate_status_cache()
-                update_pending_display()
-
-            num_remaining = len(undeployed_charm_classes())
-            if num_remaining > 0:
-                log.debug("{} charms pending deploy.".format(num_remaining))
-                log.debug("deployed_charm_classes={}".format(
-                    PrettyLog(self.deployed_charm_classes)))
+            name = charm_class.display_name
+            if err:
+                log.debug(
+                    "{} is waiting for another service, will"
+                    " re-try".format(name))
+            else:
+                log.debug("Issued deploy for {}".format(name))
+            self.juju_state.invalidate_status_cache()
+            return err
+
+        def update_pending_display(scheduler):
+            for cc in scheduler.tasks_in_state(TaskState.DONE):
+                if cc not in self.deployed_charm_classes:
+                    self.deployed_charm_classes.append(cc)
+            pending_names = [c.display_name for c in
+                             charm_classes if c in scheduler.pending()]
+            self.ui.set_pending_deploys(pending_names)
 
-                time.sleep(5)
-            update_pending_display()
+        undeployed = [c for c in charm_classes
+                      if c not in self.deployed_charm_classes]
+        scheduler = DeployScheduler(undeployed, deploy,
+                                    on_change=update_pending_display)
+        update_pending_display(scheduler)
+        scheduler.run()
+        log.debug("deployed_charm_classes={}".format(
+            PrettyLog(self.deployed_charm_classes)))
 
     def try_deploy(self, charm_class):
         "returns True if deploy is deferred and should be tried again."
@@ -477,9 +588,12 @@ class Controller:
                             ui=self.ui,
                             config=self.config)
 
-        asts = self.placement_controller.get_assignments(charm_class)
+        with self.placement_lock:
+            asts = self.placement_controller.get_assignments(charm_class)
         errs = []
-        first_deploy = True
+        # a re-try after some units were deferred only adds units
+        first_deploy = not self.step_done(JournalStep.CHARM_DEPLOYED,
+                                          charm_class.charm_name)
         for atype, ml in asts.items():
             for machine in ml:
                 mspec = self.get_machine_spec(machine, atype)
@@ -497,20 +611,30 @@ class Controller:
                         errs.append(machine)
                     else:
                         first_deploy = False
+                        self.record_step(JournalStep.CHARM_DEPLOYED,
+                                         charm_class.charm_name)
                 else:
                     # service already deployed, need to add-unit
-                    msg = ("Adding one unit of "
-                           "{c}".format(c=charm_class.display_name))
-                    if mspec != '':
-                        msg += " to machine {mspec}".format(mspec=mspec)
-                    self.ui.status_info_message(msg)
-                    deploy_err = charm.add_unit(machine_spec=mspec)
+                    unit_key = "{} {}".format(charm_class.charm_name,
+                                              machine.instance_id)
+                    if self.step_done(JournalStep.UNIT_ADDED, unit_key):
+                        deploy_err = False
+                    else:
+                        msg = ("Adding one unit of "
+                               "{c}".format(c=charm_class.display_name))
+                        if mspec != '':
+                            msg += " to machine {mspec}".format(mspec=mspec)
+                        self.ui.status_info_message(msg)
+                        deploy_err = charm.add_unit(machine_spec=mspec)
                     if deploy_err:
                         errs.append(machine)
+                    else:
+                        self.record_step(JournalStep.UNIT_ADDED, unit_key)
                 if not deploy_err:
-                    self.placement_controller.mark_deployed(machine,
-                                                            charm_class,
-                                                            atype)
+                    with self.placement_lock:
+                        self.placement_controller.mark_deployed(machine,
+                                                                charm_class,
+                                                                atype)
 
         had_err = len(errs) > 0
         if had_err and not self.config.getopt('headless'):
@@ -527,10 +651,10 @@ class Controller:
             # placeholder machines do not use a machine spec
             return ""
 
-        jm = next((m for m in self.juju_state.machines()
-                   if (m.instance_id == maas_machine.instance_id or
-                       m.machine_id == maas_machine.machine_id)), None)
+        jm = self.juju_state.machine_by_instance_id(maas_machine.instance_id)
         if jm is None:
+            jm = self.juju_state.machine(maas_machine.machine_id)
+        if jm.machine_id == -1:
             log.error("could not find juju machine matching {}"
                       " (instance id {})".format(maas_machine,
                                                  maas_machine.instance_id))
@@ -548,6 +672,7 @@ class Controller:
             log.error("unexpected atype: {}".format(atype))
             return None
 
+    @trace.traced
     def wait_for_deployed_services_ready(self):
         """ Blocks until all deployed services attached units
         are in a 'started' state
@@ -559,28 +684,34 @@ class Controller:
             "Waiting for deployed services to be in a ready state.")
 
         not_ready_len = 0
-        while not self.juju_state.all_agents_started():
+
+        def agents_started():
+            nonlocal not_ready_len
+            if self.juju_state.all_agents_started():
+                return True
             not_ready = [(a, b) for a, b in self.juju_state.get_agent_states()
                          if b != 'started']
-            if len(not_ready) == not_ready_len:
-                time.sleep(3)
-                continue
+            if len(not_ready) != not_ready_len:
+                not_ready_len = len(not_ready)
+                log.info("Checking availability of {} ".format(
+                    ", ".join(["{}:{}".format(a, b) for a, b in not_ready])))
+            return False
 
-            not_ready_len = len(not_ready)
-            log.info("Checking availability of {} ".format(
-                ", ".join(["{}:{}".format(a, b) for a, b in not_ready])))
-            time.sleep(3)
+        self.juju_state.invalidate_status_cache()
+        utils.wait_until(agents_started, self.juju_state)
 
         self.ui.status_info_message(
             "Processing relations and finalizing services")
 
+    @trace.traced
     def enqueue_deployed_charms(self):
         """Send all deployed charms to CharmQueue for relation setting and
         post-proc.
         """
         charm_q = CharmQueue(ui=self.ui, config=self.config,
                              juju=self.juju, juju_state=self.juju_state,
-                             deployed_charms=self.deployed_charm_classes)
+                             deployed_charms=self.deployed_charm_classes,
+                             journal=self.journal)
 
         if self.config.getopt('headless'):
             charm_q.watch_relations()
@@ -593,11 +724,10 @@ class Controller:
         # Exit cleanly if we've finished all deploys, relations,
         # post processing, and running in headless mode.
         if self.config.getopt('headless'):
-            while not self.config.getopt('deploy_complete'):
+            if not self.config.getopt('deploy_complete'):
                 self.ui.status_info_message(
                     "Waiting for services to be started.")
-                # FIXME: Is this needed?
-                # time.sleep(10)
+                charm_q.post_proc_done.wait()
             self.ui.status_info_message(
                 "All services deployed, relations set, and started")
             self.loop.exit(0)
@@ -246,13 +246,14 @@ class ServicesView(ScrollableWidgetWrap):
 
         Returns list of text and formatting tuples
         """
-        juju_machine = self.juju_state.machine(unit.machine_id)
+        juju_machine = self.juju_state.machine(unit.machine_id,
+                                               allow_stale=True)
         maas_machine = None
         if self.maas_state:
             maas_machine = self.maas_state.machine(juju_machine.instance_id)
 
         m = juju_machine
-        if juju_machine.arch == "N/A":
+        if juju_machine.arch is None:
             if maas_machine:
                 m = maas_machine
             else:
@@ -271,9 +272,10 @@ class ServicesView(ScrollableWidgetWrap):
         like a container.
 
         """
-        base_machine = self.juju_state.base_machine(unit.machine_id)
+        base_machine = self.juju_state.base_machine(unit.machine_id,
+                                                    allow_stale=True)
 
-        if base_machine.arch == "N/A" and self.maas_state is not None:
+        if base_machine.arch is None and self.maas_state is not None:
             m = self.maas_state.machine(base_machine.instance_id)
         else:
             m = base_machine
@@ -303,9 +305,13 @@ class ServicesView(ScrollableWidgetWrap):
         return rl
 
     def _hardware_info_for_machine(self, m):
-        return [('label', 'arch'), ' {}  '.format(m.arch),
-                ('label', 'cores'), ' {}  '.format(m.cpu_cores),
-                ('label', 'mem'), ' {}  '.format(m.mem),
+        # juju machines report parsed values, maas machines display strings
+        mem = m.mem
+        if isinstance(mem, int):
+            mem = "{}M".format(mem)
+        return [('label', 'arch'), ' {}  '.format(m.arch or "N/A"),
+                ('label', 'cores'), ' {}  '.format(m.cpu_cores or "N/A"),
+                ('label', 'mem'), ' {}  '.format(mem or "N/A"),
                 ('label', 'storage'), ' {}'.format(m.storage)]
 
     def _detect_errors(self, unit, charm_class):
@@ -314,7 +320,8 @@ class ServicesView(ScrollableWidgetWrap):
         Return error info string if present,
         or None if no error is found
         """
-        unit_machine = self.juju_state.machine(unit.machine_id)
+        unit_machine = self.juju_state.machine(unit.machine_id,
+                                               allow_stale=True)
 
         if unit.agent_state == "error":
             return unit.agent_state_info.lstrip()
@@ -0,0 +1,145 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from enum import Enum
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.journal')
+
+
+class JournalScopeUnknown(Exception):
+    pass
+
+
+class JournalStep(Enum):
+    MACHINE_ADDED = 'machine-added'
+    LXC_NETWORK = 'lxc-network'
+    APT_GO_FAST = 'apt-go-fast'
+    HOSTNAME_SET = 'hostname-set'
+    CHARM_DEPLOYED = 'charm-deployed'
+    UNIT_ADDED = 'unit-added'
+    RELATION_ADDED = 'relation-added'
+    POST_PROC_DONE = 'post-proc-done'
+
+
+class DeployJournal:
+
+    """ Append-only record of finished deployment steps
+
+    Each step is one JSON line, flushed and fsynced before record()
+    returns, so a step in the journal really happened even if the
+    installer dies right after. A restarted deployment checks done()
+    and skips what was already finished.
+
+    A torn last line, left by a crash mid-write, is ignored.
+
+    Machine ids, charm names and relations repeat between environments,
+    so a journal belongs to one environment, its scope. A journal
+    written for another scope is set aside when loaded, renamed with a
+    timestamp suffix.
+    """
+
+    def __init__(self, filename, scope=None):
+        """
+        :param filename: journal file, created on first record()
+        :param str scope: identifies the environment, e.g. its juju UUID
+        """
+        self.filename = filename
+        self.scope = scope
+        self._lock = threading.Lock()
+        self._done = {}
+        # set when the file ends in a torn line that must be ended
+        # before appending
+        self._torn = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        scope = None
+        with open(self.filename) as f:
+            for line in f:
+                self._torn = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                    if 'scope' in entry:
+                        scope = entry['scope']
+                        continue
+                    step = JournalStep(entry['step'])
+                except (ValueError, KeyError):
+                    log.warning("Ignoring bad journal entry: {}".format(
+                        line.strip()))
+                    continue
+                self._done[(step, entry['key'])] = entry.get('data')
+        if scope != self.scope:
+            archive = "{}.{}".format(self.filename,
+                                     time.strftime('%Y%m%d%H%M%S'))
+            log.warning("Journal {} is of environment {}, deploying to {}; "
+                        "moved it to {}".format(self.filename, scope,
+                                                self.scope, archive))
+            os.rename(self.filename, archive)
+            self._done = {}
+            self._torn = False
+            return
+        log.info("Loaded {} finished steps from {}".format(
+            len(self._done), self.filename))
+
+    def done(self, step, key):
+        """ Returns True if step was recorded for key """
+        return (step, str(key)) in self._done
+
+    def data(self, step, key):
+        """ Returns the data recorded with step for key, or None """
+        return self._done.get((step, str(key)))
+
+    def keys(self, step):
+        """ Returns every key step was recorded for """
+        return [k for s, k in self._done if s == step]
+
+    def record(self, step, key, data=None):
+        """ Durably records that step finished for key
+
+        :param JournalStep step: what finished
+        :param key: what it finished for, e.g. a machine id
+        :param data: optional JSON-serializable detail
+        """
+        key = str(key)
+        line = json.dumps(dict(step=step.value, key=key, data=data,
+                               time=time.time())) + "\n"
+        with self._lock:
+            if (step, key) in self._done:
+                return
+            new = not os.path.exists(self.filename)
+            with open(self.filename, 'a') as f:
+                if new and self.scope is not None:
+                    f.write(json.dumps(dict(scope=self.scope)) + "\n")
+                if self._torn:
+                    f.write("\n")
+                    self._torn = False
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._done[(step, key)] = data
+        log.debug("journal: {} {}".format(step.value, key))
+
+
+def relation_key(relation):
+    """ Journal key for a relation, the same for (a, b) and (b, a) """
+    return " ".join(sorted(relation))
@@ -18,30 +18,207 @@
 
 from collections import Counter
 import logging
+import threading
 import time
 
+from cloudinstall import utils
 from cloudinstall.machine import Machine
 from cloudinstall.service import Service
 
-from macumba import RequestTimeout
+from macumba import MacumbaError, RequestTimeout
 
 log = logging.getLogger('cloudinstall.juju')
 
 
+class StatusDiff:
+
+    """ Changes between two consecutive status snapshots
+
+    Machine lists include containers. State changes are
+    (id, old_agent_state, new_agent_state) tuples and relations are
+    (service_name, relation_name, related_service_name) tuples.
+    """
+
+    def __init__(self, status):
+        self.status = status
+        self.machines_added = []
+        self.machines_removed = []
+        self.machine_state_changes = []
+        self.units_added = []
+        self.units_removed = []
+        self.unit_state_changes = []
+        self.relations_added = []
+        self.relations_removed = []
+
+    def is_empty(self):
+        return not any([self.machines_added, self.machines_removed,
+                        self.machine_state_changes, self.units_added,
+                        self.units_removed, self.unit_state_changes,
+                        self.relations_added, self.relations_removed])
+
+    def units_in_state(self, state):
+        """ Names of units that reached state in this change """
+        return [name for name, _, new in self.unit_state_changes
+                if new == state]
+
+    @property
+    def units_started(self):
+        return self.units_in_state('started')
+
+    @property
+    def units_errored(self):
+        return self.units_in_state('error')
+
+    def __repr__(self):
+        return ("<StatusDiff machines +{} -{} ~{} units +{} -{} ~{} "
+                "relations +{} -{}>".format(
+                    self.machines_added, self.machines_removed,
+                    self.machine_state_changes, self.units_added,
+                    self.units_removed, self.unit_state_changes,
+                    self.relations_added, self.relations_removed))
+
+
+def _machine_states(status):
+    states = {}
+    pending = list(status.get('Machines', {}).items())
+    while pending:
+        machine_id, machine = pending.pop()
+        states[machine_id] = machine.get('AgentState')
+        pending.extend((machine.get('Containers') or {}).items())
+    return states
+
+
+def _unit_states(status):
+    states = {}
+    for service in status.get('Services', {}).values():
+        for name, unit in (service.get('Units') or {}).items():
+            states[name] = unit.get('AgentState')
+    return states
+
+
+def _relations(status):
+    relations = set()
+    for name, service in status.get('Services', {}).items():
+        for rel_name, related in (service.get('Relations') or {}).items():
+            for other in related:
+                relations.add((name, rel_name, other))
+    return relations
+
+
+def _diff_states(old, new, added, removed, changed):
+    added.extend(sorted(k for k in new if k not in old))
+    removed.extend(sorted(k for k in old if k not in new))
+    changed.extend(sorted((k, old[k], new[k]) for k in new
+                          if k in old and old[k] != new[k]))
+
+
+def status_diff(old, new):
+    """ Computes a :class:`StatusDiff` between two status documents.
+
+    :param old: previous FullStatus, or None for the first snapshot
+    :param new: current FullStatus
+    """
+    old = old or {}
+    diff = StatusDiff(new)
+    _diff_states(_machine_states(old), _machine_states(new),
+                 diff.machines_added, diff.machines_removed,
+                 diff.machine_state_changes)
+    _diff_states(_unit_states(old), _unit_states(new),
+                 diff.units_added, diff.units_removed,
+                 diff.unit_state_changes)
+    old_rels, new_rels = _relations(old), _relations(new)
+    diff.relations_added = sorted(new_rels - old_rels)
+    diff.relations_removed = sorted(old_rels - new_rels)
+    return diff
+
+
 class JujuState:
 
     """ Represents a global Juju state """
 
-    def __init__(self, juju):
+    def __init__(self, juju, cache_ttl=20, max_retries=5, poll_interval=1):
         """ Builds a JujuState
 
         :param juju: Juju API connection
+        :param cache_ttl: seconds a status snapshot is served from cache
+        :param max_retries: FullStatus attempts before giving up
+        :param poll_interval: seconds between FullStatus refreshes while
+                              there are subscribers, or None to never poll
         """
         self.juju = juju
+        self.cache_ttl = cache_ttl
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self._polling = False
         self.start_time = time.time()
         self._juju_status = None
+        self._stale = False
+        self._fetching = False
+        self._status_cond = threading.Condition()
+        self._indexes = (None, None)
+        self._subscribers = []
+        self._published_status = None
+        self._publish_lock = threading.Lock()
         self.valid_states = ['pending', 'started', 'down']
 
+    def subscribe(self, callback):
+        """ Calls callback(diff) with a :class:`StatusDiff` whenever a
+        new status snapshot differs from the previous one.
+
+        Callbacks run on the thread that fetched the snapshot and
+        should return quickly.
+
+        While there are subscribers, status is refreshed in the
+        background every poll_interval seconds so changes are seen
+        even if nothing else asks for status.
+        """
+        with self._publish_lock:
+            self._subscribers.append(callback)
+            if self.poll_interval is None or self._polling:
+                return
+            self._polling = True
+        self._poll()
+
+    def unsubscribe(self, callback):
+        with self._publish_lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _publish(self, juju_status):
+        """ Sends the changes since the last published snapshot to
+        subscribers.
+        """
+        with self._publish_lock:
+            subscribers = list(self._subscribers)
+            old = self._published_status
+            if juju_status is old:
+                return
+            self._published_status = juju_status
+        if len(subscribers) == 0:
+            return
+        diff = status_diff(old, juju_status)
+        if diff.is_empty():
+            return
+        log.debug("status changed: {}".format(diff))
+        for callback in subscribers:
+            try:
+                callback(diff)
+            except Exception:
+                log.exception("Error in status subscriber")
+
+    @utils.async
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._publish_lock:
+                if len(self._subscribers) == 0:
+                    self._polling = False
+                    return
+            try:
+                self.status(refresh=True)
+            except Exception:
+                log.exception("Error polling juju status")
+
     def get_agent_states(self):
         """ Returns list of deployed services and their agent-state """
         states = []
@@ -61,36 +238,93 @@ class JujuState:
         return all([state == "started" for _, state in
                     self.get_agent_states()])
 
-    def status(self):
+    def status(self, allow_stale=False, refresh=False):
         """Returns juju status.
-        Caches value for 20 seconds.
+        Caches value for cache_ttl seconds.
+
+        Concurrent callers share a single in-flight FullStatus request
+        instead of each starting their own.
 
-        Call invalidate_status_cache() to force next status call to
+        :param bool allow_stale: if the cache is expired or invalidated
+            but a previous snapshot exists, return it immediately and
+            refresh in the background.
+        :param bool refresh: ignore the cache and fetch from the server
+            (joining a fetch already in flight).
+
+        Call invalidate_status_cache() to force the next status call to
         fetch from server.
 
         If request times out (macumba default is 60 seconds), retries
-        5 times.
+        max_retries times.
 
         """
-        elapsed_time = time.time() - self.start_time
+        with self._status_cond:
+            if refresh:
+                self._stale = True
+            while True:
+                if self._is_fresh():
+                    return self._juju_status
+                if allow_stale and self._juju_status is not None:
+                    if not self._fetching:
+                        self._fetching = True
+                        self._fetch_status_async()
+                    return self._juju_status
+                if not self._fetching:
+                    self._fetching = True
+                    break
+                self._status_cond.wait()
+
+        return self._fetch_status()
+
+    def _is_fresh(self):
+        return (self._juju_status is not None and not self._stale and
+                time.time() - self.start_time <= self.cache_ttl)
+
+    @utils.async
+    def _fetch_status_async(self):
+        # callers already have the stale snapshot; a failed refresh must
+        # not reach the async exception handler and take down the UI
+        try:
+            self._fetch_status()
+        except Exception:
+            log.exception("Error refreshing juju status")
+            with self._status_cond:
+                self._stale = True
+
+    def _fetch_status(self):
+        """ Fetches FullStatus and wakes up everyone waiting on it.
+
+        Only called by the thread that set self._fetching.
+        """
+        juju_status = None
         n_retries = 0
-        if not self._juju_status or elapsed_time > 20:
-            self._juju_status = None
-            while self._juju_status is None:
+        try:
+            while juju_status is None:
                 try:
-                    self._juju_status = self.juju.status()
+                    juju_status = self.juju.status()
                 except RequestTimeout:
                     n_retries += 1
-                    if n_retries == 5:
+                    if n_retries >= self.max_retries:
                         raise Exception("Connection failure with juju API")
-            self.start_time = time.time()
-        return self._juju_status
+        finally:
+            with self._status_cond:
+                if juju_status is not None:
+                    self._juju_status = juju_status
+                    self._stale = False
+                    self.start_time = time.time()
+                self._fetching = False
+                self._status_cond.notify_all()
+        self._publish(juju_status)
+        return juju_status
 
     def invalidate_status_cache(self):
         """Invalidates cache of status.  Use this to force fetching from
-        server more often than every 20 seconds.
+        server more often than every cache_ttl seconds.
+
+        The previous snapshot is kept for callers using allow_stale.
         """
-        self._juju_status = None
+        with self._status_cond:
+            self._stale = True
 
     def machines_summary(self):
         """ Returns summary of known machines and their status
@@ -115,54 +349,93 @@ class JujuState:
                      if m['Id'] != '0'])
         return d
 
-    def machine(self, machine_id):
+    def _index(self, allow_stale=False):
+        """ Lookup tables for the current status snapshot.
+
+        Built once per snapshot and reused until status() returns a
+        different one, so lookups don't rebuild every Machine and
+        Service object.
+        """
+        status = self.status(allow_stale=allow_stale)
+        indexed_status, indexes = self._indexes
+        if indexed_status is status:
+            return indexes
+
+        machines = {}
+        containers = {}
+        instances = {}
+        for machine_id, machine in status.get('Machines', {}).items():
+            if '0' == machine_id:
+                continue
+            m = Machine(machine_id, machine)
+            machines[machine_id] = m
+            if m.instance_id:
+                instances[m.instance_id] = m
+            for container in m.containers:
+                containers[container.machine_id] = container
+                if container.instance_id:
+                    instances.setdefault(container.instance_id, container)
+
+        services = {}
+        units = {}
+        for name, service in status.get('Services', {}).items():
+            svc = Service(name, service)
+            services[name] = svc
+            for unit in svc.units:
+                units[unit.unit_name] = unit
+
+        indexes = dict(machines=machines,
+                       containers=containers,
+                       instances=instances,
+                       services=services,
+                       units=units)
+        # swap in as one tuple so concurrent readers see a matching pair
+        self._indexes = (status, indexes)
+        return indexes
+
+    def machine(self, machine_id, allow_stale=False):
         """ Return single machine state
 
         :param str machine_id: machine machine_id
+        :param bool allow_stale: see status()
         :returns: machine
         :rtype: :class:`~cloudinstall.machine.Machine`
         """
-        for m in self.machines():
-            if m.machine_id == machine_id:
-                return m
-        return Machine(-1, {})
+        return self._index(allow_stale)['machines'].get(machine_id,
+                                                        Machine(-1, {}))
 
-    def machines(self):
+    def machines(self, allow_stale=False):
         """ Machines property
 
+        :param bool allow_stale: see status()
         :returns: machines known to juju (except bootstrap)
         :rtype: list
         """
-        ret = self.status()
-        machines = []
-
-        for machine_id, machine in ret.get('Machines', {}).items():
-            if '0' == machine_id:
-                continue
-            machines.append(Machine(machine_id, machine))
-        return machines
+        return list(self._index(allow_stale)['machines'].values())
 
-    def machine_or_container(self, machine_id):
+    def machine_or_container(self, machine_id, allow_stale=False):
         """ returns machine or container matching the id
         """
-        for machine in self.machines():
-            if '0' == machine_id:
-                continue
-            if machine.machine_id == machine_id:
-                return machine
-            for container in machine.containers:
-                if container.machine_id == machine_id:
-                    return container
-        return None
-
-    def base_machine(self, machine_id):
+        if '0' == machine_id:
+            return None
+        idx = self._index(allow_stale)
+        return idx['machines'].get(machine_id,
+                                   idx['containers'].get(machine_id))
+
+    def machine_by_instance_id(self, instance_id, allow_stale=False):
+        """ returns machine or container with the given instance id,
+        or None
+        """
+        return self._index(allow_stale)['instances'].get(instance_id)
+
+    def base_machine(self, machine_id, allow_stale=False):
         """ returns machine if given a numeric machine id,
         or machine hosting the container if given a container id
         """
         base_id = machine_id
         if 'lxc' in machine_id or 'kvm' in machine_id:
             base_id = machine_id.split('/')[0]
-        return self.machine(base_id)
+        return self.machine(base_id, allow_stale)
 
     def machines_allocated(self):
         """ Machines allocated property
@@ -175,17 +448,16 @@ class JujuState:
                 (m.agent is not None and
                  m.agent['Status'] in self.valid_states)]
 
-    def service(self, name):
+    def service(self, name, allow_stale=False):
         """ Return a single service entry
 
         :param str name: service/charm name
+        :param bool allow_stale: see status()
         :returns: a service entry or None
         :rtype: :class:`~cloudinstall.service.Service`
         """
-        for s in self.services:
-            if s.service_name == name:
-                return s
-        return Service(name, {})
+        return self._index(allow_stale)['services'].get(name,
+                                                        Service(name, {}))
 
     @property
     def services(self):
@@ -194,16 +466,200 @@ class JujuState:
         :returns: Service() of all loaded services
         :rtype: list
         """
-        ret = self.status()
-        services = []
+        return self.get_services()
+
+    def get_services(self, allow_stale=False):
+        """ Service() of all loaded services
+
+        :param bool allow_stale: see status()
+        :rtype: list
+        """
+        return list(self._index(allow_stale)['services'].values())
 
-        for name, service in ret.get('Services', {}).items():
-            services.append(Service(name, service))
+    def unit(self, name, allow_stale=False):
+        """ Return a single unit by its full name, e.g. 'mysql/0'
 
-        return services
+        :rtype: :class:`~cloudinstall.service.Unit` or None
+        """
+        return self._index(allow_stale)['units'].get(name)
 
     @property
     def networks(self):
         """ Juju netwoks property
         """
         return self.status()['Networks']
+
+
+class JujuWatchState(JujuState):
+
+    """ JujuState kept current from a WatchAll subscription
+
+    Instead of re-fetching FullStatus, this subscribes once and applies
+    the AllWatcher deltas to an in-memory model of machines, services,
+    units and relations. status() returns a FullStatus-shaped snapshot
+    built from that model, so every JujuState accessor works unchanged.
+    """
+
+    def __init__(self, juju):
+        super().__init__(juju, poll_interval=None)
+        self._lock = threading.RLock()
+        self._synced = threading.Event()
+        self._stopped = False
+        self._entities = {'machine': {},
+                          'service': {},
+                          'unit': {},
+                          'relation': {}}
+        self.watcher_id = None
+        self._generation = 0
+
+    def start(self):
+        """ Subscribes to the environment and starts applying deltas """
+        self.watcher_id = self.juju.get_watcher()['AllWatcherId']
+        self._watch()
+
+    def stop(self):
+        self._stopped = True
+
+    @utils.async
+    def _watch(self):
+        while not self._stopped:
+            try:
+                rv = self.juju.get_watched_tasks(self.watcher_id)
+            except MacumbaError:
+                log.exception("Error reading juju watcher, re-trying")
+                time.sleep(1)
+                continue
+            # a watcher re-created after a reconnect starts over with
+            # the whole environment
+            generation = self.juju.watcher_generation(self.watcher_id)
+            reset = generation != self._generation
+            self._generation = generation
+            self.apply_deltas(rv.get('Deltas', []), reset=reset)
+
+    def apply_deltas(self, deltas, reset=False):
+        """ Applies a list of [entity, change, data] AllWatcher deltas
+
+        :param bool reset: deltas describe the whole environment, drop
+                           entities not in them
+        """
+        with self._lock:
+            if reset:
+                for entities in self._entities.values():
+                    entities.clear()
+            for entity, change, data in deltas:
+                if entity not in self._entities:
+                    continue
+                entities = self._entities[entity]
+                key = self._entity_key(entity, data)
+                if change == 'remove':
+                    entities.pop(key, None)
+                else:
+                    entities[key] = data
+            self._juju_status = None
+        self._synced.set()
+        if self._subscribers:
+            self._publish(self.status())
+
+    def _entity_key(self, entity, data):
+        if entity == 'machine':
+            return data['Id']
+        if entity == 'relation':
+            return data['Key']
+        return data['Name']
+
+    def status(self, allow_stale=False, refresh=False):
+        """Returns a FullStatus-shaped snapshot of the watched model.
+
+        Blocks until the first set of deltas has arrived. The model is
+        always current, so allow_stale and refresh have no effect.
+        """
+        self._synced.wait()
+        with self._lock:
+            if self._juju_status is None:
+                self._juju_status = self._build_status()
+            return self._juju_status
+
+    def invalidate_status_cache(self):
+        """No-op, the model is kept current by the watcher."""
+
+    def _build_status(self):
+        machines = {}
+        containers = {}
+        for machine_id, m in self._entities['machine'].items():
+            d = self._machine_status(m)
+            if '/' in machine_id:
+                containers[machine_id] = d
+            else:
+                machines[machine_id] = d
+        # '1/lxc/0' lives under '1', '1/lxc/0/kvm/2' under '1/lxc/0'
+        for container_id in sorted(containers, key=len):
+            parent_id = container_id.rsplit('/', 2)[0]
+            parent = machines.get(parent_id, containers.get(parent_id))
+            if parent is not None:
+                parent['Containers'][container_id] = containers[container_id]
+
+        services = {}
+        for name, svc in self._entities['service'].items():
+            services[name] = dict(Charm=svc.get('CharmURL'),
+                                  Exposed=svc.get('Exposed'),
+                                  Life=svc.get('Life'),
+                                  Networks={},
+                                  Units={},
+                                  Relations={})
+
+        for name, unit in self._entities['unit'].items():
+            svc = services.get(unit.get('Service'))
+            # FullStatus nests subordinates under their principal
+            if svc is None or unit.get('Subordinate'):
+                continue
+            svc['Units'][name] = dict(
+                AgentState=unit.get('Status'),
+                AgentStateInfo=unit.get('StatusInfo'),
+                Machine=unit.get('MachineId'),
+                PublicAddress=unit.get('PublicAddress'))
+
+        for rel in self._entities['relation'].values():
+            endpoints = rel.get('Endpoints', [])
+            names = [ep['ServiceName'] for ep in endpoints]
+            for ep in endpoints:
+                svc = services.get(ep['ServiceName'])
+                if svc is None:
+                    continue
+                others = [n for n in names if n != ep['ServiceName']]
+                if len(others) == 0:
+                    others = [ep['ServiceName']]  # peer relation
+                related = svc['Relations'].setdefault(
+                    ep['Relation']['Name'], [])
+                related.extend(o for o in others if o not in related)
+
+        return {'Machines': machines,
+                'Services': services,
+                'Networks': {}}
+
+    def _machine_status(self, m):
+        hc = m.get('HardwareCharacteristics') or {}
+        hardware = []
+        for key, name, suffix in [('Arch', 'arch', ''),
+                                  ('CpuCores', 'cpu-cores', ''),
+                                  ('Mem', 'mem', 'M'),
+                                  ('RootDisk', 'root-disk', 'M')]:
+            if hc.get(key) is not None:
+                hardware.append("{}={}{}".format(name, hc[key], suffix))
+
+        addresses = m.get('Addresses') or []
+        public = [a['Value'] for a in addresses
+                  if a.get('Scope') == 'public']
+        dns_name = (public or [a['Value'] for a in addresses] or [''])[0]
+
+        return dict(Id=m['Id'],
+                    AgentState=m.get('Status', ''),
+                    AgentStateInfo=m.get('StatusInfo', ''),
+                    InstanceId=m.get('InstanceId', ''),
+                    DNSName=dns_name,
+                    Hardware=" ".join(hardware),
+                    Life=m.get('Life', ''),
+                    Series=m.get('Series', ''),
+                    Jobs=m.get('Jobs', []),
+                    HasVote=m.get('HasVote'),
+                    WantsVote=m.get('WantsVote'),
+                    Containers={})
@@ -17,14 +17,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from cloudinstall.machine import Machine
-from cloudinstall.utils import human_to_mb
+from cloudinstall.utils import async, human_to_mb
 from maasclient.auth import MaasAuth
 from maasclient import MaasClient
-from collections import Counter
+from collections import Counter, defaultdict
 from enum import Enum
 import json
 import logging
 import os
+import threading
 import time
 
 
@@ -118,6 +119,8 @@ class MaasMachineStatus(Enum):
 class MaasMachine(Machine):
     """ Single maas machine """
 
+    __slots__ = ()
+
     @property
     def hostname(self):
         """ Query hostname reported by MaaS
@@ -291,23 +294,131 @@ class MaasMachine(Machine):
 class MaasState:
     """ Represents global MaaS state """
 
-    def __init__(self, maas_client):
+    def __init__(self, maas_client, poll_interval=3):
+        """
+        :param maas_client: :class:`maasclient.MaasClient`
+        :param poll_interval: seconds between node list refreshes while
+                              there are subscribers
+        """
         self.maas_client = maas_client
+        self.poll_interval = poll_interval
         self._maas_client_nodes = None
+        self._indexes = (None, None)
+        # guards the node cache and its indexes against the poll thread
+        self._nodes_lock = threading.RLock()
         self.start_time = time.time()
+        self._subscribers = []
+        self._published_key = None
+        self._publish_lock = threading.Lock()
+        self._polling = False
 
     def nodes(self):
         """ Cache MAAS nodes
         """
-        elapsed_time = time.time() - self.start_time
-        if not self._maas_client_nodes or elapsed_time > 20:
-            self._maas_client_nodes = self.maas_client.nodes
-            self.start_time = time.time()
-        return self._maas_client_nodes
+        with self._nodes_lock:
+            elapsed_time = time.time() - self.start_time
+            nodes = self._maas_client_nodes
+            fetched = not nodes or elapsed_time > 20
+            if fetched:
+                nodes = self.maas_client.nodes
+                self._maas_client_nodes = nodes
+                self.start_time = time.time()
+        if fetched:
+            self._publish(nodes)
+        return nodes
+
+    def subscribe(self, callback):
+        """ Calls callback(nodes) whenever a fetched node list differs
+        from the previous one in node status or tags.
+
+        While there are subscribers, nodes are re-fetched in the
+        background every poll_interval seconds.
+        """
+        with self._publish_lock:
+            self._subscribers.append(callback)
+            if self._polling:
+                return
+            self._polling = True
+        self._poll()
+
+    def unsubscribe(self, callback):
+        with self._publish_lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _publish(self, nodes):
+        key = frozenset((n.get('system_id'), n.get('status'),
+                         tuple(n.get('tag_names', [])))
+                        for n in nodes)
+        with self._publish_lock:
+            subscribers = list(self._subscribers)
+            if key == self._published_key:
+                return
+            self._published_key = key
+        for callback in subscribers:
+            try:
+                callback(nodes)
+            except Exception:
+                log.exception("Error in maas subscriber")
+
+    @async
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._publish_lock:
+                if len(self._subscribers) == 0:
+                    self._polling = False
+                    return
+            self.invalidate_nodes_cache()
+            try:
+                self.nodes()
+            except Exception:
+                log.exception("Error polling maas nodes")
 
     def invalidate_nodes_cache(self):
         """Force reload on next access"""
-        self._maas_client_nodes = None
+        with self._nodes_lock:
+            self._maas_client_nodes = None
+
+    def _index(self):
+        """ Lookup tables for the current node list.
+
+        Rebuilt only when nodes() returns a different list.
+        """
+        nodes = self.nodes()
+        with self._nodes_lock:
+            indexed_nodes, indexes = self._indexes
+            if indexed_nodes is nodes:
+                return indexes
+
+            machines = []
+            by_instance_id = {}
+            by_system_id = {}
+            by_status = defaultdict(list)
+            by_tag = defaultdict(list)
+            for n in nodes:
+                if n['hostname'] == 'juju-bootstrap.maas':
+                    continue
+                m = MaasMachine(-1, n)
+                machines.append(m)
+                by_instance_id[m.instance_id] = m
+                by_system_id[m.system_id] = m
+                try:
+                    by_status[m.status].append(m)
+                except ValueError:
+                    log.warning("unknown status for node {}: {}".format(
+                        m.system_id, n.get('status')))
+                for tag in n.get('tag_names', []):
+                    by_tag[tag].append(m)
+
+            indexes = dict(machines=machines,
+                           instance_id=by_instance_id,
+                           system_id=by_system_id,
+                           status=by_status,
+                           tag=by_tag)
+            # swap in as one tuple so concurrent readers see a matching pair
+            self._indexes = (nodes, indexes)
+            return indexes
 
     def machine(self, instance_id):
         """ Return single machine state
@@ -316,10 +427,15 @@ class MaasState:
         :returns: machine
         :rtype: cloudinstall.maas.MaasMachine
         """
-        for m in self.machines():
-            if m.instance_id == instance_id:
-                return m
-        return None
+        return self._index()['instance_id'].get(instance_id)
+
+    def machine_by_system_id(self, system_id):
+        """ Return single machine state, or None
+
+        :param str system_id: machine system_id
+        :rtype: cloudinstall.maas.MaasMachine
+        """
+        return self._index()['system_id'].get(system_id)
 
     def machines(self, state=None, tag=None):
         """Maas Machines
@@ -332,17 +448,16 @@ class MaasState:
         :rtype: list of MaasMachine
 
         """
-        nodes = [n for n in self.nodes()
-                 if n['hostname'] != 'juju-bootstrap.maas']
-
-        if tag:
-            nodes = [n for n in nodes if tag in n['tag_names']]
-
-        all_machines = [MaasMachine(-1, m) for m in nodes]
+        idx = self._index()
+        if state and tag:
+            tagged = set(id(m) for m in idx['tag'].get(tag, []))
+            return [m for m in idx['status'].get(state, [])
+                    if id(m) in tagged]
         if state:
-            return [m for m in all_machines if m.status == state]
-        else:
-            return all_machines
+            return list(idx['status'].get(state, []))
+        if tag:
+            return list(idx['tag'].get(tag, []))
+        return list(idx['machines'])
 
     def machines_summary(self):
         """ Returns summary of known machines and their states.
@@ -384,5 +499,11 @@ class FakeMaasState:
     def invalidate_nodes_cache(self):
         "no op"
 
+    def subscribe(self, callback):
+        "no op, the fake machines never change"
+
+    def unsubscribe(self, callback):
+        "no op"
+
     def machines_summary(self):
         return "no summary for fake state"
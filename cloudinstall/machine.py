@@ -21,25 +21,94 @@ import logging
 
 log = logging.getLogger('cloudinstall.machine')
 
+# juju hardware size suffixes, in megabytes
+_SIZE_UNITS = {'M': 1, 'G': 1024, 'T': 1024 * 1024, 'P': 1024 ** 3}
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_megabytes(value):
+    """ Converts a juju size such as '2048M' or '8G' to megabytes """
+    if not value:
+        return None
+    multiplier = _SIZE_UNITS.get(value[-1].upper())
+    if multiplier is not None:
+        value = value[:-1]
+    try:
+        return int(float(value) * (multiplier or 1))
+    except ValueError:
+        return None
+
 
 class Machine:
 
-    """ Base machine class """
+    """ Base machine class
+
+    Built once per status snapshot: the hardware string is parsed in the
+    constructor into typed fields and containers are wrapped on first
+    access, so repeated lookups don't re-parse or re-allocate.
+    Everything except machine_id is read-only.
+    """
+
+    __slots__ = ('machine_id', 'machine', '_arch', '_cpu_cores', '_mem',
+                 '_root_disk', '_containers')
 
     def __init__(self, machine_id, machine):
         self.machine_id = machine_id
         self.machine = machine
-        self._cpu_cores = self.hardware('cpu-cores')
-        self._storage = self.hardware('root-disk')
-        self._mem = self.hardware('memory')
-        self.agent = self.machine.get('Agent', None)
-        self.agent_state = self.machine.get('AgentState', None)
-        self.agent_state_info = self.machine.get('AgentStateInfo', None)
-        self.agent_version = self.machine.get('AgentVersion', None)
-        self.dns_name = self.machine.get('DNSName', '')
-        self.err = self.machine.get('Err', None)
-        self.has_vote = self.machine.get('HasVote')
-        self.wants_vote = self.machine.get('WantsVote')
+        hardware = self._parse_hardware(machine.get('Hardware', None))
+        self._arch = hardware.get('arch')
+        self._cpu_cores = _to_int(hardware.get('cpu-cores'))
+        self._mem = _to_megabytes(hardware.get('mem'))
+        self._root_disk = _to_megabytes(hardware.get('root-disk'))
+        self._containers = None
+
+    @staticmethod
+    def _parse_hardware(hardware):
+        """ Parses 'arch=amd64 cpu-cores=1 mem=1024M' into a dict of
+        raw values
+        """
+        if not hardware:
+            return {}
+        return dict(item.split('=', 1)
+                    for item in hardware.split(' ') if '=' in item)
+
+    @property
+    def agent(self):
+        return self.machine.get('Agent', None)
+
+    @property
+    def agent_state(self):
+        return self.machine.get('AgentState', None)
+
+    @property
+    def agent_state_info(self):
+        return self.machine.get('AgentStateInfo', None)
+
+    @property
+    def agent_version(self):
+        return self.machine.get('AgentVersion', None)
+
+    @property
+    def dns_name(self):
+        return self.machine.get('DNSName', '')
+
+    @property
+    def err(self):
+        return self.machine.get('Err', None)
+
+    @property
+    def has_vote(self):
+        return self.machine.get('HasVote')
+
+    @property
+    def wants_vote(self):
+        return self.machine.get('WantsVote')
 
     @property
     def instance_id(self):
@@ -54,80 +123,61 @@ class Machine:
     def cpu_cores(self):
         """ Return number of cpu-cores
 
-        :returns: number of cpus
-        :rtype: str
+        :returns: number of cpus, None if unknown
+        :rtype: int
         """
         return self._cpu_cores
 
-    @cpu_cores.setter
-    def cpu_cores(self, val):
-        self._cpu_cores = val
-
     @property
     def arch(self):
         """ Return architecture
 
-        :returns: architecture type
+        :returns: architecture type, None if unknown
         :rtype: str
         """
-        return self.hardware('arch')
+        return self._arch
 
     @property
-    def storage(self):
-        """ Return storage
+    def mem(self):
+        """ Return memory
 
-        :returns: storage size
-        :rtype: str
+        :returns: memory size in megabytes, None if unknown
+        :rtype: int
         """
-        try:
-            self._storage = int(self._storage[:-1]) / 1024
-            return "{size}G".format(size=str(self._storage))
-        except:
-            return "N/A"
-
-    @storage.setter
-    def storage(self, val):
-        self._storage = val
+        return self._mem
 
     @property
-    def mem(self):
-        """ Return memory
+    def root_disk(self):
+        """ Return root disk size
 
-        :returns: memory size
-        :rtype: str
+        :returns: root disk size in megabytes, None if unknown
+        :rtype: int
         """
-        return "{size}".format(size=str(self._mem))
+        return self._root_disk
 
-    @mem.setter
-    def mem(self, val):
-        self._mem = val
-
-    def hardware(self, spec):
-        """ Get hardware information
+    @property
+    def storage(self):
+        """ Return storage
 
-        :param spec: a hardware specification
-        :type spec: str
-        :returns: hardware of spec
+        :returns: root disk size for display
         :rtype: str
         """
-        _machine = self.machine.get('Hardware', None)
-        if _machine:
-            _hardware_list = _machine.split(' ')
-            for item in _hardware_list:
-                k, v = item.split('=')
-                if k in spec:
-                    return v
-        return "N/A"
+        if self._root_disk is None:
+            return "N/A"
+        return "{size}G".format(size=str(self._root_disk / 1024))
 
     @property
     def containers(self):
         """ Return containers for machine
 
-        :rtype: generator
+        :rtype: tuple
         """
-        _containers = self.machine.get('Containers', {}).items()
-        for container_id, container in _containers:
-            yield Machine(container_id, container)
+        if self._containers is None:
+            _containers = self.machine.get('Containers', None) or {}
+            self._containers = tuple(Machine(container_id, container)
+                                     for container_id, container
+                                     in _containers.items())
+        return self._containers
 
     def container(self, container_id):
         """ Inspect a container
@@ -0,0 +1,179 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Running commands and copying files on many juju machines at once
+
+run() sends one command to every machine in a single `juju run` call.
+run_each() and copy() work per machine and spread the `juju` processes
+over a bounded worker pool. All three return {machine_id: RemoteResult}.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import shlex
+
+from cloudinstall import utils
+
+log = logging.getLogger('cloudinstall.remote')
+
+
+class RemoteResult:
+
+    """ Outcome of a command on one machine """
+
+    def __init__(self, machine_id, code=0, stdout="", stderr="", error=""):
+        """
+        :param machine_id: juju machine id
+        :param code: exit status of the command
+        :param stdout: command output
+        :param stderr: command error output
+        :param error: set when juju could not run the command at all
+        """
+        self.machine_id = machine_id
+        self.code = code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.code == 0 and not self.error
+
+    def __repr__(self):
+        if self.error:
+            return "<RemoteResult {}: {}>".format(self.machine_id,
+                                                  self.error)
+        return "<RemoteResult {}: {}>".format(self.machine_id, self.code)
+
+
+def _join(cmds):
+    if type(cmds) is list:
+        return " && ".join(cmds)
+    return cmds
+
+
+def _failed(machine_ids, ret):
+    """ Results for machines when the juju process itself failed """
+    error = ret.get('err', '').strip() or "juju exited with {}".format(
+        ret.get('status', ret.get('ret')))
+    return {m: RemoteResult(m, code=None, error=error) for m in machine_ids}
+
+
+def parse_run_output(machine_ids, ret):
+    """ Builds results from `juju run --format json` output
+
+    :param list machine_ids: machines the command was sent to
+    :param dict ret: get_command_output() result
+    :returns: {machine_id: RemoteResult}, one per machine_ids entry
+    """
+    try:
+        entries = json.loads(ret.get('output', ''))
+    except ValueError:
+        return _failed(machine_ids, ret)
+
+    results = {}
+    for e in entries:
+        m = str(e.get('MachineId'))
+        results[m] = RemoteResult(m,
+                                  code=e.get('ReturnCode', 0),
+                                  stdout=e.get('Stdout', ''),
+                                  stderr=e.get('Stderr', ''),
+                                  error=e.get('Error', ''))
+    for m in machine_ids:
+        if m not in results:
+            results[m] = RemoteResult(m, code=None,
+                                      error="no result from juju run")
+    return results
+
+
+def _log_results(action, results):
+    for r in results.values():
+        if r.ok:
+            log.debug("{} on machine {} ok".format(action, r.machine_id))
+        else:
+            log.error("{} on machine {} failed: {} {}".format(
+                action, r.machine_id, r.error or r.code, r.stderr))
+
+
+def run(machine_ids, cmds, juju_home, timeout=None):
+    """ Runs cmds on every machine with one `juju run` call
+
+    :param list machine_ids: juju machine ids
+    :param cmds: command string, or list of commands joined with &&
+    :param str juju_home: JUJU_HOME=... prefix, see Config.juju_home()
+    :param timeout: seconds before the juju process is killed
+    :returns: {machine_id: RemoteResult}
+    """
+    machine_ids = [str(m) for m in machine_ids]
+    if len(machine_ids) == 0:
+        return {}
+    cmds = _join(cmds)
+    log.debug("Remote running ({}) on machines {}".format(
+        cmds, ",".join(machine_ids)))
+    ret = utils.get_command_output(
+        "{} juju run --format json --machine {} {}".format(
+            juju_home, ",".join(machine_ids), shlex.quote(cmds)),
+        timeout=timeout)
+    results = parse_run_output(machine_ids, ret)
+    _log_results("Remote run", results)
+    return results
+
+
+def run_each(commands, juju_home, workers=8, timeout=None):
+    """ Runs a different command on each machine, in parallel
+
+    :param dict commands: {machine_id: cmds}
+    :param int workers: most `juju run` processes at once
+    :returns: {machine_id: RemoteResult}
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run, [m], cmds, juju_home, timeout)
+                   for m, cmds in commands.items()]
+        for f in futures:
+            results.update(f.result())
+    return results
+
+
+def _copy_one(machine_id, src, dst, juju_home, timeout):
+    ret = utils.get_command_output(
+        "{} juju scp {} {}:{}".format(juju_home, shlex.quote(src),
+                                      machine_id, shlex.quote(dst)),
+        timeout=timeout)
+    if ret.get('status') != 0:
+        return _failed([machine_id], ret)[machine_id]
+    return RemoteResult(machine_id, stdout=ret['output'],
+                        stderr=ret['err'])
+
+
+def copy(machine_ids, src, dst, juju_home, workers=8, timeout=None):
+    """ Copies src to dst on every machine, in parallel
+
+    :param list machine_ids: juju machine ids
+    :param int workers: most `juju scp` processes at once
+    :returns: {machine_id: RemoteResult}
+    """
+    machine_ids = [str(m) for m in machine_ids]
+    log.debug("Remote copying {} to {} on machines {}".format(
+        src, dst, ",".join(machine_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {m: pool.submit(_copy_one, m, src, dst, juju_home,
+                                  timeout)
+                   for m in machine_ids}
+        results = {m: f.result() for m, f in futures.items()}
+    _log_results("Remote copy", results)
+    return results
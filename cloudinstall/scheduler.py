@@ -0,0 +1,315 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from enum import Enum
+import logging
+import time
+
+log = logging.getLogger('cloudinstall.scheduler')
+
+
+class TaskState(Enum):
+    PENDING = 0
+    RUNNING = 1
+    DEFERRED = 2
+    DONE = 3
+    FAILED = 4
+
+
+def _related_names(charm_class):
+    """ Service names charm_class declares relations with """
+    names = set()
+    for relation in charm_class.related:
+        for endpoint in relation:
+            names.add(endpoint.split(':')[0])
+    names.discard(charm_class.charm_name)
+    return names
+
+
+def _order(charm):
+    return (charm.deploy_priority, charm.charm_name)
+
+
+def deploy_graph(charm_classes):
+    """Returns {charm_class: set of charm classes deployed before it}.
+
+    Two charms are linked when either one lists the other in
+    `depends` or `related`. Linked charms deploy in deploy_priority
+    order (then by name), so the graph has no cycles even where
+    `depends` is mutual, as with swift-proxy and swift-storage.
+    Unlinked charms have no ordering and deploy side by side.
+    """
+    by_name = {cc.charm_name: cc for cc in charm_classes}
+    graph = {cc: set() for cc in charm_classes}
+
+    for cc in charm_classes:
+        for name in set(cc.depends) | _related_names(cc):
+            other = by_name.get(name)
+            if other is None or other is cc:
+                continue
+            first, second = sorted([cc, other], key=_order)
+            graph[second].add(first)
+    return graph
+
+
+def post_proc_graph(charms):
+    """Returns {charm: set of charms whose post_proc runs before it}.
+
+    Built from each charm's `post_proc_depends`. Dependencies that
+    aren't deployed are ignored.
+    """
+    by_name = {c.charm_name: c for c in charms}
+    return {c: set(by_name[name] for name in c.post_proc_depends
+                   if name in by_name and by_name[name] is not c)
+            for c in charms}
+
+
+class TaskScheduler:
+
+    """ Runs tasks concurrently in dependency order
+
+    graph maps each task to the set of tasks that must be done before
+    it. func(task) is called on a worker thread as soon as those are
+    done. It returns True when the task was deferred (e.g. a charm's
+    machine isn't in juju yet); deferred tasks are retried after a
+    backoff that doubles on each attempt, up to max_backoff seconds.
+    Tasks that depend on a deferred task wait for it.
+
+    An exception is retried the same way, but once a task has raised
+    max_failures times it fails: no further tasks are started and run()
+    raises its error.
+    """
+
+    def __init__(self, graph, func, workers=8, backoff=1, max_backoff=30,
+                 max_failures=5, key=None, on_change=None):
+        """
+        :param graph: {task: set of tasks to finish first}, acyclic
+        :param func: runs one task, returns True if deferred
+        :param workers: most tasks in flight at once
+        :param backoff: seconds before the first retry of a deferred task
+        :param max_backoff: longest wait between retries
+        :param max_failures: exceptions a task may raise before it fails
+        :param key: sort key, orders tasks ready at the same time
+        :param on_change: called with the scheduler whenever a task
+                          changes state, on the thread running run()
+        """
+        self.graph = graph
+        self.func = func
+        self.workers = workers
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.key = key
+        self.on_change = on_change
+        self.states = {t: TaskState.PENDING for t in self.graph}
+        self.attempts = {t: 0 for t in self.graph}
+        self.failures = {t: 0 for t in self.graph}
+        self.errors = {}
+        self.retry_at = {}
+
+    def tasks_in_state(self, state):
+        return [t for t, s in self.states.items() if s == state]
+
+    def pending(self):
+        """ Tasks not yet done """
+        return [t for t, s in self.states.items() if s != TaskState.DONE]
+
+    def is_done(self):
+        return len(self.pending()) == 0
+
+    def ready(self, now=None):
+        """ Tasks that can be started now """
+        if now is None:
+            now = time.time()
+        rv = []
+        for t, state in self.states.items():
+            if state == TaskState.DEFERRED and self.retry_at[t] > now:
+                continue
+            if state not in (TaskState.PENDING, TaskState.DEFERRED):
+                continue
+            if all(self.states[p] == TaskState.DONE for p in self.graph[t]):
+                rv.append(t)
+        if self.key is not None:
+            rv.sort(key=self.key)
+        return rv
+
+    def _set_state(self, task, state):
+        self.states[task] = state
+        if self.on_change:
+            self.on_change(self)
+
+    def _finished(self, task, future):
+        self.attempts[task] += 1
+        try:
+            deferred = future.result()
+        except Exception as e:
+            self.failures[task] += 1
+            log.exception("Error running {} ({} of {})".format(
+                task, self.failures[task], self.max_failures))
+            if self.failures[task] >= self.max_failures:
+                self.errors[task] = e
+                self._set_state(task, TaskState.FAILED)
+                return
+            deferred = True
+        if deferred:
+            delay = min(self.backoff * 2 ** (self.attempts[task] - 1),
+                        self.max_backoff)
+            self.retry_at[task] = time.time() + delay
+            log.debug("{} deferred, re-trying in {}s".format(task, delay))
+            self._set_state(task, TaskState.DEFERRED)
+        else:
+            self._set_state(task, TaskState.DONE)
+
+    def _next_wakeup(self):
+        """ Seconds until the earliest deferred task can be retried """
+        times = [self.retry_at[t] for t in
+                 self.tasks_in_state(TaskState.DEFERRED)]
+        if not times:
+            return None
+        return max(0, min(times) - time.time())
+
+    def run(self):
+        """ Runs every task, blocks until all are done
+
+        Raises the error of a task that failed, once the tasks already
+        running have finished.
+        """
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self.is_done() and not self.errors:
+                for t in self.ready():
+                    self._set_state(t, TaskState.RUNNING)
+                    running[pool.submit(self.func, t)] = t
+                if running:
+                    done, _ = wait(list(running), timeout=self._next_wakeup(),
+                                   return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._finished(running.pop(future), future)
+                else:
+                    time.sleep(self._next_wakeup() or 0)
+        for future, task in running.items():
+            self._finished(task, future)
+        failed = self.tasks_in_state(TaskState.FAILED)
+        if failed:
+            raise self.errors[failed[0]]
+
+
+class DeployScheduler(TaskScheduler):
+
+    """ Deploys charm classes concurrently, ordered by deploy_graph() """
+
+    def __init__(self, charm_classes, deploy_func, **kwargs):
+        kwargs.setdefault('key', _order)
+        super().__init__(deploy_graph(list(charm_classes)), deploy_func,
+                         **kwargs)
+
+
+class RelationState(Enum):
+    PENDING = 0
+    FAILED = 1
+    ADDED = 2
+
+
+def unique_relations(relations):
+    """ relations without repeats, (a, b) and (b, a) count as the same
+
+    Keeps the first occurrence of each, in order.
+    """
+    seen = set()
+    rv = []
+    for a, b in relations:
+        key = tuple(sorted((a, b)))
+        if key in seen:
+            continue
+        seen.add(key)
+        rv.append((a, b))
+    return rv
+
+
+class RelationEngine:
+
+    """ Adds a set of relations, retrying only the ones that failed
+
+    Each round sends every outstanding relation in one pipelined batch
+    (see JujuClient.add_relations). Relations that fail are sent again
+    in the next round, after a backoff that doubles each round up to
+    max_backoff seconds. Once a relation has failed `attempts` times,
+    run() raises its error.
+    """
+
+    def __init__(self, juju, relations, attempts=5, backoff=1,
+                 max_backoff=30, on_progress=None):
+        """
+        :param juju: :class:`macumba.JujuClient`
+        :param relations: list of (endpoint_a, endpoint_b)
+        :param attempts: rounds before giving up on a relation
+        :param backoff: seconds before the first retry
+        :param max_backoff: longest wait between rounds
+        :param on_progress: called with (engine, relation) each time a
+                            relation is added or fails
+        """
+        self.juju = juju
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_progress = on_progress
+        self.states = OrderedDict((r, RelationState.PENDING)
+                                  for r in unique_relations(relations))
+        self.errors = {}
+
+    def relations_in_state(self, state):
+        return [r for r, s in self.states.items() if s == state]
+
+    def outstanding(self):
+        """ Relations not yet added """
+        return [r for r, s in self.states.items()
+                if s != RelationState.ADDED]
+
+    def _round(self, relations):
+        try:
+            results = self.juju.add_relations(relations)
+        except Exception as e:
+            log.exception("Error adding relations")
+            results = [e] * len(relations)
+        for relation, rv in zip(relations, results):
+            if isinstance(rv, Exception):
+                self.states[relation] = RelationState.FAILED
+                self.errors[relation] = rv
+            else:
+                self.states[relation] = RelationState.ADDED
+                self.errors.pop(relation, None)
+            if self.on_progress:
+                self.on_progress(self, relation)
+
+    def run(self):
+        """ Adds every relation, blocks until done or out of attempts """
+        for attempt in range(self.attempts):
+            outstanding = self.outstanding()
+            if len(outstanding) == 0:
+                return
+            if attempt > 0:
+                delay = min(self.backoff * 2 ** (attempt - 1),
+                            self.max_backoff)
+                log.debug("{} relations failed, re-trying in {}s".format(
+                    len(outstanding), delay))
+                time.sleep(delay)
+            self._round(outstanding)
+
+        failed = self.outstanding()
+        if failed:
+            raise self.errors[failed[0]]
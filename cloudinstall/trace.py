@@ -0,0 +1,158 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Deployment tracing
+
+Wrap work in a span to record when it ran and on which thread:
+
+    with trace.span("deploy mysql", cat='deploy'):
+        ...
+
+or decorate a function with @trace.traced. Spans on the same thread
+nest by time. Nothing is recorded until enable() is called, and until
+then span() returns a shared no-op, so tracing costs next to nothing
+when off.
+
+export() writes the Chrome trace-event format, which chrome://tracing
+and https://ui.perfetto.dev can open.
+"""
+
+from functools import wraps
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.trace')
+
+_enabled = False
+_events = []
+_lock = threading.Lock()
+
+
+class _NoSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+
+    """ One timed, named piece of work """
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+        if exc_type is not None:
+            self.args['error'] = repr(exc_value)
+        thread = threading.current_thread()
+        event = dict(name=self.name, cat=self.cat, ph='X',
+                     ts=int(self.start * 1e6),
+                     dur=int((end - self.start) * 1e6),
+                     pid=os.getpid(), tid=thread.ident,
+                     args=self.args)
+        with _lock:
+            _events.append((event, thread.name))
+        return False
+
+
+def enable():
+    """ Starts recording spans """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear():
+    """ Drops every recorded span """
+    with _lock:
+        del _events[:]
+
+
+def span(name, cat='deploy', **args):
+    """ Returns a context manager timing the enclosed block
+
+    :param str name: shown on the span
+    :param str cat: category, e.g. 'juju', 'subprocess', 'post_proc'
+    :param args: extra details attached to the span
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return Span(name, cat, args)
+
+
+def traced(func=None, cat='deploy'):
+    """ Decorator recording each call of func as a span
+
+    Use bare, @traced, or with a category, @traced(cat='charm').
+    """
+    if func is None:
+        return lambda f: traced(f, cat)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with Span(func.__qualname__, cat, {}):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def events():
+    """ Returns the recorded Chrome trace events, with thread names """
+    with _lock:
+        recorded = list(_events)
+    rv = []
+    threads = {}
+    for event, thread_name in recorded:
+        threads[(event['pid'], event['tid'])] = thread_name
+        rv.append(event)
+    for (pid, tid), thread_name in threads.items():
+        rv.append(dict(name='thread_name', ph='M', pid=pid, tid=tid,
+                       args=dict(name=thread_name)))
+    return rv
+
+
+def export(filename):
+    """ Writes recorded spans to filename as Chrome trace JSON """
+    evs = events()
+    with open(filename, 'w') as f:
+        json.dump(dict(traceEvents=evs, displayTimeUnit='ms'), f)
+    log.info("Wrote {} trace events to {}".format(len(evs), filename))
@@ -32,7 +32,7 @@ import traceback
 import urwid
 import itertools
 import configparser
-from threading import Thread
+from threading import Event, Thread
 from functools import wraps
 import time
 from importlib import import_module
@@ -44,6 +44,8 @@ import json
 import yaml
 import requests
 
+from cloudinstall import trace
+
 log = logging.getLogger('cloudinstall.utils')
 
 # String with number of minutes, or None.
@@ -363,16 +365,17 @@ def get_command_output(command, timeout=None, user_sudo=False):
     if user_sudo:
         command = "sudo -E -H -u {0} {1}".format(install_user(), command)
 
-    try:
-        p = Popen(command, shell=True,
-                  stdout=PIPE, stderr=PIPE,
-                  bufsize=-1, env=cmd_env, close_fds=True)
-    except OSError as e:
-        if e.errno == errno.ENOENT:
-            return dict(ret=127, output="", err="")
-        else:
-            raise e
-    stdout, stderr = p.communicate()
+    with trace.span(command[:80], cat='subprocess', command=command):
+        try:
+            p = Popen(command, shell=True,
+                      stdout=PIPE, stderr=PIPE,
+                      bufsize=-1, env=cmd_env, close_fds=True)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return dict(ret=127, output="", err="")
+            else:
+                raise e
+        stdout, stderr = p.communicate()
     if p.returncode == 126 or p.returncode == 127:
         stdout = bytes()
     if not stderr:
@@ -414,6 +417,49 @@ def poll_until_true(cmd, predicate, frequency, timeout=600,
             return False
 
 
+def wait_until(predicate, source, timeout=None):
+    """Blocks until predicate() returns True.
+
+    predicate is checked once up front and then again only when source
+    reports a change, e.g. a :class:`cloudinstall.juju.JujuState` or
+    :class:`cloudinstall.maas.MaasState`. Anything with
+    subscribe(callback) and unsubscribe(callback) works, and source may
+    also be a list of them.
+
+    returns True once predicate() does, or False if timeout seconds
+    pass first. Waits forever if timeout is None.
+    """
+    if isinstance(source, (list, tuple)):
+        sources = source
+    else:
+        sources = [source]
+
+    changed = Event()
+
+    def on_change(*args):
+        changed.set()
+
+    name = "wait_until " + getattr(predicate, '__name__', 'predicate')
+    with trace.span(name, cat='wait'):
+        for s in sources:
+            s.subscribe(on_change)
+        try:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                changed.clear()
+                if predicate():
+                    return True
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                changed.wait(remaining)
+        finally:
+            for s in sources:
+                s.unsubscribe(on_change)
+
+
 def remote_cp(machine_id, src, dst, juju_home):
     log.debug("Remote copying {src} to {dst} on machine {m}".format(
         src=src,
@@ -17,9 +17,39 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import bson
+from concurrent.futures import ThreadPoolExecutor
 from requests_oauthlib import OAuth1
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
 import json
+import logging
+import socket
+import time
+
+log = logging.getLogger('maasclient')
+
+# Connection failures that happen before a request is written. urllib3
+# 1.13+ wraps them in NewConnectionError (a ConnectTimeoutError); the
+# urllib3 bundled with requests 2.2.1 hands back the raw socket error.
+_NOT_SENT_REASONS = (urllib3_exceptions.ConnectTimeoutError,
+                     ConnectionRefusedError,
+                     socket.gaierror)
+
+# requests 2.4+ only
+_ConnectTimeout = getattr(requests.exceptions, 'ConnectTimeout', None)
+
+
+def _not_sent(error):
+    """ True if a failed request never reached the server
+
+    That is a connect timeout or a refused/unresolvable connection,
+    as opposed to one dropped after the request went out.
+    """
+    if _ConnectTimeout is not None and isinstance(error, _ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, _NOT_SENT_REASONS)
 
 
 class MaasClient:
@@ -27,26 +57,79 @@ class MaasClient:
     """ Client Class
     """
 
-    def __init__(self, auth):
+    def __init__(self, auth, timeout=30, pool_maxsize=10, max_retries=3,
+                 retry_backoff=0.5, workers=None):
         """ Entry point to client routines for interfacing
         with MAAS api.
 
+        All requests share one keep-alive connection pool.
+
         :param auth: MAAS Authorization class (required)
+        :param timeout: seconds to wait for a response
+        :param pool_maxsize: connections kept open to the MAAS server
+        :param max_retries: attempts after a failed connection
+        :param retry_backoff: seconds before the first retry, doubled
+                              after each attempt
+        :param workers: threads used by bulk operations, defaults to
+                        pool_maxsize
         """
         self.auth = auth
+        self.workers = workers if workers else pool_maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._auth = None
 
     def _oauth(self):
         """ Generates OAuth attributes for protected resources
 
+        The OAuth1 object signs each request as it is sent, so one
+        instance is reused for the life of the client.
+
         :returns: OAuth class
         """
-        oauth = OAuth1(self.auth.consumer_key,
-                       client_secret=self.auth.consumer_secret,
-                       resource_owner_key=self.auth.token_key,
-                       resource_owner_secret=self.auth.token_secret,
-                       signature_method='PLAINTEXT',
-                       signature_type='query')
-        return oauth
+        if self._auth is None:
+            self._auth = OAuth1(self.auth.consumer_key,
+                                client_secret=self.auth.consumer_secret,
+                                resource_owner_key=self.auth.token_key,
+                                resource_owner_secret=self.auth.token_secret,
+                                signature_method='PLAINTEXT',
+                                signature_type='query')
+        return self._auth
+
+    def _request(self, method, url, **kwargs):
+        """ Sends a request through the pooled session.
+
+        Retries with exponential backoff when the connection fails. GET
+        and DELETE are also retried on timeouts and dropped connections;
+        POST only when the request never reached the server, since
+        otherwise the server may already have acted on it.
+        """
+        retry_on = (requests.exceptions.ConnectionError,)
+        if method != 'POST':
+            retry_on += (requests.exceptions.Timeout,)
+        attempt = 0
+        while True:
+            try:
+                return self.session.request(method,
+                                            self.auth.api_url + url,
+                                            auth=self._oauth(),
+                                            timeout=self.timeout,
+                                            **kwargs)
+            except retry_on as e:
+                if attempt >= self.max_retries:
+                    raise
+                if method == 'POST' and not _not_sent(e):
+                    raise
+                delay = self.retry_backoff * (2 ** attempt)
+                log.debug("{} {} failed ({}), retrying in {}s".format(
+                    method, url, e, delay))
+                time.sleep(delay)
+                attempt += 1
 
     def get(self, url, params=None):
         """ Performs a authenticated GET against a MAAS endpoint
@@ -54,9 +137,7 @@ class MaasClient:
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
         """
-        return requests.get(url=self.auth.api_url + url,
-                            auth=self._oauth(),
-                            params=params)
+        return self._request('GET', url, params=params)
 
     def post(self, url, params=None):
         """ Performs a authenticated POST against a MAAS endpoint
@@ -64,9 +145,7 @@ class MaasClient:
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
         """
-        return requests.post(url=self.auth.api_url + url,
-                             auth=self._oauth(),
-                             data=params)
+        return self._request('POST', url, data=params)
 
     def delete(self, url, params=None):
         """ Performs a authenticated DELETE against a MAAS endpoint
@@ -74,8 +153,23 @@ class MaasClient:
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
         """
-        return requests.delete(url=self.auth.api_url + url,
-                               auth=self._oauth())
+        return self._request('DELETE', url)
+
+    def close(self):
+        """ Closes pooled connections """
+        self.session.close()
+
+    def _map(self, func, items):
+        """ Runs func over items on a bounded worker pool sharing the
+        session's connections.
+
+        :returns: list of results in the order of items
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return [func(i) for i in items]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(func, items))
 
     ###########################################################################
     # Boot Images API
@@ -303,6 +397,23 @@ class MaasClient:
             return res.ok
         return False
 
+    def tag_new_many(self, tags):
+        """ Create every tag in tags that doesn't exist yet.
+
+        Fetches the tag list once instead of once per tag.
+
+        :param tags: Tag names
+        :returns: list of tags that were created
+        """
+        existing = {tagmd['name'] for tagmd in self.tags}
+        missing = sorted(set(tags) - existing)
+
+        def _new(tag):
+            return self.post('/tags/', dict(op='new', name=tag)).ok
+
+        return [tag for tag, ok in zip(missing, self._map(_new, missing))
+                if ok]
+
     def tag_delete(self, tag):
         """ Delete a tag
 
@@ -335,6 +446,29 @@ class MaasClient:
             return True
         return False
 
+    def tag_machines(self, tag, system_ids, chunk_size=100):
+        """ Tag many machines with the specified tag.
+
+        Sends one update_nodes request per chunk_size machines.
+
+        :param tag: Tag name
+        :type tag: str
+        :param system_ids: IDs of nodes
+        :type system_ids: list
+        :returns: True if every request succeeded
+        :rtype: bool
+        """
+        system_ids = list(system_ids)
+        chunks = [system_ids[i:i + chunk_size]
+                  for i in range(0, len(system_ids), chunk_size)]
+
+        def _update(chunk):
+            return self.post('/tags/%s/' % (tag,),
+                             dict(op='update_nodes',
+                                  add=chunk)).ok
+
+        return all(self._map(_update, chunks))
+
     def tag_name(self, nodes):
         """ Tag each managed node with its hostname.
 
@@ -345,13 +479,17 @@ class MaasClient:
         its hostname for now so that we can pass that tag as a
         constraint to juju.
 
+        Missing tags are created together and the per-node tag
+        requests run on the worker pool.
+
         """
-        for machine in nodes:
-            system_id = machine['system_id']
-            if 'tag_names' not in machine['tag_names'] or \
-               system_id not in machine['tag_names']:
-                self.tag_new(system_id)
-                self.tag_machine(system_id, system_id)
+        untagged = [machine['system_id'] for machine in nodes
+                    if machine['system_id'] not in machine['tag_names']]
+        if len(untagged) == 0:
+            return
+        self.tag_new_many(untagged)
+        self._map(lambda system_id: self.tag_machine(system_id, system_id),
+                  untagged)
 
     def tag_fpi(self, nodes):
         """ Tag each DECLARED host with the FPI tag.
@@ -367,9 +505,10 @@ class MaasClient:
         """
         FPI_TAG = 'use-fastpath-installer'
         self.tag_new(FPI_TAG)
-        for machine in nodes:
-            if machine['status'] == 0:
-                self.tag_machine(FPI_TAG, machine['system_id'])
+        declared = [machine['system_id'] for machine in nodes
+                    if machine['status'] == 0]
+        if len(declared) > 0:
+            self.tag_machines(FPI_TAG, declared)
 
     ###########################################################################
     # Users API
@@ -0,0 +1,201 @@
+#
+# asyncclient.py - asyncio client routines for MAAS API
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" asyncio MAAS API client
+
+Wraps :class:`maasclient.MaasClient` so every per-node call is a
+coroutine. Requests still go through the client's pooled, OAuth-signed
+session, on a worker pool bounded by ``concurrency``; the ``*_many``
+helpers run one request per node at once, so a batch takes about as
+long as its slowest node.
+
+.. code::
+
+    client = AsyncMaasClient(auth, concurrency=20)
+    details = loop.run_until_complete(client.details_many(system_ids))
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from maasclient import MaasClient
+
+log = logging.getLogger('maasclient.async')
+
+
+class AsyncMaasClient:
+
+    """ Client Class
+    """
+
+    def __init__(self, auth, loop=None, concurrency=10, **kwargs):
+        """ Entry point to asyncio client routines for interfacing
+        with MAAS api.
+
+        :param auth: MAAS Authorization class (required)
+        :param loop: event loop, defaults to the current one
+        :param concurrency: most requests in flight at once, also the
+                            number of pooled connections
+        :param kwargs: passed on to :class:`MaasClient`
+        """
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.client = MaasClient(auth, pool_maxsize=concurrency,
+                                 workers=concurrency, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    @asyncio.coroutine
+    def _run(self, func, *args):
+        return (yield from self.loop.run_in_executor(self.executor,
+                                                     func, *args))
+
+    @asyncio.coroutine
+    def _many(self, func, args_list):
+        """ Runs func once per args tuple concurrently.
+
+        :returns: list of results in the order of args_list. A request
+                  that raised has its exception in place of the result.
+        """
+        return (yield from asyncio.gather(*[self._run(func, *args)
+                                            for args in args_list],
+                                          loop=self.loop,
+                                          return_exceptions=True))
+
+    def close(self):
+        """ Closes pooled connections and worker threads """
+        self.executor.shutdown(wait=False)
+        self.client.close()
+
+    ###########################################################################
+    # Node API
+    ###########################################################################
+    @asyncio.coroutine
+    def nodes(self):
+        """ Nodes managed by MAAS, see MaasClient.nodes """
+        return (yield from self._run(lambda: self.client.nodes))
+
+    @asyncio.coroutine
+    def node_get(self, node_id):
+        return (yield from self._run(self.client.node_get, node_id))
+
+    @asyncio.coroutine
+    def node_details(self, system_id):
+        """ Node Details, see MaasClient.node_details """
+        return (yield from self._run(self.client.node_details, system_id))
+
+    @asyncio.coroutine
+    def node_start(self, node_id, user_data=None, distro_series=None):
+        """ Power up a node, see MaasClient.node_start """
+        return (yield from self._run(self.client.node_start, node_id,
+                                     user_data, distro_series))
+
+    @asyncio.coroutine
+    def node_stop(self, node_id):
+        """ Shutdown a node, see MaasClient.node_stop """
+        return (yield from self._run(self.client.node_stop, node_id))
+
+    @asyncio.coroutine
+    def node_commission(self, system_id):
+        """ (Re)commission a node, see MaasClient.node_commission """
+        return (yield from self._run(self.client.node_commission,
+                                     system_id))
+
+    @asyncio.coroutine
+    def node_release(self, node_id):
+        """ Release a node, see MaasClient.node_release """
+        return (yield from self._run(self.client.node_release, node_id))
+
+    @asyncio.coroutine
+    def node_remove(self, system_id):
+        """ Delete a node, see MaasClient.node_remove """
+        return (yield from self._run(self.client.node_remove, system_id))
+
+    @asyncio.coroutine
+    def details_many(self, system_ids):
+        """ Node details for every node in system_ids
+
+        :returns: list of details dicts (or None) in the order of
+                  system_ids, see _many()
+        """
+        return (yield from self._many(self.client.node_details,
+                                      [(s,) for s in system_ids]))
+
+    @asyncio.coroutine
+    def start_many(self, node_ids, user_data=None, distro_series=None):
+        """ Power up every node in node_ids
+
+        :returns: list of True/False in the order of node_ids
+        """
+        return (yield from self._many(self.client.node_start,
+                                      [(n, user_data, distro_series)
+                                       for n in node_ids]))
+
+    @asyncio.coroutine
+    def stop_many(self, node_ids):
+        """ Shutdown every node in node_ids
+
+        :returns: list of True/False in the order of node_ids
+        """
+        return (yield from self._many(self.client.node_stop,
+                                      [(n,) for n in node_ids]))
+
+    @asyncio.coroutine
+    def commission_many(self, system_ids):
+        """ (Re)commission every node in system_ids
+
+        :returns: list of True/False in the order of system_ids
+        """
+        return (yield from self._many(self.client.node_commission,
+                                      [(s,) for s in system_ids]))
+
+    @asyncio.coroutine
+    def release_many(self, node_ids):
+        """ Release every node in node_ids back into the pool
+
+        :returns: list of True/False in the order of node_ids
+        """
+        return (yield from self._many(self.client.node_release,
+                                      [(n,) for n in node_ids]))
+
+    ###########################################################################
+    # Tag API
+    ###########################################################################
+    @asyncio.coroutine
+    def tags(self):
+        """ List tags known to MAAS, see MaasClient.tags """
+        return (yield from self._run(lambda: self.client.tags))
+
+    @asyncio.coroutine
+    def tag_new(self, tag):
+        """ Create tag if it doesn't exist, see MaasClient.tag_new """
+        return (yield from self._run(self.client.tag_new, tag))
+
+    @asyncio.coroutine
+    def tag_machine(self, tag, system_id):
+        """ Tag one machine, see MaasClient.tag_machine """
+        return (yield from self._run(self.client.tag_machine, tag,
+                                     system_id))
+
+    @asyncio.coroutine
+    def tag_many(self, tags_and_ids):
+        """ Apply many (tag, system_id) pairs
+
+        :returns: list of True/False in the order of tags_and_ids
+        """
+        return (yield from self._many(self.client.tag_machine,
+                                      list(tags_and_ids)))
@@ -0,0 +1,497 @@
+#
+# fakeserver.py - Local MAAS API emulator
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Fake MAAS API server
+
+Serves the parts of the MAAS 1.0 API used by :class:`maasclient.MaasClient`
+(``/nodes/``, ``/tags/``, ``/nodegroups/``, ``/zones/``, ``/users/`` and
+``/networks/``) from memory, checking OAuth PLAINTEXT signatures.
+
+Nodes move through MAAS states the way a real cluster does: commission
+takes NEW to COMMISSIONING and then READY, acquire takes READY to
+ALLOCATED and release takes ALLOCATED back to READY. Transitions finish
+``transition_delay`` seconds after they are requested. Every response
+can be delayed by ``latency`` seconds.
+
+.. code::
+
+    server = FakeMaasServer(num_nodes=2000, latency=0.01)
+    server.start()
+    client = MaasClient(MaasAuth(server.api_url, server.api_key))
+    ...
+    server.stop()
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import random
+import threading
+import time
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import uuid
+
+import bson
+
+log = logging.getLogger('maasclient.fakeserver')
+
+API_PREFIX = '/MAAS/api/1.0'
+
+NEW = 0
+COMMISSIONING = 1
+READY = 4
+ALLOCATED = 6
+
+
+class FakeMaasError(Exception):
+    """ Carries the HTTP status for a failed request """
+
+    def __init__(self, status, message=''):
+        super().__init__(message)
+        self.status = status
+
+
+class FakeMaas:
+
+    """ In-memory MAAS cluster state
+    """
+
+    def __init__(self, num_nodes=10, status=READY, transition_delay=0,
+                 bootstrap=True, seed=None, clock=time.time):
+        """ Builds a cluster of num_nodes nodes.
+
+        :param num_nodes: nodes to create, not counting bootstrap
+        :param status: initial MAAS status of every node
+        :param transition_delay: seconds a status change takes
+        :param bootstrap: also create a deployed juju-bootstrap.maas node
+        :param seed: seed for the generated hardware, for repeatable runs
+        :param clock: time source, for tests
+        """
+        self.transition_delay = transition_delay
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.nodes = {}
+        self.tags = {}
+        self.zones = {'default': self._zone('default', '')}
+        self.nodegroup_uuid = str(uuid.UUID(int=self.random.getrandbits(128)))
+        # system_id -> (target status, when)
+        self._pending = {}
+        if bootstrap:
+            self.add_node('juju-bootstrap.maas', ALLOCATED)
+        for i in range(num_nodes):
+            self.add_node('node-{:05d}.maas'.format(i), status)
+
+    def _zone(self, name, description):
+        return dict(name=name, description=description,
+                    resource_uri='{}/zones/{}/'.format(API_PREFIX, name))
+
+    def add_node(self, hostname, status=READY):
+        """ Adds a node with randomly sized hardware
+
+        :returns: node dict
+        """
+        r = self.random
+        system_id = 'node-{}'.format(uuid.UUID(int=r.getrandbits(128)))
+        mac = ':'.join('{:02x}'.format(r.randint(0, 255)) for _ in range(6))
+        uri = '{}/nodes/{}/'.format(API_PREFIX, system_id)
+        node = dict(system_id=system_id,
+                    hostname=hostname,
+                    status=status,
+                    architecture='amd64/generic',
+                    cpu_count=r.choice([2, 4, 8, 16]),
+                    memory=r.choice([4096, 8192, 16384, 32768]),
+                    storage=r.choice([40960, 102400, 512000]),
+                    power_type='virsh',
+                    power_state='off',
+                    netboot=True,
+                    owner='root' if status == ALLOCATED else None,
+                    tag_names=[],
+                    ip_addresses=[],
+                    routers=[],
+                    zone=self.zones['default'],
+                    macaddress_set=[dict(mac_address=mac,
+                                         resource_uri='{}macs/{}/'.format(
+                                             uri, mac))],
+                    resource_uri=uri)
+        with self.lock:
+            self.nodes[system_id] = node
+        return node
+
+    def _transition(self, node, now_status, then_status):
+        node['status'] = now_status
+        when = self.clock() + self.transition_delay
+        self._pending[node['system_id']] = (then_status, when)
+
+    def _settle(self):
+        """ Completes transitions whose delay has passed. Holds lock. """
+        if not self._pending:
+            return
+        now = self.clock()
+        for system_id, (status, when) in list(self._pending.items()):
+            if when <= now:
+                del self._pending[system_id]
+                node = self.nodes.get(system_id)
+                if node is not None:
+                    node['status'] = status
+
+    def _node(self, system_id):
+        try:
+            return self.nodes[system_id]
+        except KeyError:
+            raise FakeMaasError(404, "no node {}".format(system_id))
+
+    ###########################################################################
+    # Node API
+    ###########################################################################
+    def list_nodes(self, params):
+        with self.lock:
+            self._settle()
+            nodes = self.nodes.values()
+            if 'id' in params:
+                nodes = [n for n in nodes if n['system_id'] in params['id']]
+            if 'hostname' in params:
+                nodes = [n for n in nodes
+                         if n['hostname'] in params['hostname']]
+            return [dict(n) for n in nodes]
+
+    def get_node(self, system_id):
+        with self.lock:
+            self._settle()
+            return dict(self._node(system_id))
+
+    def node_details(self, system_id):
+        with self.lock:
+            node = self._node(system_id)
+            lshw = ('<list><node id="{}" class="system">'
+                    '<product>Fake</product></node></list>'.format(
+                        node['hostname']))
+        return bson.BSON.encode(dict(lshw=lshw.encode('utf-8')))
+
+    def node_op(self, system_id, op, params):
+        """ Applies a per-node POST op """
+        with self.lock:
+            self._settle()
+            node = self._node(system_id)
+            if op == 'commission':
+                self._transition(node, COMMISSIONING, READY)
+            elif op == 'start':
+                if node['status'] != ALLOCATED:
+                    raise FakeMaasError(409, "node not allocated")
+                node['power_state'] = 'on'
+            elif op == 'stop':
+                node['power_state'] = 'off'
+            elif op == 'release':
+                if node['status'] != ALLOCATED:
+                    raise FakeMaasError(409, "node not allocated")
+                node['owner'] = None
+                node['power_state'] = 'off'
+                self._transition(node, ALLOCATED, READY)
+            else:
+                raise FakeMaasError(400, "unknown op {}".format(op))
+            return dict(node)
+
+    def nodes_op(self, op, params):
+        """ Applies a POST op on the node collection """
+        with self.lock:
+            self._settle()
+            if op == 'accept_all':
+                accepted = []
+                for node in self.nodes.values():
+                    if node['status'] == NEW:
+                        self._transition(node, COMMISSIONING, READY)
+                        accepted.append(dict(node))
+                return accepted
+            if op == 'acquire':
+                tags = set(params.get('tags', []))
+                names = set(params.get('name', []))
+                for node in sorted(self.nodes.values(),
+                                   key=lambda n: n['hostname']):
+                    if node['status'] != READY:
+                        continue
+                    if not tags.issubset(node['tag_names']):
+                        continue
+                    if names and node['hostname'] not in names:
+                        continue
+                    node['status'] = ALLOCATED
+                    node['owner'] = 'root'
+                    return dict(node)
+                raise FakeMaasError(409, "no matching node available")
+            raise FakeMaasError(400, "unknown op {}".format(op))
+
+    def delete_node(self, system_id):
+        with self.lock:
+            self._node(system_id)
+            del self.nodes[system_id]
+            self._pending.pop(system_id, None)
+
+    ###########################################################################
+    # Tag API
+    ###########################################################################
+    def tag_new(self, name, params):
+        with self.lock:
+            if name in self.tags:
+                raise FakeMaasError(400, "tag {} exists".format(name))
+            tag = dict(name=name,
+                       definition=params.get('definition', [''])[0],
+                       comment=params.get('comment', [''])[0],
+                       resource_uri='{}/tags/{}/'.format(API_PREFIX, name))
+            self.tags[name] = tag
+            return dict(tag)
+
+    def tag_update_nodes(self, name, params):
+        with self.lock:
+            if name not in self.tags:
+                raise FakeMaasError(404, "no tag {}".format(name))
+            added = removed = 0
+            for system_id in params.get('add', []):
+                node = self.nodes.get(system_id)
+                if node is not None and name not in node['tag_names']:
+                    node['tag_names'].append(name)
+                    added += 1
+            for system_id in params.get('remove', []):
+                node = self.nodes.get(system_id)
+                if node is not None and name in node['tag_names']:
+                    node['tag_names'].remove(name)
+                    removed += 1
+            return dict(added=added, removed=removed)
+
+    def tag_nodes(self, name):
+        with self.lock:
+            self._settle()
+            return [dict(n) for n in self.nodes.values()
+                    if name in n['tag_names']]
+
+    def tag_delete(self, name):
+        with self.lock:
+            if self.tags.pop(name, None) is None:
+                raise FakeMaasError(404, "no tag {}".format(name))
+            for node in self.nodes.values():
+                if name in node['tag_names']:
+                    node['tag_names'].remove(name)
+
+    ###########################################################################
+    # Zone API
+    ###########################################################################
+    def zone_new(self, params):
+        name = params.get('name', [''])[0]
+        if not name:
+            raise FakeMaasError(400, "zone name required")
+        with self.lock:
+            if name in self.zones:
+                raise FakeMaasError(400, "zone {} exists".format(name))
+            self.zones[name] = self._zone(name,
+                                          params.get('description',
+                                                     [''])[0])
+            return dict(self.zones[name])
+
+    def zone_delete(self, name):
+        with self.lock:
+            if name == 'default' or name not in self.zones:
+                raise FakeMaasError(400, "cannot delete zone {}".format(name))
+            del self.zones[name]
+
+    ###########################################################################
+    # Nodegroups API
+    ###########################################################################
+    def list_nodegroups(self):
+        return [dict(uuid=self.nodegroup_uuid, status=1,
+                     name='maas', cluster_name='Cluster master')]
+
+    def boot_images(self):
+        return [dict(osystem='ubuntu', release='trusty',
+                     architecture='amd64', subarchitecture='generic',
+                     purpose='xinstall', label='release')]
+
+
+class FakeMaasHandler(BaseHTTPRequestHandler):
+
+    """ Routes MAAS API requests to the server's FakeMaas """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _check_auth(self, query):
+        """ Checks an OAuth PLAINTEXT query signature """
+        server = self.server
+        key = query.get('oauth_consumer_key', [None])[0]
+        token = query.get('oauth_token', [None])[0]
+        signature = query.get('oauth_signature', [None])[0]
+        return (key == server.consumer_key and
+                token == server.token_key and
+                signature == '&' + server.token_secret)
+
+    def _send(self, status, body=b'', content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        params = query
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            form = self.rfile.read(length).decode('utf-8')
+            params = dict(query, **parse_qs(form))
+        if server.latency:
+            time.sleep(server.latency)
+
+        if not self._check_auth(query):
+            self._send(401, b'Unauthorised', 'text/plain')
+            return
+        if not url.path.startswith(API_PREFIX):
+            self._send(404, b'Not Found', 'text/plain')
+            return
+        parts = [p for p in url.path[len(API_PREFIX):].split('/') if p]
+        op = params.get('op', [None])[0]
+        try:
+            rv = self._route(method, parts, op, params)
+        except FakeMaasError as e:
+            self._send(e.status, str(e).encode('utf-8'), 'text/plain')
+            return
+        if rv is None:
+            self._send(404, b'Not Found', 'text/plain')
+        elif isinstance(rv, bytes):
+            self._send(200, rv, 'application/bson')
+        else:
+            self._send(200, rv)
+
+    def _route(self, method, parts, op, params):
+        maas = self.server.maas
+        if not parts:
+            return None
+        resource, rest = parts[0], parts[1:]
+        if resource == 'nodes':
+            if not rest:
+                if method == 'GET':
+                    return maas.list_nodes(params)
+                if method == 'POST':
+                    return maas.nodes_op(op, params)
+            elif len(rest) == 1:
+                if method == 'GET':
+                    if op == 'details':
+                        return maas.node_details(rest[0])
+                    return maas.get_node(rest[0])
+                if method == 'POST':
+                    return maas.node_op(rest[0], op, params)
+                if method == 'DELETE':
+                    maas.delete_node(rest[0])
+                    return {}
+        elif resource == 'tags':
+            if not rest:
+                if method == 'GET':
+                    return list(maas.tags.values())
+                if method == 'POST' and op == 'new':
+                    return maas.tag_new(params.get('name', [''])[0], params)
+            elif len(rest) == 1:
+                if method == 'GET' and op == 'nodes':
+                    return maas.tag_nodes(rest[0])
+                if method == 'POST' and op == 'update_nodes':
+                    return maas.tag_update_nodes(rest[0], params)
+                if method == 'DELETE':
+                    maas.tag_delete(rest[0])
+                    return {}
+        elif resource == 'zones':
+            if not rest:
+                if method == 'GET':
+                    return list(maas.zones.values())
+                if method == 'POST':
+                    return maas.zone_new(params)
+            elif len(rest) == 1 and method == 'DELETE':
+                maas.zone_delete(rest[0])
+                return {}
+        elif resource == 'nodegroups':
+            if not rest:
+                if method == 'GET':
+                    return maas.list_nodegroups()
+                if method == 'POST' and op == 'import_boot_images':
+                    return {}
+            elif rest[0] != maas.nodegroup_uuid:
+                return None
+            elif rest[1:] == ['boot-images']:
+                if method == 'GET':
+                    return maas.boot_images()
+                if op == 'report_boot_images':
+                    return {}
+            elif op == 'report_download_progress':
+                return {}
+        elif resource in ('users', 'networks') and method == 'GET':
+            return []
+        return None
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class FakeMaasServer(ThreadingMixIn, HTTPServer):
+
+    """ Threaded HTTP server for a FakeMaas cluster
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0,
+                 api_key='consumer:token:secret', **kwargs):
+        """
+        :param host: address to listen on
+        :param port: port to listen on, 0 picks a free one
+        :param latency: seconds added to every response
+        :param api_key: MAAS api key, consumer_key:token_key:token_secret
+        :param kwargs: passed on to :class:`FakeMaas`
+        """
+        super().__init__((host, port), FakeMaasHandler)
+        self.latency = latency
+        self.api_key = api_key
+        (self.consumer_key,
+         self.token_key,
+         self.token_secret) = api_key.split(':')
+        self.maas = FakeMaas(**kwargs)
+        self._thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, API_PREFIX)
+
+    def start(self):
+        """ Serves requests on a background thread """
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
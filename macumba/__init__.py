@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from ws4py.client.threadedclient import WebSocketClient
+from collections import OrderedDict
 import json
 import logging
 import requests
@@ -24,6 +25,8 @@ import pprint
 import threading
 import time
 
+from macumba.metrics import ClientMetrics
+
 log = logging.getLogger('macumba')
 
 creds = {'Type': 'Admin',
@@ -104,6 +107,13 @@ class ConnectionClosedError(MacumbaError):
     "Attempted to receive messages from closed connection"
 
 
+class RequestInterrupted(ConnectionClosedError):
+
+    """ The connection was lost before the reply to a request that is
+    not safe to send twice. It may or may not have been applied.
+    """
+
+
 class UnknownRequestError(MacumbaError):
 
     "Attempted to receive a message with an unknown ID"
@@ -114,17 +124,97 @@ class RequestTimeout(MacumbaError):
     "Request timed out"
 
 
+# Requests that can be sent again after a lost connection without
+# changing the outcome: reads, watcher calls, and writes that set a value
+IDEMPOTENT_REQUESTS = frozenset([
+    'CharmInfo', 'EnvironmentGet', 'EnvironmentInfo', 'EnvironmentSet',
+    'FullStatus', 'GetAnnotations', 'GetEnvironmentConstraints',
+    'GetServiceConstraints', 'Next', 'PublicAddress',
+    'ServiceCharmRelations', 'ServiceGet', 'ServiceSet', 'SetAnnotations',
+    'SetEnvironmentConstraints', 'WatchAll'])
+
+
+class _NoSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _no_tracer(name, **args):
+    return _NO_SPAN
+
+
+class PendingRequest:
+
+    """ A request that has been sent and is waiting for its reply.
+
+    The websocket thread completes it from received_message(), waking
+    up exactly the thread that is waiting on this RequestId.
+    """
+
+    def __init__(self, request_id, request=None, sent_size=0,
+                 deadline=None, params=None):
+        self.request_id = request_id
+        self.request = request
+        # the request as sent, to replay it on a new connection
+        self.params = params
+        self.sent_size = sent_size
+        self.sent_at = time.time()
+        # time after which an entry nobody waits on is dropped
+        self.deadline = deadline
+        self.waiting = False
+        self.received_at = None
+        self.received_size = 0
+        self.message = None
+        self.done = threading.Event()
+
+    def complete(self, message, size=0):
+        self.received_at = time.time()
+        self.received_size = size
+        self.message = message
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Blocks until the reply arrives or timeout seconds pass.
+
+        Returns True if the request was completed.
+        """
+        self.waiting = True
+        try:
+            return self.done.wait(timeout)
+        finally:
+            self.waiting = False
+
+
 class JujuWS(WebSocketClient):
 
+    # most requests sent and not yet answered, do_send blocks beyond it
+    max_pending = 256
+    # seconds an entry no thread is waiting on is kept for its reply
+    pending_ttl = 600
+    # expired request ids remembered to recognise their late replies
+    expired_history = 1024
+
     def __init__(self, url, password, protocols=['https-only'],
                  extensions=None, ssl_options=None, headers=None,
-                 start_reqid=1):
+                 start_reqid=1, metrics=None):
         WebSocketClient.__init__(self, url, protocols, extensions,
                                  ssl_options=ssl_options, headers=headers)
         self.open_done = threading.Event()
         self.rid_lock = threading.RLock()
         self.msglock = threading.RLock()
+        self.slot_free = threading.Condition(self.msglock)
         self.messages = {}
+        self.metrics = metrics
+        self._unanswered = 0
+        self._expired = OrderedDict()
+        self._next_expiry = 0
         self._cur_request_id = start_reqid
 
     # WebSocketClient subclass overrides, run in private thread:
@@ -135,10 +225,77 @@ class JujuWS(WebSocketClient):
         msg = json.loads(m.data.decode('utf-8'))
         msg_req_id = msg['RequestId']
         with self.msglock:
-            self.messages[msg_req_id] = msg
+            pending = self.messages.get(msg_req_id)
+            if pending is None:
+                request = self._expired.pop(msg_req_id, None)
+            elif not pending.done.is_set():
+                self._answered()
+        if pending is None:
+            log.debug("dropping reply for unknown request "
+                      "{}".format(msg_req_id))
+            if self.metrics is not None:
+                self.metrics.late_reply(request)
+            return
+        pending.complete(msg, len(m.data))
 
     def closed(self, code, reason=None):
         log.debug("socket closed: code:{} reason:{}".format(code, reason))
+        # wake up every waiter, they will see the closed connection
+        with self.msglock:
+            pending = list(self.messages.values())
+            # nothing more will be answered on this connection
+            self._unanswered = 0
+            self.slot_free.notify_all()
+        for p in pending:
+            p.done.set()
+
+    def _answered(self):
+        """ A request stopped counting against max_pending.
+
+        Called with msglock held.
+        """
+        self._unanswered -= 1
+        self.slot_free.notify()
+
+    def _drop(self, pending):
+        """ Forgets an unanswered request, remembering its id so a late
+        reply can be told apart from a bogus one.
+
+        Called with msglock held.
+        """
+        self.messages.pop(pending.request_id, None)
+        if pending.done.is_set():
+            return
+        self._answered()
+        self._expired[pending.request_id] = pending.request
+        while len(self._expired) > self.expired_history:
+            self._expired.popitem(last=False)
+
+    def expire(self, now=None):
+        """ Drops entries past their deadline that no thread waits on,
+        e.g. requests whose caller gave up or died before receiving.
+
+        Returns the number of entries dropped.
+        """
+        if now is None:
+            now = time.time()
+        with self.msglock:
+            stale = [p for p in self.messages.values()
+                     if p.deadline is not None and p.deadline <= now
+                     and not p.waiting]
+            for p in stale:
+                self._drop(p)
+        for p in stale:
+            log.debug("expired request {} ({})".format(p.request_id,
+                                                       p.request))
+            if self.metrics is not None:
+                self.metrics.expired(p.request)
+        return len(stale)
+
+    def pending_count(self):
+        """ Requests sent and not yet answered """
+        with self.msglock:
+            return self._unanswered
 
     # actions for users of the class:
     def get_current_request_id(self):
@@ -155,56 +312,146 @@ class JujuWS(WebSocketClient):
         rv = self.do_send(creds)
         return rv
 
+    def _wait_for_slot(self):
+        """ Blocks while max_pending requests are unanswered.
+
+        Called with msglock held.
+        """
+        now = time.time()
+        if now >= self._next_expiry:
+            self._next_expiry = now + 1
+            self.expire(now)
+        while self._unanswered >= self.max_pending:
+            if self.terminated:
+                raise ConnectionClosedError
+            log.debug("{} requests unanswered, waiting".format(
+                self._unanswered))
+            self.slot_free.wait(1)
+            self.expire()
+
     def do_send(self, json_message):
         with self.rid_lock:
             self._cur_request_id += 1
             request_id = self._cur_request_id
 
         json_message['RequestId'] = request_id
+        data = json.dumps(json_message)
 
-        self.send(json.dumps(json_message))
-
+        # register before sending so a fast reply always finds its slot
+        pending = PendingRequest(request_id, json_message.get('Request'),
+                                 len(data),
+                                 deadline=time.time() + self.pending_ttl,
+                                 params=json_message)
         with self.msglock:
-            self.messages[request_id] = None
+            self._wait_for_slot()
+            self.messages[request_id] = pending
+            self._unanswered += 1
+
+        try:
+            self.send(data)
+        except Exception as e:
+            with self.msglock:
+                self.messages.pop(request_id, None)
+                if not pending.done.is_set():
+                    self._answered()
+            # an unsent frame was never applied, so the caller may
+            # send it again on a new connection
+            raise ConnectionClosedError("send failed: {}".format(e)) from e
 
         return request_id
 
-    def do_receive(self, request_id):
-        """Checks for message matching request_id.
+    def pending(self, request_id):
+        """ Returns the PendingRequest for request_id, or None """
+        with self.msglock:
+            return self.messages.get(request_id)
 
-        Will return None if message has not arrived yet.
+    def do_receive(self, request_id, timeout=None):
+        """Waits for the message matching request_id.
+
+        Blocks until the reply arrives. Returns None if timeout is set
+        and it expires first; the request is then forgotten and a late
+        reply is dropped.
 
         Raises UnknownRequestError if request_id hasn't been sent yet
-        (or was already received).
+        (or was already received, timed out or expired).
 
-        """
-        if self.terminated:
-            raise ConnectionClosedError
+        Raises ConnectionClosedError if the connection closes while
+        waiting.
 
+        """
         with self.msglock:
             if request_id not in self.messages:
                 errmsg = ("{} not in messages. "
                           "cur = {}".format(request_id,
                                             self._cur_request_id))
                 raise UnknownRequestError(errmsg)
+            pending = self.messages[request_id]
 
-            message = self.messages[request_id]
-            if message is not None:
-                del self.messages[request_id]
+        if not pending.done.is_set() and self.terminated:
+            with self.msglock:
+                self._drop(pending)
+            raise ConnectionClosedError
+
+        if not pending.wait(timeout):
+            with self.msglock:
+                self._drop(pending)
+            return None
 
-        return message
+        with self.msglock:
+            self.messages.pop(request_id, None)
+
+        if pending.message is None:
+            raise ConnectionClosedError
+
+        return pending.message
 
 
 class JujuClient:
 
+    """ Juju API client
+
+    A lost connection is re-established with exponential backoff and
+    logged in again. Requests in IDEMPOTENT_REQUESTS that were waiting
+    for a reply are sent again, others raise RequestInterrupted.
+    Watchers from get_watcher() are re-created and keep their ids.
+    """
+
+    # reconnect after a lost connection, instead of raising
+    # ConnectionClosedError
+    auto_reconnect = True
+    # seconds before the first retry, doubled up to reconnect_max_delay
+    reconnect_delay = 1
+    reconnect_max_delay = 30
+    # seconds to keep trying before giving up
+    reconnect_timeout = 600
+
     def __init__(self, url='wss://localhost:17070', password='pass'):
         self.url = url
         self.password = password
+        # closed connections that still hold unreceived requests
+        self._retired = []
+        # watcher id handed out by get_watcher() -> id on this connection
+        self._watchers = {}
+        # every id a watcher had on any connection -> get_watcher() id
+        self._watcher_origins = {}
+        # watcher id handed out by get_watcher() -> times re-created
+        self._watcher_generations = {}
+        # tracer(name, cat=..., **args) returns a context manager that
+        # times each request, e.g. cloudinstall.trace.span
+        self.tracer = _no_tracer
+        self.metrics = ClientMetrics()
         self.connlock = threading.RLock()
         with self.connlock:
-            self.conn = JujuWS(url, password)
+            self.conn = self._new_conn()
         creds['Params']['Password'] = password
 
+    def _new_conn(self, start_reqid=1):
+        """ A new, not yet connected, websocket to the state server """
+        return JujuWS(self.url,
+                      self.password,
+                      start_reqid=start_reqid,
+                      metrics=self.metrics)
+
     def _prepare_strparams(self, d):
         r = {}
         for k, v in d.items():
@@ -224,21 +471,64 @@ class JujuClient:
         """
         with self.connlock:
             req_id = self.conn.do_connect()
+            self._record_sent(self.conn, req_id)
             try:
-                res = self.receive(req_id)
+                res = self._receive(self.conn, req_id)
                 if 'Error' in res:
                     raise LoginError(res['ErrorCode'])
             except Exception as e:
                 raise LoginError(str(e))
 
     def reconnect(self):
+        """ Replaces the connection with a new, logged in one and
+        re-creates every watcher on it.
+        """
         with self.connlock:
-            self.close()
-            start_id = self.conn.get_current_request_id() + 1
-            self.conn = JujuWS(self.url,
-                               self.password,
-                               start_reqid=start_id)
+            old = self.conn
+            try:
+                self.close()
+            except Exception:
+                log.debug("error closing old connection", exc_info=True)
+            self.conn = self._new_conn(old.get_current_request_id() + 1)
+            self._retired = [c for c in self._retired + [old]
+                             if c is not self.conn and c.messages]
             self.login()
+            for watcher_id in list(self._watchers):
+                rv = self._receive(self.conn, self._send_once(
+                    dict(Type="Client", Request="WatchAll")))
+                self._watchers[watcher_id] = rv['AllWatcherId']
+                self._watcher_origins[rv['AllWatcherId']] = watcher_id
+                self._watcher_generations[watcher_id] += 1
+        self.metrics.reconnected()
+
+    def _recover(self, conn):
+        """ Reconnects after conn was lost, retrying with exponential
+        backoff.
+
+        Does nothing if another thread already replaced conn. Raises
+        ConnectionClosedError after reconnect_timeout seconds.
+        """
+        with self.connlock:
+            if self.conn is not conn and not self.conn.terminated:
+                return
+            delay = self.reconnect_delay
+            deadline = time.time() + self.reconnect_timeout
+            while True:
+                log.warning("Lost connection to {}, reconnecting".format(
+                    self.url))
+                try:
+                    self.reconnect()
+                    log.info("Reconnected to {}".format(self.url))
+                    return
+                except Exception as e:
+                    if time.time() + delay > deadline:
+                        raise ConnectionClosedError(
+                            "Could not reconnect to {}: {}".format(
+                                self.url, e)) from e
+                    log.warning("Reconnecting failed ({}), retrying in "
+                                "{}s".format(e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_delay)
 
     def close(self):
         """ Closes connection to juju websocket """
@@ -247,23 +537,96 @@ class JujuClient:
 
     def receive(self, request_id, timeout=None):
         """receives expected message.
-        
+
         returns parsed response object.
 
         if timeout is set, raises RequestTimeout after 'timeout' seconds
         with no received message.
 
+        if the connection is lost first, reconnects and sends the request
+        again if it is idempotent, or raises RequestInterrupted.
+
         """
-        res = None
-        start_time = time.time()
-        while res is None:
-            with self.connlock:
-                res = self.conn.do_receive(request_id)
-            if res is None:
-                time.sleep(0.1)
-                if timeout and (time.time() - start_time > timeout):
-                    raise RequestTimeout(request_id)
+        conn = self._conn_for(request_id)
+        pending = conn.pending(request_id)
+        try:
+            return self._receive(conn, request_id, timeout)
+        except ConnectionClosedError:
+            if not self.auto_reconnect or pending is None:
+                raise
+            self._recover(conn)
+            if pending.request not in IDEMPOTENT_REQUESTS:
+                raise RequestInterrupted(
+                    "connection lost waiting for {} {}".format(
+                        pending.request, request_id))
+        log.info("Replaying {} {} after reconnect".format(pending.request,
+                                                          request_id))
+        self.metrics.replayed(pending.request)
+        return self.receive(self._send(self._replay_params(pending.params)),
+                            timeout)
+
+    def _conn_for(self, request_id):
+        """ The connection request_id was sent on """
+        with self.connlock:
+            for conn in self._retired:
+                if conn.pending(request_id) is not None:
+                    return conn
+            return self.conn
+
+    def _replay_params(self, params):
+        params = dict(params)
+        params.pop('RequestId', None)
+        if params.get('Type') == 'AllWatcher':
+            params['Id'] = self._current_watcher(params['Id'])
+        return params
+
+    def _receive(self, conn, request_id, timeout=None):
+        """ receive() on conn, raising ConnectionClosedError if it is lost
+        """
+        pending = conn.pending(request_id)
+        try:
+            res = conn.do_receive(request_id, timeout)
+        except ConnectionClosedError:
+            if pending is not None:
+                self.metrics.interrupted(pending.request)
+            raise
+        if res is None:
+            if pending is not None:
+                self.metrics.timed_out(pending.request)
+            raise RequestTimeout(request_id)
+
+        if pending is not None:
+            self.metrics.completed(pending.request,
+                                   pending.received_at - pending.sent_at,
+                                   pending.received_size,
+                                   error='Error' in res)
+        return self._parse_response(res)
+
+    def _send(self, params):
+        with self.connlock:
+            conn = self.conn
+            try:
+                return self._send_once(params)
+            except ConnectionClosedError:
+                if not self.auto_reconnect:
+                    raise
+            # nothing was sent, so any request can go on the new one
+            self._recover(conn)
+            return self._send(params)
+
+    def _send_once(self, params):
+        with self.connlock:
+            req_id = self.conn.do_send(params)
+            self._record_sent(self.conn, req_id)
+        return req_id
+
+    def _record_sent(self, conn, req_id):
+        pending = conn.pending(req_id)
+        if pending is not None:
+            self.metrics.sent(pending.request, pending.sent_size)
 
+    def _parse_response(self, res):
+        """Returns the Response of a reply, raising on server errors."""
         if 'Error' in res:
             raise ServerError(res['Error'], res)
 
@@ -278,10 +641,42 @@ class JujuClient:
         :params params: Additional params to be passed into request
         :type params: dict
         """
-        with self.connlock:
-            req_id = self.conn.do_send(params)
+        with self.tracer(params.get('Request', ''), cat='juju'):
+            req_id = self._send(params)
+            return self.receive(req_id, timeout)
+
+    def call_many(self, params_list, timeout=None):
+        """ Sends all requests before waiting for any reply.
 
-        return self.receive(req_id, timeout)
+        The API multiplexes on RequestId, so every request is in flight
+        at once and the batch costs roughly one round-trip.
+
+        :param list params_list: list of request dicts, as for call()
+        :param timeout: seconds to wait for the whole batch
+        :returns: list of responses in the same order as params_list.
+                  A request that failed or timed out has its exception
+                  in place of the response.
+        """
+        requests = sorted(set(p.get('Request', '') for p in params_list))
+        with self.tracer("batch " + ",".join(requests), cat='juju',
+                         count=len(params_list)):
+            with self.connlock:
+                req_ids = [self._send(params) for params in params_list]
+
+            deadline = None
+            if timeout:
+                deadline = time.time() + timeout
+
+            results = []
+            for req_id in req_ids:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0, deadline - time.time())
+                try:
+                    results.append(self.receive(req_id, remaining))
+                except MacumbaError as e:
+                    results.append(e)
+            return results
 
     def info(self):
         """ Returns Juju environment state """
@@ -295,15 +690,41 @@ class JujuClient:
                          timeout=60)
 
     def get_watcher(self):
-        """ Returns watcher """
-        return self.call(dict(Type="Client",
-                              Request="WatchAll"))
+        """ Returns watcher
+
+        The AllWatcherId stays valid across reconnects, see
+        watcher_generation().
+        """
+        rv = self.call(dict(Type="Client",
+                            Request="WatchAll"))
+        with self.connlock:
+            watcher_id = rv['AllWatcherId']
+            self._watchers[watcher_id] = watcher_id
+            self._watcher_origins[watcher_id] = watcher_id
+            self._watcher_generations[watcher_id] = 0
+        return rv
+
+    def watcher_generation(self, watcher_id):
+        """ Times the watcher was re-created after a reconnect
+
+        The first get_watched_tasks() after a change returns the whole
+        environment again, not changes since the last call.
+        """
+        return self._watcher_generations.get(watcher_id, 0)
+
+    def _current_watcher(self, watcher_id):
+        """ The id on the current connection of a get_watcher() id, or of
+        an id it had on an earlier connection
+        """
+        with self.connlock:
+            original = self._watcher_origins.get(watcher_id)
+            return self._watchers.get(original, watcher_id)
 
     def get_watched_tasks(self, watcher_id):
         """ Returns a list of all watches for Id """
         return self.call(dict(Type="AllWatcher",
                               Request="Next",
-                              Id=watcher_id))
+                              Id=self._current_watcher(watcher_id)))
 
     def add_charm(self, charm_url):
         """ Adds charm """
@@ -339,25 +760,36 @@ class JujuClient:
                               Request="EnvironmentSet",
                               Params=dict(Config=config)))
 
-    def add_machine(self, series="", constraints={},
-                    machine_spec="", parent_id="", container_type=""):
-        """Allocate a new machine from the iaas provider.
+    def machine_params(self, series="", constraints={},
+                       machine_spec="", parent_id="", container_type=""):
+        """ Returns the parameters for one machine of add_machines()
         """
         if machine_spec:
             err_msg = "Cant specify machine spec with container_type/parent_id"
             assert not (parent_id or container_type), err_msg
             parent_id, container_type = machine_spec.split(":", 1)
 
-        params = dict(
+        return dict(
             Series=series,
             ContainerType=container_type,
             ParentId=parent_id,
             Constraints=self._prepare_constraints(constraints),
             Jobs=[Jobs.HostUnits])
-        return self.add_machines([params])
+
+    def add_machine(self, series="", constraints={},
+                    machine_spec="", parent_id="", container_type=""):
+        """Allocate a new machine from the iaas provider.
+        """
+        return self.add_machines([self.machine_params(
+            series, constraints, machine_spec, parent_id, container_type)])
 
     def add_machines(self, machines):
-        """ Add machines """
+        """ Add machines
+
+        :param list machines: one dict per machine, see machine_params()
+        :returns: response whose 'Machines' list has a Machine id or an
+                  Error for each requested machine, in the same order
+        """
         return self.call(dict(Type="Client",
                               Request="AddMachines",
                               Params=dict(MachineParams=machines)))
@@ -370,22 +802,41 @@ class JujuClient:
                               Request="DestroyMachines",
                               Params=params))
 
+    def _add_relation_params(self, endpoint_a, endpoint_b):
+        return dict(Type="Client",
+                    Request="AddRelation",
+                    Params=dict(Endpoints=[endpoint_a,
+                                           endpoint_b]))
+
+    def _relation_exists(self, e):
+        return 'relation already exists' in e.response['Error']
+
     def add_relation(self, endpoint_a, endpoint_b):
         """ Adds relation between units """
         try:
-            rv = self.call(dict(Type="Client",
-                                Request="AddRelation",
-                                Params=dict(Endpoints=[endpoint_a,
-                                                       endpoint_b])))
+            rv = self.call(self._add_relation_params(endpoint_a, endpoint_b))
         except ServerError as e:
             # do not treat pre-existing relations as exceptions:
-            if 'relation already exists' in e.response['Error']:
+            if self._relation_exists(e):
                 rv = e.response
             else:
                 raise e
 
         return rv
 
+    def add_relations(self, relations, timeout=None):
+        """ Adds many relations in one batch
+
+        :param list relations: list of (endpoint_a, endpoint_b)
+        :returns: list of responses or exceptions, see call_many()
+        """
+        rvs = self.call_many([self._add_relation_params(a, b)
+                              for a, b in relations], timeout)
+        # do not treat pre-existing relations as exceptions:
+        return [rv.response if isinstance(rv, ServerError) and
+                self._relation_exists(rv) else rv
+                for rv in rvs]
+
     def remove_relation(self, endpoint_a, endpoint_b):
         """ Removes relation """
         return self.call(dict(Type="Client",
@@ -405,10 +856,17 @@ class JujuClient:
         :param str machine_spec: Type of machine to deploy to
         :returns: Deployed charm status
         """
+        _url = query_cs(charm)
+        return self.call(self._deploy_params(_url['charm']['url'],
+                                             service_name, num_units,
+                                             config_yaml, constraints,
+                                             machine_spec))
+
+    def _deploy_params(self, charm_url, service_name, num_units=1,
+                       config_yaml="", constraints=None, machine_spec=""):
         params = {'ServiceName': service_name}
 
-        _url = query_cs(charm)
-        params['CharmUrl'] = _url['charm']['url']
+        params['CharmUrl'] = charm_url
         params['NumUnits'] = num_units
         params['ConfigYAML'] = config_yaml
 
@@ -417,16 +875,28 @@ class JujuClient:
                 constraints)
         if machine_spec:
             params['ToMachineSpec'] = machine_spec
-        return self.call(dict(Type="Client",
-                              Request="ServiceDeploy",
-                              Params=dict(params)))
+        return dict(Type="Client",
+                    Request="ServiceDeploy",
+                    Params=dict(params))
+
+    def _set_config_params(self, service_name, config_keys):
+        return dict(Type="Client",
+                    Request="ServiceSet",
+                    Params=dict(ServiceName=service_name,
+                                Options=config_keys))
 
     def set_config(self, service_name, config_keys):
         """ Sets machine config """
-        return self.call(dict(Type="Client",
-                              Request="ServiceSet",
-                              Params=dict(ServiceName=service_name,
-                                          Options=config_keys)))
+        return self.call(self._set_config_params(service_name, config_keys))
+
+    def set_configs(self, configs, timeout=None):
+        """ Sets config of many services in one batch
+
+        :param list configs: list of (service_name, config_keys)
+        :returns: list of responses or exceptions, see call_many()
+        """
+        return self.call_many([self._set_config_params(name, keys)
+                               for name, keys in configs], timeout)
 
     def unset_config(self, service_name, config_keys):
         """ Unsets machine config """
@@ -501,6 +971,17 @@ class JujuClient:
                               Request="ServiceCharmRelations",
                               Params=dict(ServiceName=service_name)))
 
+    def _add_unit_params(self, service_name, num_units=1, machine_spec=""):
+        params = {}
+        params['ServiceName'] = service_name
+        params['NumUnits'] = num_units
+        if machine_spec:
+            params['ToMachineSpec'] = machine_spec
+
+        return dict(Type="Client",
+                    Request="AddServiceUnits",
+                    Params=dict(params))
+
     def add_unit(self, service_name, num_units=1, machine_spec=""):
         """ Add unit
 
@@ -509,15 +990,17 @@ class JujuClient:
         :param str machine_spec: Type of machine to deploy to
         :returns dict: Units added
         """
-        params = {}
-        params['ServiceName'] = service_name
-        params['NumUnits'] = num_units
-        if machine_spec:
-            params['ToMachineSpec'] = machine_spec
+        return self.call(self._add_unit_params(service_name, num_units,
+                                               machine_spec))
 
-        return self.call(dict(Type="Client",
-                              Request="AddServiceUnits",
-                              Params=dict(params)))
+    def add_units(self, units, timeout=None):
+        """ Add units in one batch
+
+        :param list units: list of (service_name, num_units, machine_spec)
+        :returns: list of responses or exceptions, see call_many()
+        """
+        return self.call_many([self._add_unit_params(*u) for u in units],
+                              timeout)
 
     def remove_unit(self, unit_names):
         """ Removes unit """
@@ -538,18 +1021,42 @@ class JujuClient:
                               Request="PublicAddress",
                               Params=dict(Target=target)))
 
+    def _set_annotations_params(self, entity, entity_type, annotation):
+        return dict(Type="Client",
+                    Request="SetAnnotations",
+                    Params=dict(Tag="%s-%s" % (entity_type, entity),
+                                Pairs=annotation))
+
+    def _get_annotations_params(self, entity, entity_type):
+        return dict(Type="Client",
+                    Request="GetAnnotations",
+                    Params=dict(Tag="%s-%s" % (entity_type, entity)))
+
     def set_annotations(self, entity, entity_type, annotation):
         """ Sets annotations.
         :param dict annotation: dict with string pairs.
         """
-        return self.call(dict(Type="Client",
-                              Request="SetAnnotations",
-                              Params=dict(Tag="%s-%s" % (entity_type, entity),
-                                          Pairs=annotation)))
+        return self.call(self._set_annotations_params(entity, entity_type,
+                                                      annotation))
+
+    def set_annotations_many(self, annotations, timeout=None):
+        """ Sets annotations on many entities in one batch
+
+        :param list annotations: list of (entity, entity_type, annotation)
+        :returns: list of responses or exceptions, see call_many()
+        """
+        return self.call_many([self._set_annotations_params(*a)
+                               for a in annotations], timeout)
 
     def get_annotations(self, entity, entity_type):
         """ Gets annotations """
-        return self.call(dict(Type="Client",
-                              Request="GetAnnotations",
-                              Params=dict(Tag="%s-%s" % (entity_type,
-                                                         entity))))
+        return self.call(self._get_annotations_params(entity, entity_type))
+
+    def get_annotations_many(self, entities, timeout=None):
+        """ Gets annotations of many entities in one batch
+
+        :param list entities: list of (entity, entity_type)
+        :returns: list of responses or exceptions, see call_many()
+        """
+        return self.call_many([self._get_annotations_params(*e)
+                               for e in entities], timeout)
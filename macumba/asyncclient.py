@@ -0,0 +1,242 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" asyncio Juju API client
+
+Same method surface as :class:`macumba.JujuClient`, but every API
+method is a coroutine and all requests share one websocket driven by
+the event loop, so many concurrent calls do not need a thread each.
+
+.. code::
+
+    client = AsyncJujuClient(url, password)
+    loop.run_until_complete(client.login())
+    status = loop.run_until_complete(client.status())
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+
+import websockets
+
+from macumba import (JujuClient, MacumbaError, LoginError, ServerError,
+                     ConnectionClosedError, UnknownRequestError,
+                     RequestTimeout, query_cs, creds)
+
+log = logging.getLogger('macumba.async')
+
+
+class AsyncJujuClient(JujuClient):
+
+    def __init__(self, url='wss://localhost:17070', password='pass',
+                 loop=None, start_reqid=1):
+        super().__init__(url, password)
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.ws = None
+        self.messages = {}
+        self._cur_request_id = start_reqid
+        self._reader = None
+
+    def _new_conn(self, start_reqid=1):
+        # requests go over self.ws, opened by login()
+        return None
+
+    def _ssl_context(self):
+        # the state server uses a self-signed certificate
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        ctx.verify_mode = ssl.CERT_NONE
+        return ctx
+
+    @asyncio.coroutine
+    def login(self):
+        """Connect and log in to juju websocket endpoint."""
+        try:
+            self.ws = yield from websockets.connect(self.url,
+                                                    ssl=self._ssl_context(),
+                                                    loop=self.loop)
+        except Exception as e:
+            raise LoginError(str(e))
+        self._reader = self.loop.create_task(self._read_loop())
+
+        params = dict(creds)
+        params['Params'] = dict(creds['Params'], Password=self.password)
+        try:
+            yield from self.call(params)
+        except MacumbaError as e:
+            raise LoginError(str(e))
+
+    @asyncio.coroutine
+    def reconnect(self):
+        yield from self.close()
+        yield from self.login()
+
+    @asyncio.coroutine
+    def close(self):
+        """ Closes connection to juju websocket """
+        if self.ws is not None:
+            yield from self.ws.close()
+        if self._reader is not None:
+            yield from self._reader
+            self._reader = None
+
+    def _dispatch(self, msg):
+        """Completes the future waiting on msg's RequestId."""
+        fut = self.messages.get(msg['RequestId'])
+        if fut is None or fut.done():
+            log.debug("dropping reply for unknown request "
+                      "{}".format(msg['RequestId']))
+            return
+        fut.set_result(msg)
+
+    @asyncio.coroutine
+    def _read_loop(self):
+        try:
+            while True:
+                data = yield from self.ws.recv()
+                if data is None:
+                    break
+                self._dispatch(json.loads(data))
+        except websockets.exceptions.ConnectionClosed as e:
+            log.debug("socket closed: {}".format(e))
+        finally:
+            for fut in self.messages.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionClosedError())
+
+    @asyncio.coroutine
+    def receive(self, request_id, timeout=None):
+        """receives expected message.
+
+        returns parsed response object.
+
+        if timeout is set, raises RequestTimeout after 'timeout' seconds
+        with no received message.
+        """
+        if request_id not in self.messages:
+            raise UnknownRequestError(
+                "{} not in messages. cur = {}".format(request_id,
+                                                      self._cur_request_id))
+        try:
+            res = yield from asyncio.wait_for(self.messages[request_id],
+                                              timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            raise RequestTimeout(request_id)
+        finally:
+            self.messages.pop(request_id, None)
+
+        return self._parse_response(res)
+
+    @asyncio.coroutine
+    def call(self, params, timeout=None):
+        """ Get json data from juju api daemon.
+
+        :params params: Additional params to be passed into request
+        :type params: dict
+        """
+        if self.ws is None or not self.ws.open:
+            raise ConnectionClosedError
+
+        self._cur_request_id += 1
+        request_id = self._cur_request_id
+        params['RequestId'] = request_id
+
+        self.messages[request_id] = asyncio.Future(loop=self.loop)
+        yield from self.ws.send(json.dumps(params))
+        return (yield from self.receive(request_id, timeout))
+
+    @asyncio.coroutine
+    def call_many(self, params_list, timeout=None):
+        """ Runs all requests concurrently.
+
+        :returns: list of responses in the same order as params_list.
+                  A request that failed or timed out has its exception
+                  in place of the response.
+        """
+        rvs = yield from asyncio.gather(*[self.call(params, timeout)
+                                          for params in params_list],
+                                        loop=self.loop,
+                                        return_exceptions=True)
+        for rv in rvs:
+            if isinstance(rv, Exception) and \
+               not isinstance(rv, MacumbaError):
+                raise rv
+        return rvs
+
+    @asyncio.coroutine
+    def get_watcher(self):
+        """ Returns watcher
+
+        Unlike JujuClient, a lost connection is not re-established, so
+        the watcher is never re-created.
+        """
+        return (yield from self.call(dict(Type="Client",
+                                          Request="WatchAll")))
+
+    def watcher_generation(self, watcher_id):
+        return 0
+
+    @asyncio.coroutine
+    def get_watched_tasks(self, watcher_id):
+        """ Returns a list of all watches for Id """
+        return (yield from self.call(dict(Type="AllWatcher",
+                                          Request="Next",
+                                          Id=watcher_id)))
+
+    @asyncio.coroutine
+    def add_relation(self, endpoint_a, endpoint_b):
+        """ Adds relation between units """
+        try:
+            rv = yield from self.call(self._add_relation_params(endpoint_a,
+                                                                endpoint_b))
+        except ServerError as e:
+            # do not treat pre-existing relations as exceptions:
+            if self._relation_exists(e):
+                rv = e.response
+            else:
+                raise e
+
+        return rv
+
+    @asyncio.coroutine
+    def add_relations(self, relations, timeout=None):
+        """ Adds many relations concurrently
+
+        :param list relations: list of (endpoint_a, endpoint_b)
+        :returns: list of responses or exceptions, see call_many()
+        """
+        rvs = yield from self.call_many([self._add_relation_params(a, b)
+                                         for a, b in relations], timeout)
+        return [rv.response if isinstance(rv, ServerError) and
+                self._relation_exists(rv) else rv
+                for rv in rvs]
+
+    @asyncio.coroutine
+    def deploy(self, charm, service_name, num_units=1, config_yaml="",
+               constraints=None, machine_spec=""):
+        """ Deploy a charm to an instance, see JujuClient.deploy """
+        # the charm store lookup is blocking http, keep it off the loop
+        _url = yield from self.loop.run_in_executor(None, query_cs, charm)
+        return (yield from self.call(self._deploy_params(
+            _url['charm']['url'], service_name, num_units,
+            config_yaml, constraints, machine_spec)))
+
+    @asyncio.coroutine
+    def get_config(self, service_name):
+        """ Get service configuration """
+        svc = yield from self.get_service(service_name)
+        return svc['Config']
@@ -0,0 +1,596 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Fake Juju API server
+
+Speaks the subset of the Juju 1.x websocket API used by macumba:
+Admin Login, FullStatus, AddMachines, ServiceDeploy, AddServiceUnits,
+AddRelation, ServiceSet/ServiceGet, Get/SetAnnotations and
+WatchAll/Next, against an in-memory environment.
+
+Machines start ``machine_delay`` seconds after they are added, and
+containers the same delay after their host. Units are ``pending``
+until their machine starts, ``installed`` for ``unit_delay`` seconds
+and then ``started``. AllWatcher Next blocks until something changes,
+as the real one does.
+
+.. code::
+
+    server = FakeJujuServer(password='pass', machine_delay=2)
+    server.start()
+    client = JujuClient(url=server.url, password='pass')
+    client.login()
+    ...
+    server.stop()
+"""
+
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+import uuid
+
+import websockets
+
+log = logging.getLogger('macumba.fakeserver')
+
+# juju's instance ids for maas machines are the node resource uris
+MAAS_NODE_URI = '/MAAS/api/1.0/nodes/{}/'
+
+
+class FakeJujuError(Exception):
+    """ Becomes the Error of an API response """
+
+    def __init__(self, message, code=''):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeJuju:
+
+    """ In-memory Juju environment
+    """
+
+    def __init__(self, password='pass', machine_delay=1.0, unit_delay=2.0,
+                 clock=time.time):
+        """
+        :param password: admin password checked by Login
+        :param machine_delay: seconds from AddMachines to 'started'
+        :param unit_delay: seconds a unit spends 'installed' once its
+                           machine has started
+        :param clock: time source, for tests
+        """
+        self.password = password
+        self.machine_delay = machine_delay
+        self.unit_delay = unit_delay
+        self.clock = clock
+        self.uuid = str(uuid.uuid4())
+        self.machines = OrderedDict()
+        self.services = OrderedDict()
+        self.units = OrderedDict()
+        self.relations = OrderedDict()
+        self.annotations = {}
+        self._next_machine = 0
+        # watcher id -> {(kind, key): last sent entity}
+        self._watchers = {}
+        self._next_watcher = 0
+        self.changed = None  # asyncio.Event set by the server
+        self.add_machine(dict(Jobs=['JobManageEnviron'],
+                              Constraints={}), started=True)
+
+    def _touch(self):
+        if self.changed is not None:
+            self.changed.set()
+
+    ###########################################################################
+    # Agent states
+    ###########################################################################
+    def machine_started_at(self, machine_id):
+        """ Time the machine reaches 'started' """
+        m = self.machines[machine_id]
+        if m['ParentId']:
+            parent = self.machine_started_at(m['ParentId'])
+            return max(parent, m['created']) + self.machine_delay
+        return m['created'] + self.machine_delay
+
+    def machine_state(self, machine_id):
+        if self.clock() >= self.machine_started_at(machine_id):
+            return 'started'
+        return 'pending'
+
+    def unit_started_at(self, name):
+        """ Time the unit reaches 'started' """
+        u = self.units[name]
+        up = max(self.machine_started_at(u['Machine']), u['created'])
+        return up + self.unit_delay
+
+    def unit_state(self, name):
+        now = self.clock()
+        u = self.units[name]
+        if now < max(self.machine_started_at(u['Machine']), u['created']):
+            return 'pending'
+        if now < self.unit_started_at(name):
+            return 'installed'
+        return 'started'
+
+    def next_transition(self):
+        """ Time of the next agent state change, or None """
+        now = self.clock()
+        times = [self.machine_started_at(m) for m in self.machines]
+        times += [self.unit_started_at(u) for u in self.units]
+        times += [max(self.machine_started_at(u['Machine']), u['created'])
+                  for u in self.units.values()]
+        future = [t for t in times if t > now]
+        return min(future) if future else None
+
+    ###########################################################################
+    # Model
+    ###########################################################################
+    def add_machine(self, params, started=False):
+        parent_id = params.get('ParentId', '')
+        container_type = params.get('ContainerType', '')
+        if parent_id:
+            if parent_id not in self.machines:
+                raise FakeJujuError('machine {} not found'.format(parent_id),
+                                    'not found')
+            parent = self.machines[parent_id]
+            n = parent['next_container']
+            parent['next_container'] += 1
+            machine_id = '{}/{}/{}'.format(parent_id, container_type, n)
+        else:
+            machine_id = str(self._next_machine)
+            self._next_machine += 1
+
+        constraints = params.get('Constraints') or {}
+        tags = constraints.get('tags') or []
+        if tags:
+            instance_id = MAAS_NODE_URI.format(tags[0])
+        else:
+            instance_id = 'fake-{}'.format(machine_id.replace('/', '-'))
+        created = self.clock()
+        if started:
+            created -= self.machine_delay
+        self.machines[machine_id] = dict(
+            Id=machine_id,
+            InstanceId=instance_id,
+            ParentId=parent_id,
+            Series=params.get('Series') or 'trusty',
+            Jobs=params.get('Jobs') or ['JobHostUnits'],
+            HardwareCharacteristics=dict(
+                Arch=constraints.get('arch', 'amd64'),
+                CpuCores=constraints.get('cpu-cores', 2),
+                Mem=constraints.get('mem', 4096),
+                RootDisk=constraints.get('root-disk', 40960)),
+            created=created,
+            next_container=0)
+        self._touch()
+        return machine_id
+
+    def _resolve_machine_spec(self, spec):
+        """ Machine id for a ToMachineSpec, adding containers as needed """
+        if not spec:
+            return self.add_machine({})
+        if ':' in spec:
+            container_type, parent_id = spec.split(':', 1)
+            return self.add_machine(dict(ParentId=parent_id,
+                                         ContainerType=container_type))
+        if spec not in self.machines:
+            raise FakeJujuError('machine {} not found'.format(spec),
+                                'not found')
+        return spec
+
+    def add_units(self, service_name, num_units, machine_spec=''):
+        if service_name not in self.services:
+            raise FakeJujuError('service "{}" not found'.format(
+                service_name), 'not found')
+        svc = self.services[service_name]
+        names = []
+        for _ in range(num_units):
+            machine_id = self._resolve_machine_spec(machine_spec)
+            name = '{}/{}'.format(service_name, svc['next_unit'])
+            svc['next_unit'] += 1
+            self.units[name] = dict(Name=name,
+                                    Service=service_name,
+                                    Machine=machine_id,
+                                    created=self.clock())
+            names.append(name)
+        self._touch()
+        return names
+
+    def deploy(self, params):
+        name = params['ServiceName']
+        if name in self.services:
+            raise FakeJujuError('service already exists')
+        self.services[name] = dict(Name=name,
+                                   CharmURL=params.get('CharmUrl', ''),
+                                   Config={},
+                                   Exposed=False,
+                                   next_unit=0)
+        num_units = params.get('NumUnits', 1)
+        if num_units:
+            self.add_units(name, num_units,
+                           params.get('ToMachineSpec', ''))
+        self._touch()
+
+    def add_relation(self, endpoints):
+        parsed = []
+        for ep in endpoints:
+            svc, _, relname = ep.partition(':')
+            if svc not in self.services:
+                raise FakeJujuError('service "{}" not found'.format(svc),
+                                    'not found')
+            parsed.append((svc, relname))
+        # juju infers unnamed endpoints from the charms' interfaces,
+        # name them after the other side instead
+        for i, (svc, relname) in enumerate(parsed):
+            if not relname:
+                other = parsed[1 - i][0] if len(parsed) > 1 else svc
+                parsed[i] = (svc, other)
+        key = ' '.join(sorted('{}:{}'.format(s, r) for s, r in parsed))
+        if key in self.relations:
+            raise FakeJujuError('cannot add relation "{}": '
+                                'relation already exists'.format(key))
+        self.relations[key] = parsed
+        self._touch()
+        return {svc: dict(Name=relname, Role='', Interface=relname,
+                          Scope='global')
+                for svc, relname in parsed}
+
+    ###########################################################################
+    # Views
+    ###########################################################################
+    def _machine_entity(self, machine_id):
+        m = self.machines[machine_id]
+        state = self.machine_state(machine_id)
+        addresses = []
+        if state == 'started':
+            addresses = [dict(Value='{}.fake'.format(
+                machine_id.replace('/', '-')), Type='hostname',
+                Scope='public')]
+        return dict(Id=machine_id,
+                    InstanceId=m['InstanceId'],
+                    Status=state,
+                    StatusInfo='',
+                    Life='alive',
+                    Series=m['Series'],
+                    Jobs=m['Jobs'],
+                    HardwareCharacteristics=m['HardwareCharacteristics'],
+                    Addresses=addresses,
+                    HasVote='JobManageEnviron' in m['Jobs'],
+                    WantsVote='JobManageEnviron' in m['Jobs'])
+
+    def _unit_entity(self, name):
+        u = self.units[name]
+        return dict(Name=name,
+                    Service=u['Service'],
+                    CharmURL=self.services[u['Service']]['CharmURL'],
+                    MachineId=u['Machine'],
+                    PublicAddress='{}.fake'.format(
+                        u['Machine'].replace('/', '-')),
+                    Status=self.unit_state(name),
+                    StatusInfo='',
+                    Subordinate=False)
+
+    def _service_entity(self, name):
+        svc = self.services[name]
+        return dict(Name=name,
+                    CharmURL=svc['CharmURL'],
+                    Exposed=svc['Exposed'],
+                    Life='alive',
+                    Config=svc['Config'])
+
+    def _relation_entity(self, key):
+        return dict(Key=key,
+                    Endpoints=[dict(ServiceName=svc,
+                                    Relation=dict(Name=relname,
+                                                  Interface=relname,
+                                                  Role='', Scope='global'))
+                               for svc, relname in self.relations[key]])
+
+    def entities(self):
+        """ Current AllWatcher view of the environment """
+        rv = {}
+        for machine_id in self.machines:
+            rv[('machine', machine_id)] = self._machine_entity(machine_id)
+        for name in self.services:
+            rv[('service', name)] = self._service_entity(name)
+        for name in self.units:
+            rv[('unit', name)] = self._unit_entity(name)
+        for key in self.relations:
+            rv[('relation', key)] = self._relation_entity(key)
+        return rv
+
+    def full_status(self):
+        machines = {}
+        for machine_id, m in self.machines.items():
+            e = self._machine_entity(machine_id)
+            d = dict(Id=machine_id,
+                     AgentState=e['Status'],
+                     AgentStateInfo='',
+                     InstanceId=m['InstanceId'],
+                     DNSName=(e['Addresses'] or [dict(Value='')])[0]['Value'],
+                     Hardware='arch={Arch} cpu-cores={CpuCores} '
+                              'mem={Mem}M root-disk={RootDisk}M'.format(
+                                  **m['HardwareCharacteristics']),
+                     Life='alive',
+                     Series=m['Series'],
+                     Jobs=m['Jobs'],
+                     HasVote=e['HasVote'],
+                     WantsVote=e['WantsVote'],
+                     Containers={})
+            if m['ParentId']:
+                parent = machines[m['ParentId']]
+                parent['Containers'][machine_id] = d
+                machines[machine_id] = d  # lookups only, removed below
+            else:
+                machines[machine_id] = d
+        machines = {k: v for k, v in machines.items() if '/' not in k}
+
+        services = {}
+        for name, svc in self.services.items():
+            services[name] = dict(Charm=svc['CharmURL'],
+                                  Exposed=svc['Exposed'],
+                                  Life='alive',
+                                  Networks={},
+                                  Units={},
+                                  Relations={})
+        for name, u in self.units.items():
+            services[u['Service']]['Units'][name] = dict(
+                AgentState=self.unit_state(name),
+                AgentStateInfo='',
+                Machine=u['Machine'],
+                PublicAddress='{}.fake'.format(
+                    u['Machine'].replace('/', '-')))
+        for parsed in self.relations.values():
+            names = [svc for svc, _ in parsed]
+            for svc, relname in parsed:
+                others = [n for n in names if n != svc] or [svc]
+                related = services[svc]['Relations'].setdefault(relname, [])
+                related.extend(o for o in others if o not in related)
+        return dict(EnvironmentName='fake',
+                    Machines=machines,
+                    Services=services,
+                    Networks={})
+
+    ###########################################################################
+    # AllWatcher
+    ###########################################################################
+    def watch_all(self):
+        self._next_watcher += 1
+        watcher_id = str(self._next_watcher)
+        self._watchers[watcher_id] = {}
+        return watcher_id
+
+    def next_deltas(self, watcher_id):
+        """ Deltas since the watcher's last Next, possibly empty """
+        if watcher_id not in self._watchers:
+            raise FakeJujuError('unknown watcher id', 'not found')
+        seen = self._watchers[watcher_id]
+        current = self.entities()
+        deltas = []
+        for (kind, key), entity in current.items():
+            if seen.get((kind, key)) != entity:
+                deltas.append([kind, 'change', entity])
+        for (kind, key), entity in seen.items():
+            if (kind, key) not in current:
+                deltas.append([kind, 'remove', entity])
+        self._watchers[watcher_id] = current
+        return deltas
+
+    def stop_watcher(self, watcher_id):
+        self._watchers.pop(watcher_id, None)
+
+    ###########################################################################
+    # Requests
+    ###########################################################################
+    def handle(self, msg, session):
+        """ Response for a request that doesn't block
+
+        :param dict session: per-connection state
+        :returns: Response dict
+        :raises: FakeJujuError
+        """
+        rtype = msg.get('Type')
+        request = msg.get('Request')
+        params = msg.get('Params') or {}
+
+        if rtype == 'Admin' and request == 'Login':
+            if params.get('Password') != self.password:
+                raise FakeJujuError('invalid entity name or password',
+                                    'unauthorized access')
+            session['authenticated'] = True
+            return {}
+        if not session.get('authenticated'):
+            raise FakeJujuError('not logged in', 'unauthorized access')
+
+        if rtype == 'AllWatcher' and request == 'Stop':
+            self.stop_watcher(msg.get('Id'))
+            return {}
+        if rtype != 'Client':
+            raise FakeJujuError('unknown object type "{}"'.format(rtype),
+                                'not implemented')
+
+        if request == 'FullStatus':
+            return self.full_status()
+        if request == 'EnvironmentInfo':
+            return dict(Name='fake', ProviderType='maas',
+                        DefaultSeries='trusty', UUID=self.uuid)
+        if request == 'WatchAll':
+            return dict(AllWatcherId=self.watch_all())
+        if request == 'AddMachines':
+            machines = []
+            for mp in params.get('MachineParams', []):
+                try:
+                    machines.append(dict(Machine=self.add_machine(mp),
+                                         Error=None))
+                except FakeJujuError as e:
+                    machines.append(dict(Machine='',
+                                         Error=dict(Message=str(e),
+                                                    Code=e.code)))
+            return dict(Machines=machines)
+        if request == 'ServiceDeploy':
+            self.deploy(params)
+            return {}
+        if request == 'AddServiceUnits':
+            return dict(Units=self.add_units(params['ServiceName'],
+                                             params.get('NumUnits', 1),
+                                             params.get('ToMachineSpec',
+                                                        '')))
+        if request == 'AddRelation':
+            return dict(Endpoints=self.add_relation(params['Endpoints']))
+        if request == 'ServiceSet':
+            svc = self.services.get(params.get('ServiceName'))
+            if svc is None:
+                raise FakeJujuError('service not found', 'not found')
+            svc['Config'].update(params.get('Options') or {})
+            self._touch()
+            return {}
+        if request == 'ServiceGet':
+            svc = self.services.get(params.get('ServiceName'))
+            if svc is None:
+                raise FakeJujuError('service not found', 'not found')
+            return dict(Service=svc['Name'], Charm=svc['CharmURL'],
+                        Config={k: dict(value=v)
+                                for k, v in svc['Config'].items()})
+        if request == 'SetAnnotations':
+            self.annotations.setdefault(params['Tag'], {}).update(
+                params.get('Pairs') or {})
+            return {}
+        if request == 'GetAnnotations':
+            return dict(Annotations=dict(
+                self.annotations.get(params['Tag'], {})))
+        raise FakeJujuError('no such request - method Client.{} is not '
+                            'implemented'.format(request),
+                            'not implemented')
+
+
+class FakeJujuServer:
+
+    """ Websocket server for a FakeJuju environment
+
+    Runs its own event loop, on a background thread after start().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, ssl_context=None,
+                 **kwargs):
+        """
+        :param host: address to listen on
+        :param port: port to listen on, 0 picks a free one
+        :param ssl_context: serve wss:// with this context, else ws://
+        :param kwargs: passed on to :class:`FakeJuju`
+        """
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.juju = FakeJuju(**kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.juju.changed = asyncio.Event(loop=self.loop)
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        scheme = 'wss' if self.ssl_context else 'ws'
+        return '{}://{}:{}'.format(scheme, self.host, self.port)
+
+    @property
+    def state_server(self):
+        """ host:port, as found in a jenv's state-servers """
+        return '{}:{}'.format(self.host, self.port)
+
+    @asyncio.coroutine
+    def _next(self, msg):
+        """ AllWatcher Next, blocks until there are deltas """
+        while True:
+            deltas = self.juju.next_deltas(msg.get('Id'))
+            if deltas:
+                return dict(Deltas=deltas)
+            self.juju.changed.clear()
+            wake = self.juju.next_transition()
+            timeout = 5 if wake is None else \
+                max(0, wake - self.juju.clock()) + 0.01
+            try:
+                yield from asyncio.wait_for(self.juju.changed.wait(),
+                                            timeout, loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+
+    @asyncio.coroutine
+    def _reply(self, ws, msg, session):
+        reply = dict(RequestId=msg.get('RequestId'), Response={})
+        try:
+            if msg.get('Type') == 'AllWatcher' and \
+               msg.get('Request') == 'Next' and session.get('authenticated'):
+                reply['Response'] = yield from self._next(msg)
+            else:
+                reply['Response'] = self.juju.handle(msg, session)
+        except FakeJujuError as e:
+            reply['Error'] = str(e)
+            reply['ErrorCode'] = e.code
+        except Exception as e:
+            log.exception("error handling {}".format(msg))
+            reply['Error'] = str(e)
+            reply['ErrorCode'] = ''
+        try:
+            yield from ws.send(json.dumps(reply))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    @asyncio.coroutine
+    def _handler(self, ws, path):
+        session = {}
+        while True:
+            try:
+                data = yield from ws.recv()
+            except websockets.exceptions.ConnectionClosed:
+                break
+            if data is None:
+                break
+            # every request runs on its own so a blocked Next doesn't
+            # hold up the connection
+            self.loop.create_task(self._reply(ws, json.loads(data),
+                                              session))
+
+    def start(self):
+        """ Listens and serves on a background thread """
+        self._server = self.loop.run_until_complete(
+            websockets.serve(self._handler, self.host, self.port,
+                             ssl=self.ssl_context, loop=self.loop))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def call(self, func, *args):
+        """ Runs func on the server loop, for inspecting state """
+        done = threading.Event()
+        rv = []
+
+        def _run():
+            rv.append(func(*args))
+            done.set()
+        self.loop.call_soon_threadsafe(_run)
+        done.wait()
+        return rv[0]
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self._server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.run_until_complete(self._server.wait_closed())
+        self.loop.close()
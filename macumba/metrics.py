@@ -0,0 +1,215 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, float('inf')]
+
+# stats key for replies whose request type isn't known
+UNKNOWN_REQUEST = '<unknown>'
+
+
+class RequestStats:
+
+    """ Counters for one API Request type """
+
+    def __init__(self):
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.late_replies = 0
+        self.expired = 0
+        self.interrupted = 0
+        self.replayed = 0
+        self.in_flight = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.max_bytes_received = 0
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile latency,
+        or None with no completed requests.
+        """
+        if self.completed == 0:
+            return None
+        rank = p / 100.0 * self.completed
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def as_dict(self):
+        mean = None
+        if self.completed:
+            mean = self.latency_total / self.completed
+        return dict(sent=self.sent,
+                    completed=self.completed,
+                    errors=self.errors,
+                    timeouts=self.timeouts,
+                    late_replies=self.late_replies,
+                    expired=self.expired,
+                    interrupted=self.interrupted,
+                    replayed=self.replayed,
+                    in_flight=self.in_flight,
+                    latency_mean=mean,
+                    latency_max=self.latency_max,
+                    latency_p50=self.percentile(50),
+                    latency_p95=self.percentile(95),
+                    latency_buckets=[
+                        [str(b), c] for b, c in zip(LATENCY_BUCKETS,
+                                                    self.latency_buckets)],
+                    bytes_sent=self.bytes_sent,
+                    bytes_received=self.bytes_received,
+                    max_bytes_received=self.max_bytes_received)
+
+
+class ClientMetrics:
+
+    """ Per-Request-type counters for a :class:`macumba.JujuClient`
+
+    Tracks how many of each Request were sent and answered, how many
+    are in flight, errors, timeouts, expired requests, dropped late
+    replies, requests interrupted and replayed by a reconnect, a latency
+    histogram and payload sizes, plus reconnects. Safe to update from
+    any thread.
+
+    Query in-process with stats() / snapshot(), or write a JSON
+    snapshot with dump().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = {}
+        self.reconnects = 0
+
+    def _stats(self, request):
+        stats = self.requests.get(request)
+        if stats is None:
+            stats = self.requests[request] = RequestStats()
+        return stats
+
+    def sent(self, request, size):
+        """ Records a request of type request, size bytes, going out """
+        with self._lock:
+            stats = self._stats(request)
+            stats.sent += 1
+            stats.in_flight += 1
+            stats.bytes_sent += size
+
+    def completed(self, request, latency, size, error=False):
+        """ Records the reply to a request
+
+        :param latency: seconds from send to reply
+        :param size: reply size in bytes
+        :param error: True if the reply was an error
+        """
+        with self._lock:
+            stats = self._stats(request)
+            stats.completed += 1
+            stats.in_flight = max(0, stats.in_flight - 1)
+            if error:
+                stats.errors += 1
+            stats.latency_total += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.latency_buckets[i] += 1
+                    break
+            stats.bytes_received += size
+            stats.max_bytes_received = max(stats.max_bytes_received, size)
+
+    def timed_out(self, request):
+        """ Records a request that got no reply in time """
+        with self._lock:
+            stats = self._stats(request)
+            stats.timeouts += 1
+            stats.in_flight = max(0, stats.in_flight - 1)
+
+    def late_reply(self, request):
+        """ Records a reply that arrived after its request timed out or
+        expired, and was dropped. request is None if it is not known.
+        """
+        with self._lock:
+            self._stats(request or UNKNOWN_REQUEST).late_replies += 1
+
+    def expired(self, request):
+        """ Records a request dropped because nothing waited for its
+        reply before its deadline
+        """
+        with self._lock:
+            stats = self._stats(request or UNKNOWN_REQUEST)
+            stats.expired += 1
+            stats.in_flight = max(0, stats.in_flight - 1)
+
+    def interrupted(self, request):
+        """ Records a request whose connection was lost before its reply
+        """
+        with self._lock:
+            stats = self._stats(request)
+            stats.interrupted += 1
+            stats.in_flight = max(0, stats.in_flight - 1)
+
+    def replayed(self, request):
+        """ Records an interrupted request sent again after a reconnect """
+        with self._lock:
+            self._stats(request).replayed += 1
+
+    def reconnected(self):
+        with self._lock:
+            self.reconnects += 1
+
+    def stats(self, request):
+        """ Returns the :class:`RequestStats` for request, or None """
+        return self.requests.get(request)
+
+    def in_flight(self):
+        """ Requests sent and not yet answered or timed out """
+        with self._lock:
+            return sum(s.in_flight for s in self.requests.values())
+
+    def snapshot(self):
+        """ Returns every counter as a JSON-serializable dict """
+        with self._lock:
+            elapsed = time.time() - self.started_at
+            requests = {r: s.as_dict() for r, s in self.requests.items()}
+            total = sum(s.completed for s in self.requests.values())
+            return dict(elapsed=elapsed,
+                        reconnects=self.reconnects,
+                        completed=total,
+                        throughput=total / elapsed if elapsed else None,
+                        requests=requests)
+
+    def dump(self, filename):
+        """ Writes snapshot() to filename as JSON """
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.requests = {}
+            self.reconnects = 0
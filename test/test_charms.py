@@ -20,6 +20,7 @@ import logging
 import os
 from importlib import import_module
 import pkgutil
+from tempfile import TemporaryDirectory
 import unittest
 from unittest.mock import ANY, MagicMock, patch
 
@@ -33,6 +34,9 @@ from cloudinstall.charms.glance import CharmGlance
 from cloudinstall.charms.swift import CharmSwift
 from cloudinstall.charms.mysql import CharmMysql
 from cloudinstall.charms.ntp import CharmNtp
+from cloudinstall.journal import DeployJournal, JournalStep
+
+from macumba import ServerError
 
 log = logging.getLogger('cloudinstall.test_charms')
 
@@ -138,10 +142,10 @@ class TestCharmRelations(unittest.TestCase):
         self.assertNotIn(self.unexpected_relation, valid_relations)
 
     def test_watch_relations_exception(self):
-        """ Verifies watch_relations croaks on failed add_relation """
+        """ Verifies watch_relations croaks on failed add_relations """
         juju = self.mock_jujuclient
 
-        juju.add_relation.side_effect = Exception('Failed to add relations')
+        juju.add_relations.side_effect = Exception('Failed to add relations')
 
         charm_q = CharmQueue(
             ui=self.mock_ui,
@@ -149,7 +153,36 @@ class TestCharmRelations(unittest.TestCase):
             juju=juju,
             juju_state=self.mock_juju_state,
             deployed_charms=self.deployed_charms)
+        charm_q.relation_backoff = 0
         self.assertRaises(Exception, charm_q.watch_relations)
+        self.assertEqual(juju.add_relations.call_count,
+                         charm_q.relation_attempts)
+
+    def test_watch_relations_batch_error(self):
+        """ Verifies watch_relations croaks on a relation that keeps failing
+        """
+        juju = self.mock_jujuclient
+        err = ServerError('boom', {'Error': 'boom'})
+        juju.add_relations.side_effect = [[{}, err, {}, {}]] + \
+            [[err]] * (self.charm.relation_attempts - 1)
+        self.charm.relation_backoff = 0
+
+        self.assertRaises(ServerError, self.charm.watch_relations)
+        juju.add_relations.assert_any_call(self.expected_relation)
+        juju.add_relations.assert_called_with([self.expected_relation[1]])
+
+    def test_watch_relations_retries_failed(self):
+        """ Verifies only failed relations are re-sent, without repeats """
+        juju = self.mock_jujuclient
+        err = ServerError('boom', {'Error': 'boom'})
+        juju.add_relations.side_effect = [[{}, err, {}, {}], [{}]]
+        self.charm.relation_backoff = 0
+        self.charm.deployed_charms.append(CharmGlance)
+
+        self.charm.watch_relations()
+        self.assertEqual(juju.add_relations.call_args_list[0][0][0],
+                         self.expected_relation)
+        juju.add_relations.assert_called_with([self.expected_relation[1]])
 
 
 class TestCharmQueuePostProc(unittest.TestCase):
@@ -179,6 +212,57 @@ class TestCharmQueuePostProc(unittest.TestCase):
         for c in charms:
             self.assertTrue(isinstance(c, CharmBase))
 
+    def test_watch_post_proc_order_and_retry(self):
+        """ Verifies post_proc_depends ordering and per-charm retry """
+        calls = []
+
+        def fake_charm(name, results, post_proc_depends=[]):
+            c = MagicMock(name=name, charm_name=name, deploy_priority=1,
+                          post_proc_depends=post_proc_depends)
+            c.post_proc.side_effect = lambda: calls.append(name) or \
+                results.pop(0)
+            return c
+
+        gss = fake_charm('glance-simplestreams-sync', [True, False])
+        swift = fake_charm('swift-storage', [False],
+                           ['glance-simplestreams-sync'])
+        broken = fake_charm('broken', [])  # raises, not re-tried
+        self.charm._charm_classes = MagicMock(
+            return_value=[swift, gss, broken])
+        self.charm.post_proc_backoff = 0
+
+        self.charm.watch_post_proc()
+        self.assertEqual(calls.count('broken'), 1)
+        self.assertEqual([c for c in calls if c != 'broken'],
+                         ['glance-simplestreams-sync',
+                          'glance-simplestreams-sync',
+                          'swift-storage'])
+        self.mock_config.setopt.assert_called_with('deploy_complete', True)
+
+    def test_post_proc_done_set_on_failure(self):
+        """ post_proc_done is set even when post processing raises """
+        self.charm._charm_classes = MagicMock(side_effect=Exception('boom'))
+        self.assertRaises(Exception, self.charm.watch_post_proc)
+        self.assertTrue(self.charm.post_proc_done.is_set())
+        self.assertFalse(self.mock_config.setopt.called)
+
+    def test_journaled_post_proc_skipped(self):
+        """ post_procs finished before a restart are not run again """
+        done = MagicMock(charm_name='done', deploy_priority=1,
+                         post_proc_depends=[])
+        todo = MagicMock(charm_name='todo', deploy_priority=1,
+                         post_proc_depends=[])
+        todo.post_proc.return_value = False
+        self.charm._charm_classes = MagicMock(return_value=[done, todo])
+        with TemporaryDirectory() as tmpdir:
+            journal = DeployJournal(os.path.join(tmpdir, 'journal'))
+            journal.record(JournalStep.POST_PROC_DONE, 'done')
+            self.charm.journal = journal
+            self.charm.watch_post_proc()
+            self.assertTrue(journal.done(JournalStep.POST_PROC_DONE, 'todo'))
+        self.assertEqual(done.post_proc.call_count, 0)
+        self.assertEqual(todo.post_proc.call_count, 1)
+
 
 class TestCharmPlugin(unittest.TestCase):
 
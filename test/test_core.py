@@ -16,12 +16,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import os
+from tempfile import TemporaryDirectory
+import threading
 import unittest
 from unittest.mock import MagicMock, patch
 
 from cloudinstall.config import Config
 from cloudinstall.core import Controller
+from cloudinstall.journal import (DeployJournal, JournalScopeUnknown,
+                                  JournalStep)
 from cloudinstall.juju import JujuState
+from macumba import MacumbaError
 
 log = logging.getLogger('cloudinstall.test_core')
 
@@ -49,26 +55,126 @@ class WaitForDeployedServicesReadyCoreTestCase(unittest.TestCase):
     def test_validate_services_ready(self):
         """ Verifies wait_for_deployed_services_ready
 
-        time.sleep should not be called here as all services
-        are in a started state.
+        Returns straight away as all services are in a started state.
         """
         self.dc.juju_state.all_agents_started.return_value = True
+        self.dc.juju_state.subscribe = MagicMock()
+        self.dc.juju_state.unsubscribe = MagicMock()
 
-        with patch('cloudinstall.core.time.sleep') as mock_sleep:
-            self.dc.wait_for_deployed_services_ready()
-        self.assertEqual(len(mock_sleep.mock_calls), 0)
+        self.dc.wait_for_deployed_services_ready()
+        self.assertEqual(self.dc.juju_state.all_agents_started.call_count, 1)
+        self.dc.juju_state.unsubscribe.assert_called_once_with(
+            self.dc.juju_state.subscribe.call_args[0][0])
 
     def test_validate_services_some_ready(self):
         """ Verifies wait_for_deployed_services_ready against some of the
         services in started state
 
-        Here we test if time.sleep was called twice due to some services
-        being in an installing and allocating state.
+        Services are only re-checked when juju status changes.
         """
         self.dc.juju_state.all_agents_started.side_effect = [
-            False, False, True, True]
+            False, False, True]
+        self.dc.juju_state.get_agent_states = MagicMock(
+            return_value=[('nova-compute', 'pending')])
+        unsubscribed = threading.Event()
 
-        with patch('cloudinstall.core.time.sleep') as mock_sleep:
-            self.dc.wait_for_deployed_services_ready()
-        print(mock_sleep.mock_calls)
-        self.assertEqual(len(mock_sleep.mock_calls), 2)
+        def publish(callback):
+            while not unsubscribed.wait(0.01):
+                callback(None)
+
+        self.dc.juju_state.subscribe = lambda cb: threading.Thread(
+            target=publish, args=(cb,)).start()
+        self.dc.juju_state.unsubscribe = lambda cb: unsubscribed.set()
+
+        self.dc.wait_for_deployed_services_ready()
+        self.assertEqual(self.dc.juju_state.all_agents_started.call_count, 3)
+        self.assertTrue(unsubscribed.is_set())
+
+
+class AddMachinesToJujuSingleTestCase(unittest.TestCase):
+
+    """ Tests core.add_machines_to_juju_single batches its requests
+    """
+
+    def setUp(self):
+        self.conf = Config({})
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+        self.dc.juju = MagicMock(name='juju')
+        self.dc.juju_state = MagicMock(name='juju_state')
+        self.dc.juju_state.machines.return_value = [
+            MagicMock(machine_id='1')]
+        self.dc.juju.get_annotations_many.return_value = [
+            {'Annotations': {'instance_id': 'controller'}}]
+        self.pending = [MagicMock(instance_id=iid, constraints={})
+                        for iid in ['controller', 'a', 'b']]
+        self.dc.placement_controller = MagicMock(name='pc')
+        self.dc.placement_controller.machines_pending.return_value = \
+            self.pending
+        self.dc.juju.set_annotations_many.side_effect = lambda a: [
+            {} for _ in a]
+
+    def test_one_request_per_batch(self):
+        self.dc.juju.add_machines.return_value = {'Machines': [
+            {'Machine': '2', 'Error': None},
+            {'Machine': '3', 'Error': None}]}
+        self.dc.add_machines_to_juju_single()
+
+        self.assertEqual(len(self.dc.juju.add_machines.call_args[0][0]), 2)
+        self.dc.juju.set_annotations_many.assert_called_once_with(
+            [('2', 'machine', {'instance_id': 'a'}),
+             ('3', 'machine', {'instance_id': 'b'})])
+        self.assertEqual(self.dc.juju_m_idmap,
+                         {'controller': '1', 'a': '2', 'b': '3'})
+        self.assertEqual([m.machine_id for m in self.pending],
+                         ['1', '2', '3'])
+
+    def test_error_after_annotating_added(self):
+        self.dc.juju.add_machines.return_value = {'Machines': [
+            {'Machine': '', 'Error': {'Message': 'no'}},
+            {'Machine': '3', 'Error': None}]}
+        with self.assertRaises(Exception):
+            self.dc.add_machines_to_juju_single()
+        self.dc.juju.set_annotations_many.assert_called_once_with(
+            [('3', 'machine', {'instance_id': 'b'})])
+
+
+class JournalScopeTestCase(unittest.TestCase):
+
+    """ Tests the deployment journal is tied to the juju environment
+    """
+
+    def setUp(self):
+        self.dc = Controller(ui=MagicMock(name='ui'), config=Config({}),
+                             loop=MagicMock(name='loop'))
+        self.dc.juju = MagicMock(name='juju', url='wss://10.0.0.1:17070')
+
+    def test_environment_uuid(self):
+        self.dc.juju.info.return_value = {'UUID': 'env-1'}
+        self.assertEqual(self.dc.journal_scope(), 'env-1')
+
+    def test_state_server_without_uuid(self):
+        self.dc.juju.info.return_value = {}
+        self.assertEqual(self.dc.journal_scope(), 'wss://10.0.0.1:17070')
+
+    @patch('cloudinstall.core.time.sleep')
+    def test_info_retried(self, mock_sleep):
+        self.dc.juju.info.side_effect = [MacumbaError('boom'),
+                                         {'UUID': 'env-1'}]
+        self.assertEqual(self.dc.journal_scope(), 'env-1')
+        self.assertEqual(self.dc.juju.info.call_count, 2)
+
+    @patch('cloudinstall.core.time.sleep')
+    def test_unknown_scope_keeps_journal(self, mock_sleep):
+        self.dc.juju.info.side_effect = MacumbaError('boom')
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'deploy-journal')
+            DeployJournal(filename, scope='env-1').record(
+                JournalStep.CHARM_DEPLOYED, 'mysql')
+            with self.assertRaises(JournalScopeUnknown):
+                DeployJournal(filename, scope=self.dc.journal_scope())
+            self.assertEqual(self.dc.juju.info.call_count,
+                             self.dc.journal_scope_attempts)
+            self.assertEqual(os.listdir(tmpdir), ['deploy-journal'])
+            self.assertTrue(DeployJournal(filename, scope='env-1').done(
+                JournalStep.CHARM_DEPLOYED, 'mysql'))
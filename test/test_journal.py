@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# tests journal.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+from tempfile import TemporaryDirectory
+import unittest
+
+from cloudinstall.journal import DeployJournal, JournalStep, relation_key
+
+log = logging.getLogger('cloudinstall.test_journal')
+
+
+class DeployJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'deploy-journal')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_replay(self):
+        journal = DeployJournal(self.filename)
+        self.assertFalse(journal.done(JournalStep.HOSTNAME_SET, 1))
+        journal.record(JournalStep.HOSTNAME_SET, 1)
+        journal.record(JournalStep.MACHINE_ADDED, 'i-1', '2')
+        journal.record(JournalStep.MACHINE_ADDED, 'i-1', '2')
+
+        replayed = DeployJournal(self.filename)
+        self.assertTrue(replayed.done(JournalStep.HOSTNAME_SET, '1'))
+        self.assertEqual(replayed.data(JournalStep.MACHINE_ADDED, 'i-1'),
+                         '2')
+        self.assertEqual(replayed.keys(JournalStep.MACHINE_ADDED), ['i-1'])
+        with open(self.filename) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_torn_line_ignored(self):
+        journal = DeployJournal(self.filename)
+        journal.record(JournalStep.CHARM_DEPLOYED, 'mysql')
+        with open(self.filename, 'a') as f:
+            f.write('{"step": "charm-depl')
+
+        replayed = DeployJournal(self.filename)
+        self.assertTrue(replayed.done(JournalStep.CHARM_DEPLOYED, 'mysql'))
+        replayed.record(JournalStep.CHARM_DEPLOYED, 'keystone')
+        again = DeployJournal(self.filename)
+        self.assertTrue(again.done(JournalStep.CHARM_DEPLOYED, 'keystone'))
+
+    def _archived(self):
+        return [f for f in os.listdir(self.tmpdir.name)
+                if f.startswith('deploy-journal.')]
+
+    def test_other_environment_set_aside(self):
+        journal = DeployJournal(self.filename, scope='env-1')
+        journal.record(JournalStep.CHARM_DEPLOYED, 'mysql')
+        self.assertTrue(DeployJournal(self.filename, scope='env-1').done(
+            JournalStep.CHARM_DEPLOYED, 'mysql'))
+
+        other = DeployJournal(self.filename, scope='env-2')
+        self.assertFalse(other.done(JournalStep.CHARM_DEPLOYED, 'mysql'))
+        self.assertFalse(os.path.exists(self.filename))
+        archived = self._archived()
+        self.assertEqual(len(archived), 1)
+        with open(os.path.join(self.tmpdir.name, archived[0])) as f:
+            self.assertIn('mysql', f.read())
+        other.record(JournalStep.CHARM_DEPLOYED, 'keystone')
+        self.assertEqual(DeployJournal(self.filename, scope='env-2').keys(
+            JournalStep.CHARM_DEPLOYED), ['keystone'])
+
+    def test_unscoped_journal_set_aside(self):
+        DeployJournal(self.filename).record(JournalStep.HOSTNAME_SET, 1)
+        journal = DeployJournal(self.filename, scope='env-1')
+        self.assertFalse(journal.done(JournalStep.HOSTNAME_SET, 1))
+        self.assertEqual(len(self._archived()), 1)
+
+    def test_relation_key(self):
+        self.assertEqual(relation_key(('a:x', 'b:x')),
+                         relation_key(('b:x', 'a:x')))
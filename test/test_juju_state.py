@@ -16,12 +16,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import threading
 import unittest
-from unittest.mock import MagicMock, PropertyMock
+from unittest.mock import MagicMock, PropertyMock, patch
 
 from cloudinstall.config import Config
-from cloudinstall.juju import JujuState
+from cloudinstall.juju import JujuState, JujuWatchState, status_diff
+from cloudinstall.machine import Machine
 from cloudinstall.service import Service
+from cloudinstall.utils import wait_until
+from macumba import MacumbaError
 
 log = logging.getLogger('cloudinstall.test_core')
 
@@ -55,11 +59,16 @@ class JujuStateTestCase(unittest.TestCase):
                     {'Units': {'fake4': {'AgentState': 'allocating'}}}),
         ]
 
+    def patch_services(self, services):
+        p = patch.object(JujuState, 'services', new_callable=PropertyMock,
+                         return_value=services)
+        p.start()
+        self.addCleanup(p.stop)
+
     def test_services_ready(self):
         """ Verifies all ready services  """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_ready)
-        type(juju_state).services = services
+        self.patch_services(self.services_ready)
 
         not_ready = [(a, b) for a, b in juju_state.get_agent_states()
                      if b != 'started']
@@ -69,9 +78,267 @@ class JujuStateTestCase(unittest.TestCase):
     def test_some_services_ready(self):
         """ Verifies some ready services == not_ready list """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_some_ready)
-        type(juju_state).services = services
+        self.patch_services(self.services_some_ready)
         not_ready = [(a, b) for a, b in juju_state.get_agent_states()
                      if b != 'started']
         self.assertEqual(len(not_ready), 2)
         self.assertFalse(juju_state.all_agents_started())
+
+
+class JujuStateIndexTestCase(unittest.TestCase):
+
+    """ Tests JujuState lookups are served from per-snapshot indexes
+    """
+
+    def setUp(self):
+        self.status = {
+            'Machines': {
+                '0': {'InstanceId': 'i-0'},
+                '1': {'InstanceId': 'i-1',
+                      'Containers': {'1/lxc/0': {'InstanceId': 'c-0'}}}},
+            'Services': {
+                'mysql': {'Units': {'mysql/0': {'Machine': '1/lxc/0'}}}}}
+        self.juju = MagicMock()
+        self.juju.status.return_value = self.status
+        self.juju_state = JujuState(juju=self.juju)
+
+    def test_lookups(self):
+        js = self.juju_state
+        self.assertEqual(js.machine('1').instance_id, 'i-1')
+        self.assertEqual(js.machine('0').machine_id, -1)
+        self.assertIsNone(js.machine_or_container('0'))
+        self.assertEqual(js.machine_or_container('1/lxc/0').instance_id,
+                         'c-0')
+        self.assertEqual(js.machine_by_instance_id('c-0').machine_id,
+                         '1/lxc/0')
+        self.assertEqual(js.base_machine('1/lxc/0').machine_id, '1')
+        self.assertEqual(js.unit('mysql/0').machine_id, '1/lxc/0')
+        self.assertEqual(js.service('nope').service_name, 'nope')
+
+    def test_index_reused_per_snapshot(self):
+        js = self.juju_state
+        m = js.machine('1')
+        self.assertIs(m, js.machine('1'))
+        js.invalidate_status_cache()
+        self.juju.status.return_value = dict(self.status)
+        self.assertIsNot(m, js.machine('1'))
+
+
+class JujuStateStatusCacheTestCase(unittest.TestCase):
+
+    """ Tests JujuState status caching across threads
+    """
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.juju = MagicMock()
+        self.snapshots = [{'Machines': {}}, {'Machines': {'1': {}}}]
+
+        def slow_status():
+            self.release.wait(5)
+            return self.snapshots.pop(0)
+        self.juju.status.side_effect = slow_status
+        self.juju_state = JujuState(juju=self.juju, cache_ttl=60)
+
+    def test_single_flight(self):
+        """ concurrent callers share one FullStatus request """
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.juju_state.status()))
+            for _ in range(4)]
+        for t in threads:
+            t.start()
+        self.release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(self.juju.status.call_count, 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_stale_while_revalidate(self):
+        self.release.set()
+        first = self.juju_state.status()
+        self.release.clear()
+        self.juju_state.invalidate_status_cache()
+        self.assertIs(self.juju_state.status(allow_stale=True), first)
+        self.release.set()
+        second = self.juju_state.status()
+        self.assertEqual(second, {'Machines': {'1': {}}})
+        self.assertEqual(self.juju.status.call_count, 2)
+
+    @patch('cloudinstall.utils._async_exception_callback')
+    def test_stale_refresh_error_logged(self, mock_callback):
+        self.release.set()
+        first = self.juju_state.status()
+        self.juju.status.side_effect = MacumbaError('connection lost')
+        self.juju_state.invalidate_status_cache()
+        logged = threading.Event()
+        with patch('cloudinstall.juju.log') as mock_log:
+            mock_log.exception.side_effect = lambda *a: logged.set()
+            self.assertIs(self.juju_state.status(allow_stale=True), first)
+            self.assertTrue(logged.wait(5))
+        with self.juju_state._status_cond:
+            while self.juju_state._fetching:
+                self.juju_state._status_cond.wait(5)
+            self.assertTrue(self.juju_state._stale)
+        self.assertFalse(mock_callback.called)
+
+
+class JujuWatchStateTestCase(unittest.TestCase):
+
+    """ Tests JujuWatchState builds status from watcher deltas
+    """
+
+    def setUp(self):
+        self.juju_state = JujuWatchState(juju=MagicMock())
+        self.juju_state.apply_deltas([
+            ['machine', 'change',
+             {'Id': '1', 'InstanceId': 'i-1', 'Status': 'started',
+              'HardwareCharacteristics': {'Arch': 'amd64', 'CpuCores': 2,
+                                          'Mem': 2048, 'RootDisk': 8192},
+              'Addresses': [{'Value': '10.0.0.2', 'Scope': 'public'}]}],
+            ['machine', 'change',
+             {'Id': '1/lxc/0', 'InstanceId': 'c-0', 'Status': 'pending'}],
+            ['service', 'change', {'Name': 'keystone', 'Exposed': False}],
+            ['service', 'change', {'Name': 'mysql', 'Exposed': False}],
+            ['unit', 'change',
+             {'Name': 'keystone/0', 'Service': 'keystone',
+              'MachineId': '1/lxc/0', 'Status': 'installing'}],
+            ['relation', 'change',
+             {'Key': 'keystone:shared-db mysql:shared-db',
+              'Endpoints': [
+                  {'ServiceName': 'keystone',
+                   'Relation': {'Name': 'shared-db'}},
+                  {'ServiceName': 'mysql',
+                   'Relation': {'Name': 'shared-db'}}]}],
+        ])
+
+    def test_machines(self):
+        machines = self.juju_state.machines()
+        self.assertEqual(len(machines), 1)
+        m = self.juju_state.machine('1')
+        self.assertEqual(m.instance_id, 'i-1')
+        self.assertEqual(m.arch, 'amd64')
+        self.assertEqual(m.dns_name, '10.0.0.2')
+        c = self.juju_state.machine_or_container('1/lxc/0')
+        self.assertEqual(c.agent_state, 'pending')
+
+    def test_services(self):
+        svc = self.juju_state.service('keystone')
+        self.assertEqual(svc.units[0].agent_state, 'installing')
+        self.assertEqual(svc.relation('shared-db').charms, ['mysql'])
+
+    def test_remove_delta(self):
+        self.juju_state.apply_deltas([
+            ['unit', 'remove', {'Name': 'keystone/0',
+                                'Service': 'keystone'}]])
+        self.assertEqual(self.juju_state.service('keystone').units, ())
+
+    def test_reset_deltas(self):
+        "a re-created watcher's first deltas replace the model"
+        self.juju_state.apply_deltas([
+            ['service', 'change', {'Name': 'mysql', 'Exposed': False}]],
+            reset=True)
+        self.assertEqual(self.juju_state.machines(), [])
+        self.assertEqual(list(self.juju_state.status()['Services']),
+                         ['mysql'])
+
+
+class StatusDiffTestCase(unittest.TestCase):
+
+    """ Tests status snapshot diffing and change publishing
+    """
+
+    def setUp(self):
+        self.old = {
+            'Machines': {'1': {'AgentState': 'pending'}},
+            'Services': {'mysql': {'Units': {
+                'mysql/0': {'AgentState': 'pending'}}}}}
+        self.new = {
+            'Machines': {'1': {'AgentState': 'started',
+                               'Containers': {
+                                   '1/lxc/0': {'AgentState': 'pending'}}}},
+            'Services': {
+                'mysql': {'Units': {'mysql/0': {'AgentState': 'started'}},
+                          'Relations': {'shared-db': ['keystone']}},
+                'keystone': {'Units': {
+                    'keystone/0': {'AgentState': 'error'}}}}}
+
+    def test_diff(self):
+        diff = status_diff(self.old, self.new)
+        self.assertEqual(diff.machines_added, ['1/lxc/0'])
+        self.assertEqual(diff.machine_state_changes,
+                         [('1', 'pending', 'started')])
+        self.assertEqual(diff.units_added, ['keystone/0'])
+        self.assertEqual(diff.units_started, ['mysql/0'])
+        self.assertEqual(diff.relations_added,
+                         [('mysql', 'shared-db', 'keystone')])
+        self.assertTrue(status_diff(self.new, self.new).is_empty())
+
+    def test_subscribers_get_changes(self):
+        juju = MagicMock()
+        juju.status.side_effect = [self.old, self.new]
+        juju_state = JujuState(juju=juju)
+        diffs = []
+        juju_state.subscribe(diffs.append)
+        juju_state.status()
+        juju_state.status(refresh=True)
+        self.assertEqual(len(diffs), 2)
+        self.assertEqual(diffs[0].units_added, ['mysql/0'])
+        self.assertEqual(diffs[1].units_started, ['mysql/0'])
+        juju_state.unsubscribe(diffs.append)
+
+    def test_wait_until_polls_status(self):
+        statuses = [self.old, self.new]
+        juju = MagicMock()
+        juju.status.side_effect = lambda: statuses.pop(0) if len(
+            statuses) > 1 else statuses[0]
+        juju_state = JujuState(juju=juju, poll_interval=0.01)
+        self.assertTrue(wait_until(
+            lambda: juju_state.machine('1').agent_state == 'started',
+            juju_state, timeout=5))
+        self.assertEqual(juju_state._subscribers, [])
+
+    def test_wait_until_timeout(self):
+        juju = MagicMock()
+        juju.status.return_value = self.old
+        juju_state = JujuState(juju=juju, poll_interval=0.01)
+        self.assertFalse(wait_until(lambda: False, juju_state, timeout=0.05))
+        self.assertEqual(juju_state._subscribers, [])
+
+
+class ModelTestCase(unittest.TestCase):
+
+    """ Tests Machine and Service parse once and cache collections
+    """
+
+    def test_machine_hardware(self):
+        m = Machine('1', {'Hardware': 'arch=amd64 cpu-cores=4 '
+                          'mem=2048M root-disk=8192M',
+                          'Containers': {'1/lxc/0': {}}})
+        self.assertEqual(m.arch, 'amd64')
+        self.assertEqual(m.cpu_cores, 4)
+        self.assertEqual(m.mem, 2048)
+        self.assertEqual(m.root_disk, 8192)
+        self.assertEqual(m.storage, '8.0G')
+        self.assertIs(m.containers, m.containers)
+        self.assertEqual(m.container('1/lxc/0').machine_id, '1/lxc/0')
+        self.assertRaises(AttributeError, setattr, m, 'extra', 1)
+
+    def test_machine_no_hardware(self):
+        m = Machine('2', {})
+        self.assertIsNone(m.arch)
+        self.assertIsNone(m.cpu_cores)
+        self.assertIsNone(m.mem)
+        self.assertEqual(m.storage, 'N/A')
+        self.assertEqual(Machine('3', {'Hardware': 'mem=2G'}).mem, 2048)
+        self.assertEqual(m.containers, ())
+
+    def test_service_units_cached(self):
+        svc = Service('mysql', {'Units': {'mysql/0': {}},
+                                'Relations': {'shared-db': ['keystone']}})
+        self.assertIs(svc.units, svc.units)
+        self.assertEqual(svc.unit('mysql/0').unit_name, 'mysql/0')
+        self.assertEqual(svc.relation('shared-db').charms, ['keystone'])
+        self.assertIsInstance(svc.units, tuple)
+        self.assertEqual(Service('empty', {'Units': None}).units, ())
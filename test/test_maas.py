@@ -17,10 +17,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import importlib
 import os
+import socket
 import unittest
-from unittest.mock import MagicMock, PropertyMock
+from unittest.mock import MagicMock, PropertyMock, patch
+import asyncio
 import json
+import requests
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+from requests.packages.urllib3.exceptions import MaxRetryError
+import threading
+import time
+
+import maasclient
+from maasclient import MaasClient
+from maasclient.asyncclient import AsyncMaasClient
+from maasclient.auth import MaasAuth
+from maasclient.fakeserver import FakeMaasServer
 
 from cloudinstall.maas import (MaasMachine, MaasMachineStatus, MaasState,
                                satisfies)
@@ -160,3 +174,290 @@ class MaasStateTestCase(unittest.TestCase):
         s = MaasState(self.mock_client_oneready)
         ready_machines = s.machines(MaasMachineStatus.READY)
         self.assertEqual(len(ready_machines), 1)
+
+    def test_subscribers_get_status_changes(self):
+        declared = self.mock_client_onedeclared.nodes
+        ready = self.mock_client_oneready.nodes
+        client = MagicMock()
+        type(client).nodes = PropertyMock(
+            side_effect=[declared, declared, ready])
+        s = MaasState(client, poll_interval=60)
+        published = []
+        s.subscribe(published.append)
+        s.nodes()
+        s.invalidate_nodes_cache()
+        s.nodes()
+        s.invalidate_nodes_cache()
+        s.nodes()
+        s.unsubscribe(published.append)
+        self.assertEqual(published, [declared, ready])
+
+
+class MaasStateIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [
+            {'hostname': 'juju-bootstrap.maas', 'system_id': 'b',
+             'resource_uri': '/nodes/b/', 'status': 6, 'tag_names': []},
+            {'hostname': 'n1', 'system_id': 'n1', 'resource_uri': '/nodes/n1/',
+             'status': 4, 'tag_names': ['fast']},
+            {'hostname': 'n2', 'system_id': 'n2', 'resource_uri': '/nodes/n2/',
+             'status': 4, 'tag_names': []},
+            {'hostname': 'n3', 'system_id': 'n3', 'resource_uri': '/nodes/n3/',
+             'status': 6, 'tag_names': ['fast']}]
+        self.client = MagicMock()
+        self.nodes_prop = PropertyMock(return_value=self.nodes)
+        type(self.client).nodes = self.nodes_prop
+        self.state = MaasState(self.client)
+
+    def test_lookups(self):
+        s = self.state
+        self.assertEqual(s.machine('/nodes/n2/').system_id, 'n2')
+        self.assertIsNone(s.machine('/nodes/b/'))
+        self.assertEqual(s.machine_by_system_id('n3').hostname, 'n3')
+        self.assertEqual([m.system_id for m in
+                          s.machines(MaasMachineStatus.READY)], ['n1', 'n2'])
+        self.assertEqual([m.system_id for m in s.machines(tag='fast')],
+                         ['n1', 'n3'])
+        self.assertEqual([m.system_id for m in
+                          s.machines(MaasMachineStatus.READY, tag='fast')],
+                         ['n1'])
+        self.assertEqual(len(s.machines()), 3)
+
+    def test_index_rebuilt_only_on_new_nodes(self):
+        s = self.state
+        m = s.machine('/nodes/n1/')
+        self.assertIs(m, s.machine('/nodes/n1/'))
+        s.invalidate_nodes_cache()
+        self.nodes_prop.return_value = list(self.nodes)
+        self.assertIsNot(m, s.machine('/nodes/n1/'))
+
+    def test_invalidate_during_fetch(self):
+        "another thread invalidating the cache mid-fetch loses no nodes"
+        def invalidate(nodes):
+            t = threading.Thread(target=self.state.invalidate_nodes_cache)
+            t.start()
+            t.join()
+
+        self.state.subscribe(invalidate)
+        self.addCleanup(self.state.unsubscribe, invalidate)
+        self.assertEqual(len(self.state.machines()), 3)
+
+
+class MaasClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        auth = MaasAuth(api_url='http://maas/MAAS/api/1.0',
+                        api_key='ck:tk:ts')
+        self.client = MaasClient(auth, retry_backoff=0)
+        self.client.session.request = MagicMock(name='request')
+
+    def test_reuses_session_and_auth(self):
+        self.client.get('/nodes/', dict(op='list'))
+        self.client.post('/tags/', dict(op='new', name='t'))
+        calls = self.client.session.request.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertIs(calls[0][1]['auth'], calls[1][1]['auth'])
+        self.assertEqual(calls[0][0], ('GET',
+                                       'http://maas/MAAS/api/1.0/nodes/'))
+        self.assertEqual(calls[0][1]['timeout'], self.client.timeout)
+
+    @patch('maasclient.time.sleep')
+    def test_retries_connection_errors(self, mock_sleep):
+        err = requests.exceptions.ConnectionError('refused')
+        self.client.session.request.side_effect = [err, err, MagicMock()]
+        self.client.get('/nodes/')
+        self.assertEqual(self.client.session.request.call_count, 3)
+
+    @patch('maasclient.time.sleep')
+    def test_gives_up_after_max_retries(self, mock_sleep):
+        err = requests.exceptions.ConnectionError('refused')
+        self.client.session.request.side_effect = err
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          self.client.get, '/nodes/')
+        self.assertEqual(self.client.session.request.call_count,
+                         self.client.max_retries + 1)
+
+    @patch('maasclient.time.sleep')
+    def test_post_not_retried_on_timeout(self, mock_sleep):
+        err = requests.exceptions.Timeout('slow')
+        self.client.session.request.side_effect = err
+        self.assertRaises(requests.exceptions.Timeout,
+                          self.client.post, '/nodes/', dict(op='start'))
+        self.assertEqual(self.client.session.request.call_count, 1)
+
+    def _refused(self, reason):
+        return requests.exceptions.ConnectionError(
+            MaxRetryError(None, '/nodes/', reason))
+
+    @patch('maasclient.time.sleep')
+    def test_post_retried_before_send(self, mock_sleep):
+        # what the urllib3 bundled with requests 2.2.1 reports
+        refused = self._refused(ConnectionRefusedError(111, 'refused'))
+        unknown = self._refused(socket.gaierror(-2, 'unknown host'))
+        self.client.session.request.side_effect = [refused, unknown,
+                                                   MagicMock()]
+        self.client.post('/nodes/', dict(op='start'))
+        self.assertEqual(self.client.session.request.call_count, 3)
+
+    @unittest.skipUnless(hasattr(requests.exceptions, 'ConnectTimeout'),
+                         "requests < 2.4")
+    @patch('maasclient.time.sleep')
+    def test_post_retried_before_send_newer_requests(self, mock_sleep):
+        refused = self._refused(urllib3_exceptions.NewConnectionError(
+            None, 'refused'))
+        slow = requests.exceptions.ConnectTimeout('connect timed out')
+        self.client.session.request.side_effect = [refused, slow,
+                                                   MagicMock()]
+        self.client.post('/nodes/', dict(op='start'))
+        self.assertEqual(self.client.session.request.call_count, 3)
+
+    @patch('maasclient.time.sleep')
+    def test_post_not_retried_after_send(self, mock_sleep):
+        errors = [self._refused(ConnectionResetError(104, 'reset'))]
+        if hasattr(urllib3_exceptions, 'ProtocolError'):
+            errors.append(requests.exceptions.ConnectionError(
+                urllib3_exceptions.ProtocolError('Connection aborted.',
+                                                 ConnectionResetError())))
+        for err in errors:
+            self.client.session.request.reset_mock()
+            self.client.session.request.side_effect = [err, MagicMock()]
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              self.client.post, '/nodes/', dict(op='start'))
+            self.assertEqual(self.client.session.request.call_count, 1)
+            # the same failure is safe to retry for a GET
+            self.client.session.request.side_effect = [err, MagicMock()]
+            self.client.get('/nodes/')
+            self.assertEqual(self.client.session.request.call_count, 3)
+
+    def test_pinned_requests(self):
+        """ maasclient imports and classifies errors without the
+        exception types added after requests 2.2.1
+        """
+        missing = [(requests.exceptions, 'ConnectTimeout'),
+                   (urllib3_exceptions, 'NewConnectionError'),
+                   (urllib3_exceptions, 'ProtocolError')]
+        saved = [(module, name, getattr(module, name))
+                 for module, name in missing if hasattr(module, name)]
+        self.addCleanup(importlib.reload, maasclient)
+        try:
+            for module, name, _ in saved:
+                delattr(module, name)
+            client = importlib.reload(maasclient)
+        finally:
+            for module, name, value in saved:
+                setattr(module, name, value)
+        self.assertTrue(client._not_sent(
+            self._refused(ConnectionRefusedError(111, 'refused'))))
+        self.assertFalse(client._not_sent(
+            self._refused(ConnectionResetError(104, 'reset'))))
+        self.assertFalse(client._not_sent(
+            requests.exceptions.ConnectionError('aborted')))
+
+
+class MaasClientTaggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        auth = MaasAuth(api_url='http://maas/MAAS/api/1.0',
+                        api_key='ck:tk:ts')
+        self.client = MaasClient(auth)
+        self.client.get = MagicMock(name='get')
+        self.client.get.return_value.text = json.dumps([{'name': 'n1'}])
+        self.client.post = MagicMock(name='post')
+        self.nodes = [{'system_id': 'n1', 'tag_names': ['n1'], 'status': 4},
+                      {'system_id': 'n2', 'tag_names': [], 'status': 0},
+                      {'system_id': 'n3', 'tag_names': [], 'status': 0}]
+
+    def test_tag_name(self):
+        self.client.tag_name(self.nodes)
+        # tag list fetched once, n1 already tagged
+        self.assertEqual(self.client.get.call_count, 1)
+        posted = sorted((args[0], tuple(sorted(args[1].items())))
+                        for args, _ in self.client.post.call_args_list)
+        self.assertEqual(posted, [
+            ('/tags/', (('name', 'n2'), ('op', 'new'))),
+            ('/tags/', (('name', 'n3'), ('op', 'new'))),
+            ('/tags/n2/', (('add', 'n2'), ('op', 'update_nodes'))),
+            ('/tags/n3/', (('add', 'n3'), ('op', 'update_nodes')))])
+
+    def test_tag_fpi_single_request(self):
+        self.client.tag_fpi(self.nodes)
+        self.client.post.assert_called_with(
+            '/tags/use-fastpath-installer/',
+            dict(op='update_nodes', add=['n2', 'n3']))
+
+
+class AsyncMaasClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        auth = MaasAuth(api_url='http://maas/MAAS/api/1.0', api_key='a:b:c')
+        self.client = AsyncMaasClient(auth, loop=self.loop, concurrency=4)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+
+    def test_details_many_concurrent(self):
+        "a batch takes about as long as its slowest node"
+        def details(system_id):
+            time.sleep(0.1)
+            if system_id == 'bad':
+                raise requests.exceptions.ConnectionError()
+            return {'id': system_id}
+        self.client.client.node_details = details
+        start = time.time()
+        rvs = self.loop.run_until_complete(
+            self.client.details_many(['a', 'bad', 'c', 'd']))
+        self.assertLess(time.time() - start, 0.3)
+        self.assertEqual(rvs[0], {'id': 'a'})
+        self.assertIsInstance(rvs[1], requests.exceptions.ConnectionError)
+        self.assertEqual(rvs[3], {'id': 'd'})
+
+    def test_start_many_args(self):
+        self.client.client.node_start = MagicMock(return_value=True)
+        rvs = self.loop.run_until_complete(
+            self.client.start_many(['a', 'b'], distro_series='trusty'))
+        self.assertEqual(rvs, [True, True])
+        self.client.client.node_start.assert_any_call('b', None, 'trusty')
+
+
+class FakeMaasServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.server = FakeMaasServer(num_nodes=50, status=0,
+                                     transition_delay=10, seed=1,
+                                     clock=lambda: self.now)
+        self.server.start()
+        self.client = MaasClient(MaasAuth(self.server.api_url,
+                                          self.server.api_key))
+        self.state = MaasState(self.client)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_bad_credentials(self):
+        client = MaasClient(MaasAuth(self.server.api_url, 'a:b:c'))
+        self.assertEqual(client.nodes, [])
+
+    def test_commission_to_ready(self):
+        self.assertEqual(len(self.state.machines(MaasMachineStatus.NEW)), 50)
+        self.assertTrue(self.client.nodes_accept_all())
+        self.state.invalidate_nodes_cache()
+        self.assertEqual(len(self.state.machines(
+            MaasMachineStatus.COMMISSIONING)), 50)
+        self.now += 10
+        self.state.invalidate_nodes_cache()
+        self.assertEqual(len(self.state.machines(MaasMachineStatus.READY)),
+                         50)
+
+    def test_tagging(self):
+        nodes = self.client.nodes
+        self.client.tag_fpi(nodes)
+        self.client.tag_name(nodes)
+        self.state.invalidate_nodes_cache()
+        m = self.state.machines()[0]
+        self.assertEqual(set(m.tag_names),
+                         {'use-fastpath-installer', m.system_id})
+        self.assertEqual(len(self.state.machines(tag=m.system_id)), 1)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+#
+# tests macumba
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import os
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from macumba import (JujuWS, JujuClient, RequestTimeout,
+                     UnknownRequestError, ServerError, LoginError,
+                     ConnectionClosedError, RequestInterrupted)
+from macumba.asyncclient import AsyncJujuClient
+from macumba.fakeserver import FakeJuju, FakeJujuError
+
+log = logging.getLogger('cloudinstall.test_macumba')
+
+
+def fake_frame(msg):
+    m = MagicMock(name='frame')
+    m.data = json.dumps(msg).encode('utf-8')
+    return m
+
+
+def replying_ws(responses, sent):
+    """ A JujuWS answering each request with responses[Request] """
+    ws = JujuWS('wss://localhost:17070', 'pass')
+
+    def fake_send(data):
+        msg = json.loads(data)
+        sent.append(msg)
+        reply = dict(RequestId=msg['RequestId'],
+                     Response=responses.get(msg['Request'], {}))
+        threading.Timer(0.01, ws.received_message,
+                        [fake_frame(reply)]).start()
+
+    ws.send = fake_send
+    ws.connect = ws.opened
+    return ws
+
+
+class JujuWSTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ws = JujuWS('wss://localhost:17070', 'pass')
+        self.ws.send = MagicMock(name='send')
+
+    def test_reply_wakes_waiter(self):
+        "a reply delivered from another thread completes the request"
+        rid = self.ws.do_send(dict(Type='Client', Request='FullStatus'))
+        t = threading.Timer(0.05, self.ws.received_message,
+                            [fake_frame(dict(RequestId=rid,
+                                             Response={}))])
+        t.start()
+        msg = self.ws.do_receive(rid, timeout=5)
+        self.assertEqual(msg['RequestId'], rid)
+        self.assertNotIn(rid, self.ws.messages)
+
+    def test_receive_timeout_returns_none(self):
+        rid = self.ws.do_send(dict(Type='Client', Request='FullStatus'))
+        self.assertIsNone(self.ws.do_receive(rid, timeout=0.01))
+
+    def test_unknown_request(self):
+        self.assertRaises(UnknownRequestError, self.ws.do_receive, 1234)
+
+    def test_unknown_reply_dropped(self):
+        self.ws.received_message(fake_frame(dict(RequestId=99,
+                                                 Response={})))
+        self.assertNotIn(99, self.ws.messages)
+
+    def test_timeout_forgets_request(self):
+        "a reply arriving after the timeout is dropped and counted"
+        self.ws.metrics = MagicMock(name='metrics')
+        rid = self.ws.do_send(dict(Type='Client', Request='FullStatus'))
+        self.assertIsNone(self.ws.do_receive(rid, timeout=0.01))
+        self.assertNotIn(rid, self.ws.messages)
+        self.assertEqual(self.ws.pending_count(), 0)
+        self.ws.received_message(fake_frame(dict(RequestId=rid,
+                                                 Response={})))
+        self.ws.metrics.late_reply.assert_called_once_with('FullStatus')
+        self.assertRaises(UnknownRequestError, self.ws.do_receive, rid)
+
+    def test_expire(self):
+        "entries past their deadline are dropped unless being waited on"
+        self.ws.metrics = MagicMock(name='metrics')
+        rid = self.ws.do_send(dict(Type='Client', Request='FullStatus'))
+        self.assertEqual(self.ws.expire(), 0)
+        deadline = self.ws.messages[rid].deadline
+        self.ws.messages[rid].waiting = True
+        self.assertEqual(self.ws.expire(deadline), 0)
+        self.ws.messages[rid].waiting = False
+        self.assertEqual(self.ws.expire(deadline), 1)
+        self.assertNotIn(rid, self.ws.messages)
+        self.assertEqual(self.ws.pending_count(), 0)
+        self.ws.metrics.expired.assert_called_once_with('FullStatus')
+
+    def test_max_pending_blocks_until_reply(self):
+        self.ws.max_pending = 1
+        rid = self.ws.do_send(dict(Type='Client', Request='FullStatus'))
+        t = threading.Timer(0.05, self.ws.received_message,
+                            [fake_frame(dict(RequestId=rid,
+                                             Response={}))])
+        t.start()
+        rid2 = self.ws.do_send(dict(Type='Client', Request='FullStatus'))
+        t.join()
+        # the reply freed the slot, though it hasn't been received yet
+        self.assertIn(rid, self.ws.messages)
+        self.assertEqual(self.ws.pending_count(), 1)
+        self.assertEqual(self.ws.do_receive(rid)['RequestId'], rid)
+        self.assertIn(rid2, self.ws.messages)
+
+
+class JujuClientReceiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient()
+        self.client.conn.send = MagicMock(name='send')
+
+    def test_receive_timeout(self):
+        rid = self.client.conn.do_send(dict(Type='Client',
+                                            Request='FullStatus'))
+        self.assertRaises(RequestTimeout, self.client.receive, rid, 0.01)
+
+    def test_receive_error(self):
+        rid = self.client.conn.do_send(dict(Type='Client',
+                                            Request='FullStatus'))
+        self.client.conn.received_message(
+            fake_frame(dict(RequestId=rid, Error='boom')))
+        self.assertRaises(ServerError, self.client.receive, rid, 1)
+
+
+class JujuClientCallManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient()
+        self.sent = []
+
+        def fake_send(data):
+            msg = json.loads(data)
+            self.sent.append(msg)
+            rid = msg['RequestId']
+            if msg['Params']['Tag'] == 'machine-2':
+                reply = dict(RequestId=rid, Error='not found')
+            else:
+                reply = dict(RequestId=rid,
+                             Response={'Annotations': {'id': rid}})
+            threading.Timer(0.01, self.client.conn.received_message,
+                            [fake_frame(reply)]).start()
+
+        self.client.conn.send = fake_send
+
+    def test_all_sent_before_receive(self):
+        "every request is sent, results come back in order"
+        rvs = self.client.get_annotations_many([('1', 'machine'),
+                                                ('2', 'machine'),
+                                                ('3', 'machine')],
+                                               timeout=5)
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(rvs[0]['Annotations']['id'],
+                         self.sent[0]['RequestId'])
+        self.assertIsInstance(rvs[1], ServerError)
+        self.assertEqual(rvs[2]['Annotations']['id'],
+                         self.sent[2]['RequestId'])
+
+
+class JujuClientMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient()
+
+        def fake_send(data):
+            msg = json.loads(data)
+            rid = msg['RequestId']
+            if msg['Request'] == 'FullStatus':
+                reply = dict(RequestId=rid, Response={'Machines': {}})
+            elif msg['Request'] == 'WatchAll':
+                return
+            else:
+                reply = dict(RequestId=rid, Error='boom')
+            threading.Timer(0.01, self.client.conn.received_message,
+                            [fake_frame(reply)]).start()
+
+        self.client.conn.send = fake_send
+
+    def test_request_counters(self):
+        self.client.status()
+        self.client.status()
+        self.assertRaises(ServerError, self.client.info)
+        self.assertRaises(RequestTimeout, self.client.call,
+                          dict(Type='Client', Request='WatchAll'), 0.01)
+
+        status = self.client.metrics.stats('FullStatus')
+        self.assertEqual(status.sent, 2)
+        self.assertEqual(status.completed, 2)
+        self.assertEqual(status.in_flight, 0)
+        self.assertGreater(status.bytes_received, 0)
+        self.assertGreater(status.latency_max, 0)
+        self.assertEqual(sum(status.latency_buckets), 2)
+        self.assertEqual(
+            self.client.metrics.stats('EnvironmentInfo').errors, 1)
+        self.assertEqual(self.client.metrics.stats('WatchAll').timeouts, 1)
+        self.assertEqual(self.client.metrics.in_flight(), 0)
+
+    def test_snapshot_and_dump(self):
+        self.client.status()
+        snap = self.client.metrics.snapshot()
+        self.assertEqual(snap['completed'], 1)
+        self.assertEqual(snap['requests']['FullStatus']['latency_p50'],
+                         self.client.metrics.stats('FullStatus')
+                         .percentile(50))
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'metrics.json')
+            self.client.metrics.dump(filename)
+            with open(filename) as f:
+                self.assertEqual(json.load(f)['requests'].keys(),
+                                 {'FullStatus'})
+
+
+class JujuClientReconnectTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = JujuClient()
+        self.sent = []
+        self.responses = {'FullStatus': {'Machines': {}},
+                          'WatchAll': {'AllWatcherId': 'w1'}}
+        # requests on the first connection are never answered
+        self.client.conn.send = MagicMock(name='send')
+
+    def lose_connection(self):
+        threading.Timer(0.05, self.client.conn.closed, [1006]).start()
+        return patch('macumba.JujuWS',
+                     return_value=replying_ws(self.responses, self.sent))
+
+    def test_idempotent_request_replayed(self):
+        with self.lose_connection():
+            rv = self.client.status()
+        self.assertEqual(rv, {'Machines': {}})
+        self.assertEqual([m['Request'] for m in self.sent],
+                         ['Login', 'FullStatus'])
+        stats = self.client.metrics.stats('FullStatus')
+        self.assertEqual((stats.interrupted, stats.replayed), (1, 1))
+        self.assertEqual(self.client.metrics.reconnects, 1)
+
+    def test_other_request_interrupted(self):
+        with self.lose_connection():
+            self.assertRaises(RequestInterrupted, self.client.add_relation,
+                              'keystone:shared-db', 'mysql:shared-db')
+        self.assertEqual([m['Request'] for m in self.sent], ['Login'])
+
+    def test_failed_send_retried(self):
+        "a request that never went out is sent on the new connection"
+        conn = self.client.conn
+
+        def broken_send(data):
+            conn.closed(1006)
+            raise OSError('broken pipe')
+
+        conn.send.side_effect = broken_send
+        with patch('macumba.JujuWS',
+                   return_value=replying_ws(self.responses, self.sent)):
+            self.client.add_relation('keystone:shared-db',
+                                     'mysql:shared-db')
+        self.assertEqual([m['Request'] for m in self.sent],
+                         ['Login', 'AddRelation'])
+
+    def test_backoff(self):
+        self.client.reconnect = MagicMock(
+            side_effect=[LoginError('down'), LoginError('down'), None])
+        with patch('macumba.time.sleep') as sleep:
+            self.client._recover(self.client.conn)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2])
+
+    def test_backoff_gives_up(self):
+        self.client.reconnect_timeout = 0
+        self.client.reconnect = MagicMock(side_effect=LoginError('down'))
+        self.assertRaises(ConnectionClosedError, self.client._recover,
+                          self.client.conn)
+
+    def test_watcher_recreated(self):
+        self.client.conn = replying_ws(self.responses, self.sent)
+        watcher_id = self.client.get_watcher()['AllWatcherId']
+        self.responses['WatchAll'] = {'AllWatcherId': 'w2'}
+        with patch('macumba.JujuWS',
+                   return_value=replying_ws(self.responses, self.sent)):
+            self.client.reconnect()
+        self.assertEqual(self.client.watcher_generation(watcher_id), 1)
+        self.client.get_watched_tasks(watcher_id)
+        self.assertEqual(self.sent[-1]['Id'], 'w2')
+
+
+class FakeAsyncWS:
+
+    open = True
+
+    def __init__(self, client, reply=True):
+        self.client = client
+        self.reply = reply
+        self.sent = []
+
+    @asyncio.coroutine
+    def send(self, data):
+        msg = json.loads(data)
+        self.sent.append(msg)
+        if self.reply:
+            self.client.loop.call_soon(
+                self.client._dispatch,
+                dict(RequestId=msg['RequestId'],
+                     Response={'Request': msg['Request']}))
+
+
+class AsyncJujuClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncJujuClient(loop=self.loop)
+        self.client.ws = FakeAsyncWS(self.client)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_call(self):
+        rv = self.loop.run_until_complete(self.client.status())
+        self.assertEqual(rv, {'Request': 'FullStatus'})
+        self.assertEqual(self.client.messages, {})
+
+    def test_call_many(self):
+        rvs = self.loop.run_until_complete(
+            self.client.add_units([('nova-compute', 1, '1'),
+                                   ('nova-compute', 1, '2')]))
+        self.assertEqual(len(self.client.ws.sent), 2)
+        self.assertEqual(rvs, [{'Request': 'AddServiceUnits'}] * 2)
+
+    def test_timeout(self):
+        self.client.ws.reply = False
+        self.assertRaises(RequestTimeout, self.loop.run_until_complete,
+                          self.client.call(dict(Type='Client',
+                                                Request='FullStatus'),
+                                           timeout=0.01))
+        self.assertEqual(self.client.messages, {})
+
+    def test_watcher(self):
+        rv = self.loop.run_until_complete(self.client.get_watcher())
+        self.assertEqual(rv, {'Request': 'WatchAll'})
+        rv = self.loop.run_until_complete(
+            self.client.get_watched_tasks('w1'))
+        self.assertEqual(rv, {'Request': 'Next'})
+        self.assertEqual(self.client.ws.sent[-1]['Id'], 'w1')
+        self.assertEqual(self.client.watcher_generation('w1'), 0)
+
+    def test_inherited_helpers(self):
+        """ JujuClient helpers find the state they share """
+        self.assertIsNone(self.client.conn)
+        params = self.client._replay_params(dict(Type='AllWatcher',
+                                                 Request='Next',
+                                                 Id='w1', RequestId=3))
+        self.assertEqual(params, dict(Type='AllWatcher', Request='Next',
+                                      Id='w1'))
+        self.assertEqual(self.client.metrics.snapshot()['requests'], {})
+        with self.client.tracer('FullStatus', cat='juju'):
+            pass
+
+
+class FakeJujuTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.juju = FakeJuju(password='pass', machine_delay=10,
+                             unit_delay=5, clock=lambda: self.now)
+        self.session = {}
+        self.call('Admin', 'Login', Password='pass')
+
+    def call(self, rtype, request, **params):
+        return self.juju.handle(dict(Type=rtype, Request=request,
+                                     Params=params), self.session)
+
+    def test_login_required(self):
+        self.assertRaises(FakeJujuError, self.juju.handle,
+                          dict(Type='Client', Request='FullStatus'), {})
+        self.assertRaises(FakeJujuError, self.juju.handle,
+                          dict(Type='Admin', Request='Login',
+                               Params=dict(Password='wrong')), {})
+
+    def test_machine_and_unit_states(self):
+        rv = self.call('Client', 'AddMachines',
+                       MachineParams=[dict(Constraints=dict(tags=['n1']))])
+        mid = rv['Machines'][0]['Machine']
+        self.call('Client', 'ServiceDeploy', ServiceName='mysql',
+                  CharmUrl='cs:trusty/mysql', NumUnits=1,
+                  ToMachineSpec='lxc:' + mid)
+        status = self.call('Client', 'FullStatus')
+        m = status['Machines'][mid]
+        self.assertEqual(m['InstanceId'], '/MAAS/api/1.0/nodes/n1/')
+        self.assertEqual(m['AgentState'], 'pending')
+        self.assertIn(mid + '/lxc/0', m['Containers'])
+        unit = status['Services']['mysql']['Units']['mysql/0']
+        self.assertEqual(unit['AgentState'], 'pending')
+
+        self.now += 20  # host and container started
+        self.assertEqual(self.juju.unit_state('mysql/0'), 'installed')
+        self.now += 5
+        self.assertEqual(self.juju.unit_state('mysql/0'), 'started')
+        self.assertIsNone(self.juju.next_transition())
+
+    def test_relation_exists(self):
+        for name in ['mysql', 'keystone']:
+            self.call('Client', 'ServiceDeploy', ServiceName=name,
+                      CharmUrl='cs:trusty/' + name, NumUnits=0)
+        self.call('Client', 'AddRelation',
+                  Endpoints=['keystone:shared-db', 'mysql:shared-db'])
+        with self.assertRaisesRegex(FakeJujuError,
+                                    'relation already exists'):
+            self.call('Client', 'AddRelation',
+                      Endpoints=['mysql:shared-db', 'keystone:shared-db'])
+        rels = self.call('Client', 'FullStatus')['Services']['mysql'][
+            'Relations']
+        self.assertEqual(rels, {'shared-db': ['keystone']})
+
+    def test_annotations(self):
+        self.call('Client', 'SetAnnotations', Tag='machine-0',
+                  Pairs={'instance_id': 'x'})
+        rv = self.call('Client', 'GetAnnotations', Tag='machine-0')
+        self.assertEqual(rv['Annotations'], {'instance_id': 'x'})
+
+    def test_watcher_deltas(self):
+        wid = self.call('Client', 'WatchAll')['AllWatcherId']
+        deltas = self.juju.next_deltas(wid)
+        self.assertEqual([d[:2] for d in deltas], [['machine', 'change']])
+        self.assertEqual(self.juju.next_deltas(wid), [])
+        self.call('Client', 'AddMachines', MachineParams=[{}])
+        self.assertEqual([d[2]['Status'] for d in self.juju.next_deltas(wid)],
+                         ['pending'])
+        self.now += 10
+        self.assertEqual([d[2]['Status'] for d in self.juju.next_deltas(wid)],
+                         ['started'])
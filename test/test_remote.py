@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# tests remote.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import unittest
+from unittest.mock import patch
+
+from cloudinstall import remote
+
+log = logging.getLogger('cloudinstall.test_remote')
+
+JUJU_HOME = "JUJU_HOME=~/.cloud-install/juju"
+
+
+@patch('cloudinstall.remote.utils.get_command_output')
+class RemoteTestCase(unittest.TestCase):
+
+    def test_run_one_call_for_all_machines(self, mock_output):
+        mock_output.return_value = dict(status=1, err="", output=json.dumps([
+            {'MachineId': '1', 'Stdout': 'hi\n'},
+            {'MachineId': '2', 'ReturnCode': 2, 'Stderr': 'no'}]))
+        results = remote.run(['1', '2', 3], ["echo hi", "true"], JUJU_HOME)
+
+        mock_output.assert_called_once_with(
+            JUJU_HOME + " juju run --format json --machine 1,2,3 "
+            "'echo hi && true'", timeout=None)
+        self.assertTrue(results['1'].ok)
+        self.assertEqual(results['1'].stdout, 'hi\n')
+        self.assertEqual(results['2'].code, 2)
+        self.assertFalse(results['2'].ok)
+        self.assertEqual(results['3'].error, "no result from juju run")
+
+    def test_run_juju_failure(self, mock_output):
+        mock_output.return_value = dict(status=1, output="",
+                                        err="no environment")
+        results = remote.run(['1'], "true", JUJU_HOME)
+        self.assertEqual(results['1'].error, "no environment")
+
+    def test_copy_each_machine(self, mock_output):
+        mock_output.side_effect = lambda cmd, timeout: dict(
+            status=1 if '2:' in cmd else 0, output="", err="")
+        results = remote.copy(['1', '2'], "/src file", "/tmp/dst",
+                              JUJU_HOME)
+        self.assertEqual(mock_output.call_count, 2)
+        mock_output.assert_any_call(
+            JUJU_HOME + " juju scp '/src file' 1:/tmp/dst", timeout=None)
+        self.assertTrue(results['1'].ok)
+        self.assertFalse(results['2'].ok)
+
+    def test_run_each(self, mock_output):
+        mock_output.side_effect = lambda cmd, timeout: dict(
+            status=0, err="", output=json.dumps(
+                [{'MachineId': cmd.split('--machine ')[1].split()[0],
+                  'Stdout': cmd}]))
+        results = remote.run_each({'1': "hostname a", '2': "hostname b"},
+                                  JUJU_HOME)
+        self.assertIn("'hostname a'", results['1'].stdout)
+        self.assertIn("'hostname b'", results['2'].stdout)
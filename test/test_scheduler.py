@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# tests scheduler.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from cloudinstall.scheduler import (DeployScheduler, RelationEngine,
+                                    RelationState, TaskScheduler, TaskState,
+                                    deploy_graph, post_proc_graph,
+                                    unique_relations)
+
+log = logging.getLogger('cloudinstall.test_scheduler')
+
+
+def fake_charm(name, deploy_priority=100, depends=[], related=[]):
+    return type(name, (), dict(charm_name=name,
+                               deploy_priority=deploy_priority,
+                               depends=depends,
+                               related=related))
+
+
+class DeployGraphTestCase(unittest.TestCase):
+
+    def test_related_ordered_by_priority(self):
+        mysql = fake_charm('mysql', 0)
+        keystone = fake_charm('keystone', 1,
+                              related=[('mysql:shared-db',
+                                        'keystone:shared-db')])
+        ntp = fake_charm('ntp', 0)
+        graph = deploy_graph([keystone, mysql, ntp])
+        self.assertEqual(graph[keystone], {mysql})
+        self.assertEqual(graph[mysql], set())
+        self.assertEqual(graph[ntp], set())
+
+    def test_mutual_depends_is_not_a_cycle(self):
+        proxy = fake_charm('swift-proxy', 5, depends=['swift-storage'])
+        storage = fake_charm('swift-storage', 5, depends=['swift-proxy'])
+        graph = deploy_graph([proxy, storage])
+        self.assertEqual(graph[proxy], set())
+        self.assertEqual(graph[storage], {proxy})
+
+    def test_unassigned_dependency_ignored(self):
+        osd = fake_charm('ceph-osd', depends=['ntp', 'ceph'])
+        self.assertEqual(deploy_graph([osd])[osd], set())
+
+
+class PostProcGraphTestCase(unittest.TestCase):
+
+    def test_post_proc_depends(self):
+        gss = fake_charm('glance-simplestreams-sync')
+        gss.post_proc_depends = []
+        swift = fake_charm('swift-storage')
+        swift.post_proc_depends = ['glance-simplestreams-sync', 'missing']
+        graph = post_proc_graph([swift, gss])
+        self.assertEqual(graph[swift], {gss})
+        self.assertEqual(graph[gss], set())
+
+
+class DeploySchedulerTestCase(unittest.TestCase):
+
+    def test_independent_charms_deploy_together(self):
+        "unlinked charms are in flight at the same time"
+        charms = [fake_charm(n) for n in ['a', 'b', 'c']]
+        barrier = threading.Barrier(3, timeout=5)
+
+        def deploy(cc):
+            barrier.wait()
+            return False
+
+        s = DeployScheduler(charms, deploy)
+        s.run()
+        self.assertTrue(s.is_done())
+
+    def test_order_and_retry(self):
+        mysql = fake_charm('mysql', 0)
+        keystone = fake_charm('keystone', 1,
+                              related=[('mysql:shared-db',
+                                        'keystone:shared-db')])
+        calls = []
+
+        def deploy(cc):
+            calls.append(cc.charm_name)
+            # mysql's machine is not ready on the first attempt
+            return calls.count('mysql') == 1 and cc is mysql
+
+        states = []
+        s = DeployScheduler([keystone, mysql], deploy, backoff=0,
+                            on_change=lambda s: states.append(
+                                s.states[mysql]))
+        s.run()
+        self.assertEqual(calls, ['mysql', 'mysql', 'keystone'])
+        self.assertIn(TaskState.DEFERRED, states)
+        self.assertEqual(s.attempts[mysql], 2)
+
+    def test_exception_is_deferred(self):
+        charm = fake_charm('a')
+        calls = []
+
+        def deploy(cc):
+            calls.append(cc)
+            if len(calls) == 1:
+                raise Exception("boom")
+            return False
+
+        DeployScheduler([charm], deploy, backoff=0).run()
+        self.assertEqual(len(calls), 2)
+
+    def test_repeated_exception_fails(self):
+        "a task that keeps raising fails, and its dependents never run"
+        a, b = fake_charm('a', 0), fake_charm('b', 1, depends=['a'])
+        calls = []
+
+        def deploy(cc):
+            calls.append(cc)
+            raise ValueError("bad config")
+
+        s = DeployScheduler([a, b], deploy, backoff=0, max_failures=3)
+        self.assertRaises(ValueError, s.run)
+        self.assertEqual(calls, [a, a, a])
+        self.assertEqual(s.states[a], TaskState.FAILED)
+        self.assertEqual(s.states[b], TaskState.PENDING)
+
+    def test_task_scheduler_key(self):
+        "ready tasks start in key order"
+        a, b, c = fake_charm('a', 2), fake_charm('b', 0), fake_charm('c', 1)
+        calls = []
+        s = TaskScheduler({a: set(), b: set(), c: set()},
+                          lambda t: calls.append(t.charm_name), workers=1,
+                          key=lambda t: t.deploy_priority)
+        s.run()
+        self.assertEqual(calls, ['b', 'c', 'a'])
+
+    def test_task_scheduler_graph(self):
+        a, b = fake_charm('a'), fake_charm('b')
+        calls = []
+        s = TaskScheduler({a: set(), b: {a}},
+                          lambda t: calls.append(t.charm_name))
+        s.run()
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual(set(s.tasks_in_state(TaskState.DONE)), {a, b})
+
+
+class RelationEngineTestCase(unittest.TestCase):
+
+    def test_unique_relations(self):
+        rels = [('a:x', 'b:x'), ('b:x', 'a:x'), ('a:y', 'c:y'),
+                ('a:x', 'b:x')]
+        self.assertEqual(unique_relations(rels), [('a:x', 'b:x'),
+                                                  ('a:y', 'c:y')])
+
+    def test_progress_and_retry(self):
+        juju = MagicMock(name='juju')
+        err = Exception('not yet')
+        juju.add_relations.side_effect = [[err, {}], [{}]]
+        progress = []
+        engine = RelationEngine(juju, [('a:x', 'b:x'), ('a:y', 'c:y')],
+                                backoff=0,
+                                on_progress=lambda e, r: progress.append(
+                                    (r, e.states[r])))
+        engine.run()
+        self.assertEqual(progress,
+                         [(('a:x', 'b:x'), RelationState.FAILED),
+                          (('a:y', 'c:y'), RelationState.ADDED),
+                          (('a:x', 'b:x'), RelationState.ADDED)])
+        self.assertEqual(engine.outstanding(), [])
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# tests trace.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import os
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+
+from cloudinstall import trace
+
+log = logging.getLogger('cloudinstall.test_trace')
+
+
+class TraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        trace.clear()
+
+    def tearDown(self):
+        trace.disable()
+        trace.clear()
+
+    def test_disabled_records_nothing(self):
+        with trace.span("quiet"):
+            pass
+        self.assertEqual(trace.events(), [])
+
+    def test_nested_spans_and_threads(self):
+        trace.enable()
+
+        @trace.traced(cat='post_proc')
+        def work():
+            with trace.span("inner", cat='juju', request='FullStatus'):
+                pass
+
+        with trace.span("outer"):
+            work()
+        t = threading.Thread(target=work, name='worker')
+        t.start()
+        t.join()
+
+        spans = [e for e in trace.events() if e['ph'] == 'X']
+        self.assertEqual([e['name'] for e in spans],
+                         ['inner', 'TraceTestCase.test_nested_spans_and_'
+                          'threads.<locals>.work', 'outer', 'inner',
+                          'TraceTestCase.test_nested_spans_and_threads.'
+                          '<locals>.work'])
+        inner, work_span, outer = spans[:3]
+        self.assertGreaterEqual(inner['ts'], outer['ts'])
+        self.assertLessEqual(inner['ts'] + inner['dur'],
+                             outer['ts'] + outer['dur'])
+        self.assertEqual(inner['args'], {'request': 'FullStatus'})
+        self.assertEqual(work_span['cat'], 'post_proc')
+        self.assertNotEqual(spans[3]['tid'], inner['tid'])
+        names = [e['args']['name'] for e in trace.events()
+                 if e['ph'] == 'M']
+        self.assertIn('worker', names)
+
+    def test_error_recorded(self):
+        trace.enable()
+        with self.assertRaises(ValueError):
+            with trace.span("fails"):
+                raise ValueError("boom")
+        self.assertIn('boom', trace.events()[0]['args']['error'])
+
+    def test_export(self):
+        trace.enable()
+        with trace.span("deploy mysql"):
+            pass
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'trace.json')
+            trace.export(filename)
+            with open(filename) as f:
+                data = json.load(f)
+        self.assertEqual(data['traceEvents'][0]['name'], 'deploy mysql')